@@ -1,122 +1,1885 @@
 import os
+import functools
+import hmac
 import google.generativeai as genai
-from flask import Flask, jsonify, request
+from google.api_core import exceptions as google_exceptions
+from flask import Flask, Response, g, jsonify, request, stream_with_context
 from flask_cors import CORS
-from dotenv import load_dotenv
 import psycopg2
-import traceback
+import psycopg2.pool
+import psycopg2.extras
+import psycopg2.extensions
+import uuid
+import contextvars
+import unicodedata
 import json
-import requests 
+import csv
+import io
+import re
+import threading
+import asyncio
+import concurrent.futures
+import ast
+import math
+import random
+import time
+import datetime
+from collections import OrderedDict, deque
+from types import SimpleNamespace
+from prometheus_client import (CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Histogram,
+                               generate_latest, multiprocess)
+
+from elo import db
+from elo.db import DATABASE_URL, PoolTimeoutError, TimedCursor, db_cursor, run_db_steps
+from elo.dedup import link_known_contact_steps
+from elo.idempotency import idempotency_key, idempotency_response, idempotency_store, idempotent
+from elo.migrations import STATUS_AGUARDANDO_N8N, setup_database
+from elo.observability import (CACHE_REQUESTS, HTTP_REQUEST_SECONDS, LLM_IN_FLIGHT, LLM_REJECTIONS, LLM_WAITING,
+                               METRICS_LATENCY_BUCKETS, STAGE_SECONDS, begin_request_log, incoming_request_id,
+                               log, log_payload, log_queue_size, log_stats, observe_stage, record_error,
+                               record_llm_usage)
+from elo.outbox import SALES_WEBHOOK_URL, enqueue_webhook, outbox_dispatcher
+from elo.widget import serve_widget_file
+from elo.write_behind import lead_write_behind
 
 # A v3.1 corrige o bug do 'system_instruction'
-print("ℹ️  Iniciando a API do [SUA_GRÁFICA BOT] (v3.1 - Correção de Erro)...")
-load_dotenv()
+log.info("Iniciando a API do [SUA_GRÁFICA BOT] (v3.1 - Correção de Erro)...")
+
+app = Flask(__name__)
+CORS(app)
+
+try:
+    GEMINI_API_KEY = os.environ.get("GEMINI_API_KEY")
+    N8N_SECRET_KEY = os.environ.get("N8N_SECRET_KEY", "sua-chave-secreta-padrao") 
+
+    if not DATABASE_URL or not GEMINI_API_KEY:
+        log.critical("DATABASE_URL ou GEMINI_API_KEY não encontradas.")
+    if not SALES_WEBHOOK_URL:
+        log.warning("SALES_WEBHOOK_URL não configurada.")
+    if not N8N_SECRET_KEY:
+        log.warning("N8N_SECRET_KEY não configurada. A atualização de status pelo N8N pode falhar.")
+        
+    genai.configure(api_key=GEMINI_API_KEY)
+    # Modelo global para endpoints SEM instrução de sistema dinâmica
+    model = genai.GenerativeModel('gemini-2.5-flash-preview-09-2025') 
+    log.info("[Gemini] Modelo ('gemini-2.5-flash-preview-09-2025') inicializado.")
+
+except Exception as e:
+    model = None
+    log.exception(f"Erro ao carregar chaves ou configurar Gemini: {e}")
+
+@app.before_request
+def start_request():
+    g.metrics_started = time.perf_counter()
+    g.request_id = begin_request_log(incoming_request_id(request.headers))
+
+
+@app.after_request
+def observe_request(response):
+    started = g.pop('metrics_started', None)
+    if started is not None:
+        endpoint = request.url_rule.rule if request.url_rule else 'desconhecido'
+        elapsed = time.perf_counter() - started
+        HTTP_REQUEST_SECONDS.labels(endpoint, request.method, response.status_code).observe(elapsed)
+        log.info("Requisição atendida", extra={"method": request.method, "endpoint": endpoint,
+                                                "status": response.status_code, "ms": round(elapsed * 1000, 1)})
+    if 'request_id' in g:
+        response.headers['X-Request-ID'] = g.request_id
+    return response
+
+@app.errorhandler(PoolTimeoutError)
+def handle_pool_timeout(e):
+    record_error("db_pool", e)
+    log.error(f"[DB-Pool] Pool saturado: {e}")
+    response = jsonify({"error": "Serviço temporariamente sobrecarregado. Tente novamente em instantes."})
+    response.headers["Retry-After"] = "1"
+    return response, 503
+
+# --- 2.2 [HELPER] Backend de LLM + Controle de Admissão ---
+# Os endpoints não chamam mais o `genai` direto: falam com `llm_backend`
+# (Gemini em produção, stub local determinístico para testes/benchmarks,
+# escolhido por LLM_BACKEND). Na frente dele fica o `llm_limiter`, que limita
+# as chamadas simultâneas (e opcionalmente por segundo) de cada worker com uma
+# fila de espera curta: passou do limite, a resposta é um 429/503 rápido com
+# Retry-After em vez de um timeout lento.
+LLM_BACKEND = os.environ.get("LLM_BACKEND", "gemini")  # 'gemini' ou 'stub'
+LLM_STUB_LATENCY = float(os.environ.get("LLM_STUB_LATENCY", 0.5))  # segundos
+LLM_MAX_CONCURRENT = int(os.environ.get("LLM_MAX_CONCURRENT", 16))
+LLM_MAX_WAITING = int(os.environ.get("LLM_MAX_WAITING", 32))
+LLM_WAIT_TIMEOUT = float(os.environ.get("LLM_WAIT_TIMEOUT", 2))  # segundos na fila antes do 503
+LLM_RATE_PER_SEC = float(os.environ.get("LLM_RATE_PER_SEC", 0))  # 0 = sem limite de taxa
+LLM_RATE_BURST = int(os.environ.get("LLM_RATE_BURST", 10))
+LLM_PROVIDER_COOLDOWN = float(os.environ.get("LLM_PROVIDER_COOLDOWN", 10))  # após um 429 do provedor
+LLM_STUB_TAIL_RATE = float(os.environ.get("LLM_STUB_TAIL_RATE", 0))  # fração de chamadas "travadas" no stub
+LLM_STUB_TAIL_LATENCY = float(os.environ.get("LLM_STUB_TAIL_LATENCY", 30))  # segundos
+
+
+class LLMOverloadedError(Exception):
+    """Chamada recusada pelo controle de admissão (vira 429/503 com Retry-After)."""
+
+    def __init__(self, message, status, retry_after):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+        self.retry_after = max(1, int(math.ceil(retry_after)))
+
+
+class LLMBackend:
+    """
+    Interface dos backends de LLM. As respostas expõem `.text` e
+    `.usage_metadata`; com stream=True, um iterável de pedaços com `.text`.
+    `variant` é 'primary' ou 'fallback' (modelo mais barato/rápido, ver 2.3)
+    e `timeout` é o tempo máximo da chamada no provedor, em segundos.
+    """
+    name = "base"
+
+    def available(self):
+        return True
+
+    def generate_chat(self, contents, stream=False, variant='primary', timeout=None):
+        raise NotImplementedError
+
+    async def generate_chat_async(self, contents, variant='primary', timeout=None):
+        raise NotImplementedError
+
+    def generate_text(self, prompt, variant='primary', timeout=None):
+        raise NotImplementedError
+
+    async def generate_text_async(self, prompt, variant='primary', timeout=None):
+        raise NotImplementedError
+
+
+def _request_options(timeout):
+    return {"timeout": timeout} if timeout else None
+
+
+class GeminiBackend(LLMBackend):
+    name = "gemini"
+
+    def available(self):
+        return model is not None
+
+    def _chat_model(self, variant):
+        return get_fallback_chat_model() if variant == 'fallback' else get_chat_model()
+
+    def _text_model(self, variant):
+        return get_fallback_text_model() if variant == 'fallback' else model
+
+    def generate_chat(self, contents, stream=False, variant='primary', timeout=None):
+        return self._chat_model(variant).generate_content(contents, stream=stream, request_options=_request_options(timeout))
+
+    async def generate_chat_async(self, contents, variant='primary', timeout=None):
+        # (get_chat_model pode criar o cache de contexto na 1ª chamada: fora do event loop)
+        chat_model = await asyncio.to_thread(self._chat_model, variant)
+        return await chat_model.generate_content_async(contents, request_options=_request_options(timeout))
+
+    def generate_text(self, prompt, variant='primary', timeout=None):
+        return self._text_model(variant).generate_content(
+            prompt, generation_config=ISCA_GENERATION_CONFIG, safety_settings=SAFETY_SETTINGS,
+            request_options=_request_options(timeout))
+
+    async def generate_text_async(self, prompt, variant='primary', timeout=None):
+        return await self._text_model(variant).generate_content_async(
+            prompt, generation_config=ISCA_GENERATION_CONFIG, safety_settings=SAFETY_SETTINGS,
+            request_options=_request_options(timeout))
+
+
+class StubResponse:
+    def __init__(self, text, prompt_tokens=0):
+        self.text = text
+        self.usage_metadata = SimpleNamespace(prompt_token_count=prompt_tokens, candidates_token_count=len(text) // 4)
+
+
+class StubStream:
+    """Imita o stream do Gemini: o JSON chega em pedaços, com a latência dividida entre eles."""
+
+    def __init__(self, response, latency, chunk_size=16):
+        self._response = response
+        self._latency = latency
+        self._chunk_size = chunk_size
+        self.text = response.text
+        self.usage_metadata = response.usage_metadata
+
+    def __iter__(self):
+        text = self._response.text
+        chunks = [text[i:i + self._chunk_size] for i in range(0, len(text), self._chunk_size)]
+        for chunk in chunks:
+            time.sleep(self._latency / len(chunks))
+            yield SimpleNamespace(text=chunk)
+
+
+class StubBackend(LLMBackend):
+    """
+    Backend local e determinístico, sem rede nem cota: a mesma entrada sempre
+    gera a mesma saída, depois de `latency` segundos. No chat, a última
+    mensagem do usuário vira o próximo campo que falta no [ESTADO ATUAL], então
+    um funil completo fecha em 6 rodadas. O 'fallback' responde na metade do
+    tempo; com `tail_rate` > 0, essa fração das chamadas demora `tail_latency`
+    (respeitando o timeout), para exercitar deadline e hedge.
+    """
+    name = "stub"
+    STATE_RE = re.compile(r'\[ESTADO ATUAL\] Estes são os dados que já temos: (\{.*?\})(?:\n|$)', re.DOTALL)
+    RAMO_RE = re.compile(r'ramo de "(.*?)"')
+
+    def __init__(self, latency, tail_rate=0.0, tail_latency=0.0):
+        self.latency = latency
+        self.tail_rate = tail_rate
+        self.tail_latency = tail_latency
+
+    def _delay(self, variant, timeout):
+        delay = self.latency / 2 if variant == 'fallback' else self.latency
+        if self.tail_rate and random.random() < self.tail_rate:
+            delay = self.tail_latency
+        if timeout is not None and delay > timeout:
+            return timeout, TimeoutError(f"Stub: chamada passou do timeout de {timeout:.1f}s.")
+        return delay, None
+
+    def _sleep(self, variant, timeout):
+        delay, error = self._delay(variant, timeout)
+        time.sleep(delay)
+        if error:
+            raise error
+
+    async def _sleep_async(self, variant, timeout):
+        delay, error = self._delay(variant, timeout)
+        await asyncio.sleep(delay)
+        if error:
+            raise error
+
+    def _chat_response(self, contents):
+        last_user = next((c for c in reversed(contents) if c['role'] == 'user'), {'parts': []})
+        texts = [p['text'] for p in last_user['parts']]
+        lead_data = {}
+        for text in texts:
+            match = self.STATE_RE.match(text)
+            if match:
+                try:
+                    lead_data = ast.literal_eval(match.group(1))
+                except (ValueError, SyntaxError):
+                    lead_data = {}
+        message = texts[-1] if texts and not self.STATE_RE.match(texts[-1]) else ''
+        next_field = next((f for f in LEAD_FIELDS if not lead_data.get(f)), None)
+        extracted = {next_field: message.strip()} if next_field and message.strip() else {}
+        after = next((f for f in LEAD_FIELDS if not lead_data.get(f) and f not in extracted), None)
+        reply = f"Anotado! Agora me diga: {after}?" if after else "Perfeito! Já tenho todos os seus dados."
+        prompt_tokens = sum(len(p['text']) for c in contents for p in c['parts']) // 4
+        return StubResponse(json.dumps({"botResponse": reply, "extractedData": extracted}, ensure_ascii=False), prompt_tokens)
+
+    def _text_response(self, prompt):
+        match = self.RAMO_RE.search(prompt)
+        ramo = match.group(1) if match else "seu ramo"
+        text = (f"**Brindes de Alto Impacto (Premium):**\n1. Kit executivo: marca forte para {ramo}.\n"
+                f"2. Garrafa térmica: uso diário.\n\n**Brindes do Dia-a-Dia (Custo-Benefício):**\n"
+                f"3. Caneca: presença na mesa.\n4. Caderno: útil no escritório.\n\n"
+                f"**Brindes de Grande Volume (Econômico):**\n5. Caneta: distribuição em massa.")
+        return StubResponse(text, len(prompt) // 4)
+
+    def generate_chat(self, contents, stream=False, variant='primary', timeout=None):
+        response = self._chat_response(contents)
+        if stream:
+            return StubStream(response, self.latency)
+        self._sleep(variant, timeout)
+        return response
+
+    async def generate_chat_async(self, contents, variant='primary', timeout=None):
+        await self._sleep_async(variant, timeout)
+        return self._chat_response(contents)
+
+    def generate_text(self, prompt, variant='primary', timeout=None):
+        self._sleep(variant, timeout)
+        return self._text_response(prompt)
+
+    async def generate_text_async(self, prompt, variant='primary', timeout=None):
+        await self._sleep_async(variant, timeout)
+        return self._text_response(prompt)
+
+
+def build_llm_backend(name):
+    if name == 'stub':
+        log.warning(f"[LLM] Usando o backend STUB (latência {LLM_STUB_LATENCY}s) - nenhuma chamada real ao Gemini.")
+        return StubBackend(LLM_STUB_LATENCY, LLM_STUB_TAIL_RATE, LLM_STUB_TAIL_LATENCY)
+    return GeminiBackend()
+
+
+llm_backend = build_llm_backend(LLM_BACKEND)
+
+
+def _is_provider_rate_limit(error):
+    return isinstance(error, (google_exceptions.ResourceExhausted, google_exceptions.TooManyRequests))
+
+
+class AdmissionLimiter:
+    """
+    Controle de admissão das chamadas ao LLM (por processo).
+
+    - até `max_concurrent` chamadas em voo; as seguintes esperam numa fila de
+      no máximo `max_waiting` por até `wait_timeout` segundos (senão 503);
+    - se `rate_per_sec` > 0, um token bucket limita a taxa (estourou: 429);
+    - um 429 do provedor abre um cooldown: durante `cooldown` segundos tudo é
+      recusado na hora com 429, em vez de cada requisição falhar devagar.
+    """
+
+    def __init__(self, max_concurrent, max_waiting, wait_timeout, rate_per_sec, burst, cooldown):
+        self.max_concurrent = max_concurrent
+        self.max_waiting = max_waiting
+        self.wait_timeout = wait_timeout
+        self.rate_per_sec = rate_per_sec
+        self.burst = burst
+        self.cooldown = cooldown
+        self._lock = threading.Lock()
+        self._cond = threading.Condition(self._lock)
+        self._in_flight = 0
+        self._waiting = 0
+        self._tokens = float(burst)
+        self._tokens_at = time.monotonic()
+        self._blocked_until = 0.0
+        self._stats = {"admitted": 0, "admitted_extra": 0, "rejected_queue_full": 0, "rejected_timeout": 0,
+                       "rejected_rate": 0, "rejected_cooldown": 0, "provider_rate_limited": 0}
+
+    def _reject(self, stat, message, status, retry_after):
+        self._stats[stat] += 1
+        LLM_REJECTIONS.labels(stat.replace("rejected_", "")).inc()
+        raise LLMOverloadedError(message, status, retry_after)
+
+    def _check_gates(self):
+        """Cooldown e token bucket. Chamar com self._lock."""
+        now = time.monotonic()
+        if now < self._blocked_until:
+            self._reject("rejected_cooldown", "Limite do provedor de IA atingido. Tente novamente em instantes.",
+                         429, self._blocked_until - now)
+        if not self._take_token(now):
+            self._reject("rejected_rate", "Muitas requisições à IA. Tente novamente em instantes.",
+                         429, (1 - self._tokens) / self.rate_per_sec)
+
+    def _take_token(self, now):
+        """Token bucket (sempre True sem limite de taxa). Chamar com self._lock."""
+        if self.rate_per_sec <= 0:
+            return True
+        self._tokens = min(self.burst, self._tokens + (now - self._tokens_at) * self.rate_per_sec)
+        self._tokens_at = now
+        if self._tokens < 1:
+            return False
+        self._tokens -= 1
+        return True
+
+    def acquire(self):
+        started = time.perf_counter()
+        with self._cond:
+            self._check_gates()
+            if self._in_flight >= self.max_concurrent:
+                if self._waiting >= self.max_waiting:
+                    self._reject("rejected_queue_full", "Serviço de IA sobrecarregado. Tente novamente em instantes.",
+                                 503, self.wait_timeout)
+                self._waiting += 1
+                LLM_WAITING.inc()
+                try:
+                    admitted = self._cond.wait_for(lambda: self._in_flight < self.max_concurrent, timeout=self.wait_timeout)
+                finally:
+                    self._waiting -= 1
+                    LLM_WAITING.dec()
+                if not admitted:
+                    self._reject("rejected_timeout", "Serviço de IA sobrecarregado. Tente novamente em instantes.",
+                                 503, self.wait_timeout)
+            self._in_flight += 1
+            self._stats["admitted"] += 1
+        LLM_IN_FLIGHT.inc()
+        STAGE_SECONDS.labels("llm_wait").observe(time.perf_counter() - started)
+
+    def try_acquire(self):
+        """
+        Vaga SEM esperar, para as tentativas extras (hedge/fallback): só se há
+        vaga livre, ninguém na fila, token e nenhum cooldown. False = sem vaga.
+        """
+        with self._cond:
+            now = time.monotonic()
+            if (now < self._blocked_until or self._waiting or self._in_flight >= self.max_concurrent
+                    or not self._take_token(now)):
+                return False
+            self._in_flight += 1
+            self._stats["admitted_extra"] += 1
+        LLM_IN_FLIGHT.inc()
+        return True
+
+    def release(self):
+        with self._cond:
+            self._in_flight -= 1
+            self._cond.notify()
+        LLM_IN_FLIGHT.dec()
+
+    def record_error(self, error):
+        """Se o erro for um 429 do provedor, abre o cooldown e devolve o LLMOverloadedError correspondente."""
+        if not _is_provider_rate_limit(error):
+            return None
+        with self._lock:
+            self._stats["provider_rate_limited"] += 1
+            self._blocked_until = max(self._blocked_until, time.monotonic() + self.cooldown)
+        log.warning(f"[LLM] Provedor recusou por limite de taxa; recusando chamadas por {self.cooldown}s.")
+        return LLMOverloadedError("Limite do provedor de IA atingido. Tente novamente em instantes.", 429, self.cooldown)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats.update(in_flight=self._in_flight, waiting=self._waiting, max_concurrent=self.max_concurrent,
+                         max_waiting=self.max_waiting, backend=llm_backend.name)
+        return stats
+
+
+llm_limiter = AdmissionLimiter(LLM_MAX_CONCURRENT, LLM_MAX_WAITING, LLM_WAIT_TIMEOUT,
+                               LLM_RATE_PER_SEC, LLM_RATE_BURST, LLM_PROVIDER_COOLDOWN)
+
+
+@app.errorhandler(LLMOverloadedError)
+def handle_llm_overloaded(e):
+    record_error("llm_admission", e)
+    log.warning(f"[LLM] Requisição recusada ({e.status}): {e.message}")
+    response = jsonify({"error": e.message})
+    response.headers["Retry-After"] = str(e.retry_after)
+    return response, e.status
+
+# --- 2.3 [HELPER] Deadline, Hedge e Fallback das Chamadas ao LLM ---
+# Cada operação ('chat', 'isca') tem um deadline: passou dele, a requisição
+# recebe 504 em vez de prender o worker (a chamada no provedor também leva o
+# timeout, então não fica pendurada). Opcionalmente:
+# - hedge: se a 1ª tentativa não respondeu em `hedge_after` segundos (use o
+#   p95 de elo_llm_attempt_duration_seconds), manda uma 2ª igual e fica com a
+#   que responder primeiro. Limitado a LLM_HEDGE_BUDGET hedges por chamada,
+#   para não dobrar a carga justo quando o provedor está lento;
+# - fallback: em `fallback_after` segundos (fração LLM_FALLBACK_AFTER do
+#   deadline), ou logo se as tentativas falharem, tenta LLM_FALLBACK_MODEL.
+# Cada tentativa vira uma amostra em elo_llm_attempts_total/
+# elo_llm_attempt_duration_seconds (operação, tipo, resultado), que é o que
+# se usa para ajustar esses limites. Cada tentativa ocupa a SUA vaga no
+# llm_limiter: a 1ª espera na fila normal; hedge e fallback só saem se houver
+# vaga livre na hora (senão são puladas, 'skipped_saturated'), então sob
+# carga o hedge não multiplica as chamadas ao provedor. Uma tentativa
+# perdedora segura a vaga até terminar (na versão async ela é cancelada).
+# O /api/chat-stream passa pela mesma fila, deadline e métricas, sem hedge (o
+# texto já enviado não pode ser trocado); o fallback só entra se a 'primary'
+# falhar antes do primeiro pedaço.
+LLM_CHAT_DEADLINE = float(os.environ.get("LLM_CHAT_DEADLINE", 20))  # segundos
+LLM_CHAT_HEDGE_AFTER = float(os.environ.get("LLM_CHAT_HEDGE_AFTER", 0))  # 0 = sem hedge
+LLM_ISCA_DEADLINE = float(os.environ.get("LLM_ISCA_DEADLINE", 40))
+LLM_ISCA_HEDGE_AFTER = float(os.environ.get("LLM_ISCA_HEDGE_AFTER", 0))
+LLM_FALLBACK_MODEL = os.environ.get("LLM_FALLBACK_MODEL", "")  # ex.: 'gemini-2.5-flash-lite'; vazio = sem fallback
+LLM_FALLBACK_AFTER = float(os.environ.get("LLM_FALLBACK_AFTER", 0.6))  # fração do deadline
+LLM_HEDGE_BUDGET = float(os.environ.get("LLM_HEDGE_BUDGET", 0.1))  # hedges por chamada (máx.)
+
+LLM_ATTEMPTS = Counter("elo_llm_attempts_total", "Tentativas de chamada ao LLM por resultado.",
+                       ["operation", "kind", "outcome"])
+LLM_ATTEMPT_SECONDS = Histogram(
+    "elo_llm_attempt_duration_seconds", "Duração de cada tentativa de chamada ao LLM.",
+    ["operation", "kind", "outcome"], buckets=METRICS_LATENCY_BUCKETS)
+
+
+def _is_llm_timeout(error):
+    """Timeout da própria tentativa (no provedor ou no stub): conta como deadline, não como erro."""
+    return isinstance(error, (TimeoutError, google_exceptions.DeadlineExceeded))
+
+
+class LLMDeadlineError(LLMOverloadedError):
+    """Nenhuma tentativa respondeu dentro do deadline da operação (vira 504)."""
+
+    def __init__(self, operation, deadline):
+        super().__init__("O serviço de IA demorou demais para responder. Tente novamente.", 504, 1)
+        self.operation = operation
+        self.deadline = deadline
+
+
+class LLMCallPolicy:
+    def __init__(self, operation, deadline, hedge_after, fallback_after):
+        self.operation = operation
+        self.deadline = deadline
+        self.hedge_after = hedge_after
+        self.fallback_after = fallback_after
+
+    def schedule(self):
+        """Tentativas planejadas: [(segundos após o início, tipo)], em ordem."""
+        attempts = [(0.0, 'primary')]
+        if 0 < self.hedge_after < self.deadline:
+            attempts.append((self.hedge_after, 'hedge'))
+        if self.fallback_after is not None:
+            attempts.append((self.fallback_after, 'fallback'))
+        return sorted(attempts)
+
+
+def build_llm_policy(operation, deadline, hedge_after):
+    fallback_after = deadline * LLM_FALLBACK_AFTER if LLM_FALLBACK_MODEL else None
+    return LLMCallPolicy(operation, deadline, hedge_after, fallback_after)
+
+
+LLM_POLICIES = {
+    "chat": build_llm_policy("chat", LLM_CHAT_DEADLINE, LLM_CHAT_HEDGE_AFTER),
+    "isca": build_llm_policy("isca", LLM_ISCA_DEADLINE, LLM_ISCA_HEDGE_AFTER),
+}
+
+
+class TailLatencyRunner:
+    """
+    Executa uma chamada ao LLM segundo um LLMCallPolicy. `make_call(variant,
+    timeout)` faz UMA tentativa ('primary' ou 'fallback'), dentro de uma vaga
+    do `limiter`. Na versão síncrona as tentativas rodam num pool de threads
+    (a thread da requisição só espera); uma tentativa perdedora não é
+    interrompida, mas termina sozinha no timeout que recebeu e só então
+    devolve a vaga.
+    """
+
+    def __init__(self, limiter, max_workers, hedge_budget):
+        self.limiter = limiter
+        self.hedge_budget = hedge_budget
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="llm-attempt")
+        self._lock = threading.Lock()
+        self._hedge_tokens = 1.0
+        self._stats = {}
+
+    def _count(self, key):
+        with self._lock:
+            self._stats[key] = self._stats.get(key, 0) + 1
+
+    def record_attempt(self, policy, kind, outcome, elapsed):
+        LLM_ATTEMPTS.labels(policy.operation, kind, outcome).inc()
+        LLM_ATTEMPT_SECONDS.labels(policy.operation, kind, outcome).observe(elapsed)
+        self._count(f"{policy.operation}.{kind}.{outcome}")
+        if outcome == 'won' and kind != 'primary':
+            log.info(f"[LLM] Tentativa '{kind}' respondeu primeiro ({policy.operation}, {elapsed:.2f}s).")
+
+    def _start_call(self):
+        """Cada chamada rende `hedge_budget` de crédito; um hedge gasta 1 (acumula no máximo 2)."""
+        with self._lock:
+            self._hedge_tokens = min(2.0, self._hedge_tokens + self.hedge_budget)
+
+    def _take_hedge(self, policy):
+        with self._lock:
+            if self._hedge_tokens >= 1:
+                self._hedge_tokens -= 1
+                return True
+        self._count(f"{policy.operation}.hedge.skipped_budget")
+        return False
+
+    def _next_attempts(self, policy, pending, elapsed, idle):
+        """
+        Tira de `pending` as tentativas que já devem sair (ou a próxima, se
+        nada estiver rodando). A 'primary' já chega com a vaga reservada por
+        call(); as extras pegam a sua aqui, sem esperar.
+        """
+        due = []
+        while pending and (pending[0][0] <= elapsed or (idle and not due)):
+            _, kind = pending.pop(0)
+            if kind != 'primary':
+                if not self.limiter.try_acquire():
+                    self._count(f"{policy.operation}.{kind}.skipped_saturated")
+                    continue
+                if kind == 'hedge' and not self._take_hedge(policy):
+                    self.limiter.release()
+                    continue
+            due.append(kind)
+        return due
+
+    def _attempt_error(self, error):
+        """Erro de uma tentativa -> o que ela levanta (o 429 do provedor vira LLMOverloadedError)."""
+        record_error("llm", error)
+        overloaded = self.limiter.record_error(error)
+        return error if overloaded is None else overloaded
+
+    def _attempt(self, make_call, variant, timeout):
+        """Uma tentativa (na thread do pool); devolve a vaga ao terminar."""
+        started = time.perf_counter()
+        try:
+            return make_call(variant, timeout)
+        except Exception as e:
+            raised = self._attempt_error(e)
+            if raised is e:
+                raise
+            raise raised from e
+        finally:
+            STAGE_SECONDS.labels("llm_call").observe(time.perf_counter() - started)
+            self.limiter.release()
+
+    def _wake_in(self, started, deadline_at, pending):
+        """Quanto esperar por uma tentativa terminar (até a próxima agendada ou o deadline)."""
+        wake_at = min(deadline_at, started + pending[0][0]) if pending else deadline_at
+        return max(0.0, wake_at - time.monotonic())
+
+    def _settle(self, policy, kind, attempt_started, attempt):
+        """
+        Contabiliza uma tentativa que terminou (`attempt` é o Future/Task).
+        Devolve (True, resultado) se ela venceu ou (False, erro) se não (o
+        erro é None num timeout). LLMOverloadedError sobe na hora.
+        """
+        elapsed = time.monotonic() - attempt_started
+        try:
+            result = attempt.result()
+        except Exception as e_attempt:
+            if _is_llm_timeout(e_attempt):
+                self.record_attempt(policy, kind, 'timeout', elapsed)
+                return False, None
+            self.record_attempt(policy, kind, 'error', elapsed)
+            log.warning(f"[LLM] Tentativa '{kind}' falhou ({policy.operation}): {e_attempt}")
+            if isinstance(e_attempt, LLMOverloadedError):
+                raise
+            return False, e_attempt
+        self.record_attempt(policy, kind, 'won', elapsed)
+        return True, result
+
+    def _finish(self, policy, running, outcome):
+        now = time.monotonic()
+        for kind, started in running.values():
+            self.record_attempt(policy, kind, outcome, now - started)
+
+    def _give_up(self, policy, running, last_error):
+        """Erro final quando nenhuma tentativa venceu: o da última que falhou ou o LLMDeadlineError (504)."""
+        if running or last_error is None:
+            self._finish(policy, running, 'timeout')
+            self._count(f"{policy.operation}.deadline_exceeded")
+            log.warning(f"[LLM] Deadline de {policy.deadline}s estourado ({policy.operation}).")
+            return LLMDeadlineError(policy.operation, policy.deadline)
+        return last_error
+
+    def call(self, policy, make_call):
+        self.limiter.acquire()  # (vaga da 1ª tentativa: espera na fila; recusa vira 429/503)
+        self._start_call()
+        started = time.monotonic()
+        deadline_at = started + policy.deadline
+        pending = policy.schedule()
+        running = {}  # future -> (tipo, início)
+        last_error = None
+        try:
+            while True:
+                now = time.monotonic()
+                for kind in self._next_attempts(policy, pending, now - started, idle=not running):
+                    variant = 'fallback' if kind == 'fallback' else 'primary'
+                    try:
+                        future = self._executor.submit(contextvars.copy_context().run, self._attempt,
+                                                       make_call, variant, deadline_at - now)
+                    except BaseException:
+                        self.limiter.release()
+                        raise
+                    running[future] = (kind, now)
+                if not running:
+                    break
+                done, _ = concurrent.futures.wait(running, timeout=self._wake_in(started, deadline_at, pending),
+                                                  return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    won, result = self._settle(policy, *running.pop(future), future)
+                    if won:
+                        self._finish(policy, running, 'lost')
+                        return result
+                    last_error = result or last_error
+                if time.monotonic() >= deadline_at:
+                    break
+        finally:
+            for future in running:
+                if future.cancel():
+                    self.limiter.release()  # (nunca começou: a vaga não seria devolvida por _attempt)
+        raise self._give_up(policy, running, last_error)
+
+    def stream(self, policy, make_call):
+        """
+        call() para respostas em stream (/api/chat-stream): mesma fila,
+        deadline e métricas, mas sem hedge (o texto já enviado ao cliente não
+        pode ser trocado pelo de outra tentativa). A vaga da 'primary' é
+        reservada AQUI, antes do stream abrir, para a recusa ainda virar
+        429/503; `make_call(variant, timeout)` devolve o iterável de pedaços.
+        """
+        self.limiter.acquire()
+        return LLMStream(self, policy, make_call)
+
+    def stats(self):
+        with self._lock:
+            return dict(sorted(self._stats.items()), hedge_tokens=round(self._hedge_tokens, 2))
+
+
+class LLMStream:
+    """
+    Pedaços de uma chamada em stream aberta por TailLatencyRunner.stream().
+    Segura a vaga do limiter até o stream acabar; close() devolve a vaga mesmo
+    que a iteração nem tenha começado (cliente caiu antes do 1º evento). Se a
+    'primary' falhar antes do 1º pedaço, o fallback (quando configurado e com
+    vaga livre) assume; depois do 1º pedaço, o erro vai para quem consome.
+    """
+
+    def __init__(self, runner, policy, make_call):
+        self.runner = runner
+        self.policy = policy
+        self.make_call = make_call
+        self.response = None  # (stream da tentativa em curso: o usage_metadata é lido dele no fim)
+        self._held = True
+
+    def close(self):
+        if self._held:
+            self._held = False
+            self.runner.limiter.release()
+
+    def _attempts(self):
+        yield 'primary'
+        if self.policy.fallback_after is None:
+            return
+        if not self.runner.limiter.try_acquire():
+            self.runner._count(f"{self.policy.operation}.fallback.skipped_saturated")
+            return
+        self._held = True
+        yield 'fallback'
+
+    def __iter__(self):
+        policy = self.policy
+        deadline_at = time.monotonic() + policy.deadline
+        last_error = None
+        try:
+            for kind in self._attempts():
+                started = time.monotonic()
+                sent = False
+                try:
+                    self.response = self.make_call(kind, max(0.0, deadline_at - started))
+                    for chunk in self.response:
+                        if time.monotonic() > deadline_at:
+                            raise TimeoutError("stream passou do deadline")
+                        sent = True
+                        yield chunk
+                except Exception as e_attempt:
+                    elapsed = time.monotonic() - started
+                    STAGE_SECONDS.labels("llm_call").observe(elapsed)
+                    self.close()
+                    if _is_llm_timeout(e_attempt):
+                        self.runner.record_attempt(policy, kind, 'timeout', elapsed)
+                        self.runner._count(f"{policy.operation}.deadline_exceeded")
+                        log.warning(f"[LLM] Deadline de {policy.deadline}s estourado ({policy.operation}, stream).")
+                        raise LLMDeadlineError(policy.operation, policy.deadline) from e_attempt
+                    self.runner.record_attempt(policy, kind, 'error', elapsed)
+                    raised = self.runner._attempt_error(e_attempt)
+                    if raised is not e_attempt:
+                        raise raised from e_attempt
+                    if sent:
+                        raise
+                    log.warning(f"[LLM] Tentativa '{kind}' falhou antes do 1º pedaço ({policy.operation}): {e_attempt}")
+                    last_error = e_attempt
+                    continue
+                elapsed = time.monotonic() - started
+                STAGE_SECONDS.labels("llm_call").observe(elapsed)
+                self.close()
+                self.runner.record_attempt(policy, kind, 'won', elapsed)
+                return
+            raise last_error
+        finally:
+            self.close()
+
+
+llm_tail = TailLatencyRunner(llm_limiter, LLM_MAX_CONCURRENT, LLM_HEDGE_BUDGET)  # (1 thread por vaga)
+
+# --- 4.1 [HELPER] Histórico de Conversa no Servidor ---
+# No modo "sessão" o front manda só a última mensagem (+ leadId) e o
+# histórico é remontado a partir de 'elo_chat_messages'. As conversas
+# recentes ficam num cache LRU em memória; como cada worker do gunicorn tem
+# o seu, o cache guarda o último id visto e só busca as mensagens novas.
+CHAT_CACHE_MAX_SESSIONS = int(os.environ.get("CHAT_CACHE_MAX_SESSIONS", 2000))
+CHAT_CACHE_TTL = float(os.environ.get("CHAT_CACHE_TTL", 1800))  # segundos
+
+
+class ConversationCache:
+    """Cache LRU com TTL: lead_id -> (mensagens, último id do banco)."""
+
+    def __init__(self, max_sessions, ttl):
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, lead_id):
+        with self._lock:
+            entry = self._data.get(lead_id)
+            if entry is None or time.monotonic() - entry[2] > self.ttl:
+                self._data.pop(lead_id, None)
+                self.misses += 1
+                CACHE_REQUESTS.labels("conversas", "misses").inc()
+                return [], 0
+            self._data.move_to_end(lead_id)
+            self.hits += 1
+            CACHE_REQUESTS.labels("conversas", "hits").inc()
+            return list(entry[0]), entry[1]
+
+    def invalidate(self, lead_id):
+        with self._lock:
+            self._data.pop(lead_id, None)
+
+    def put(self, lead_id, messages, last_id):
+        with self._lock:
+            self._data[lead_id] = (messages, last_id, time.monotonic())
+            self._data.move_to_end(lead_id)
+            while len(self._data) > self.max_sessions:
+                self._data.popitem(last=False)
+
+
+conversation_cache = ConversationCache(CHAT_CACHE_MAX_SESSIONS, CHAT_CACHE_TTL)
+
+
+# (SQL com placeholders %s: serve tanto para o psycopg2 quanto para o psycopg 3 do modo ASGI)
+CHAT_HISTORY_SELECT_SQL = "SELECT id, role, texto FROM elo_chat_messages WHERE lead_id = %s AND id > %s ORDER BY id"
+
+
+def chat_messages_insert(lead_id, new_messages):
+    """Monta (sql, params) de um INSERT multi-linha das mensagens novas."""
+    sql = ("INSERT INTO elo_chat_messages (lead_id, role, texto) VALUES "
+           + ", ".join(["(%s, %s, %s)"] * len(new_messages)) + " RETURNING id")
+    params = [v for m in new_messages for v in (lead_id, m['role'], m['text'])]
+    return sql, params
+
+
+def conversation_steps(lead_id):
+    """Passos de banco (ver run_db_steps) que devolvem o histórico do lead: cache + só as mensagens novas."""
+    messages, last_id = conversation_cache.get(lead_id)
+    rows = yield CHAT_HISTORY_SELECT_SQL, (lead_id, last_id)
+    for msg_id, role, texto in rows:
+        messages.append({'role': role, 'text': texto})
+        last_id = msg_id
+    conversation_cache.put(lead_id, messages, last_id)
+    return messages
+
+
+def append_conversation_steps(lead_id, history, new_messages):
+    """Passos que gravam só as mensagens novas da rodada (append-only) e atualizam o cache."""
+    rows = yield chat_messages_insert(lead_id, new_messages)
+    conversation_cache.put(lead_id, history + new_messages, max(r[0] for r in rows))
+
+
+def load_conversation(cur, lead_id):
+    """Devolve o histórico do lead ([{'role', 'text'}, ...]) usando o cache + as mensagens novas do banco."""
+    return run_db_steps(cur, conversation_steps(lead_id))
+
+
+def append_conversation(cur, lead_id, history, new_messages):
+    run_db_steps(cur, append_conversation_steps(lead_id, history, new_messages))
+
+# --- 4.2 [HELPER] Rodada de Chat (usado por /api/chat e /api/chat-stream) ---
+CHAT_MODEL_NAME = 'gemini-2.5-flash-preview-09-2025'
+LEAD_FIELDS = ['nome', 'empresa_ramo', 'cargo', 'email', 'ja_e_cliente', 'whatsapp']
+SAFETY_SETTINGS = {'HATE': 'BLOCK_NONE', 'HARASSMENT': 'BLOCK_NONE', 'SEXUAL' : 'BLOCK_NONE', 'DANGEROUS' : 'BLOCK_NONE'}
+
+
+class ChatTurnError(Exception):
+    """Erro de validação/carregamento antes de chamar a IA (vira resposta HTTP)."""
+
+    def __init__(self, message, status):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+
+
+# 1. Define o "cérebro" da IA (System Prompt ATUALIZADO)
+# O prompt de sistema é CONSTANTE: os dados do lead (e o resumo da conversa)
+# vão numa mensagem de estado junto com a última mensagem do usuário. Assim
+# o modelo é criado uma vez só por worker e o prefixo (sistema + início do
+# histórico) fica igual entre rodadas, o que permite cache de contexto no
+# provedor.
+CHAT_SYSTEM_PROMPT = """
+    Você é o [SUA_GRÁFICA BOT], um assistente virtual amigável e proativo da [SUA_GRÁFICA BOT].
+    Seu objetivo principal é coletar os seguintes 6 dados do cliente: "nome", "empresa_ramo", "cargo", "email", "ja_e_cliente", "whatsapp".
+    
+    A última mensagem do usuário vem acompanhada de um bloco [ESTADO ATUAL] com os dados que já temos
+    (e, em conversas longas, um resumo do início da conversa). Esse bloco é gerado pelo sistema, não pelo usuário.
+    
+    REGRAS DA CONVERSA:
+    1.  Converse naturalmente. Peça o próximo dado FALTANDO da lista (nome -> empresa_ramo -> cargo -> email -> ja_e_cliente -> whatsapp).
+    2.  NÃO peça por dados que já estão preenchidos no [ESTADO ATUAL].
+    3.  Após coletar o "email", a próxima pergunta DEVE ser "Você já é cliente da [SUA_GRÁFICA BOT]? (Sim ou Não)".
+    4.  Após coletar o "ja_e_cliente", a próxima pergunta DEVE ser "Ótimo! E qual o seu WhatsApp com DDD? (para agilizar o contato)".
+    5.  Se o usuário fornecer vários dados de uma vez, capture todos.
+    
+    FORMATO DA RESPOSTA (JSON obrigatório):
+    {
+        "botResponse": "O texto da sua resposta para o usuário.",
+        "extractedData": {
+            "nome": "[O nome extraído ESTA RODADA]",
+            "empresa_ramo": "[O ramo extraído ESTA RODADA]",
+            "cargo": "[O cargo extraído ESTA RODADA]",
+            "email": "[O email extraído ESTA RODADA]",
+            "ja_e_cliente": "[O 'Sim' ou 'Não' extraído ESTA RODADA]",
+            "whatsapp": "[O whatsapp extraído ESTA RODADA]"
+        }
+    }
+    """
+
+
+def build_chat_state_message(lead_data, summary=''):
+    state = f"[ESTADO ATUAL] Estes são os dados que já temos: {lead_data}"
+    if summary:
+        state += f"\nResumo do início da conversa (as mensagens mais recentes vêm no histórico):\n{summary}"
+    return state
+
+
+def build_chat_contents(window, lead_data, summary=''):
+    """Converte a janela do histórico para o formato do Gemini e anexa o estado à última mensagem do usuário."""
+    contents = []
+    for message in window:
+        role = 'user' if message['role'] == 'user' else 'model'
+        contents.append({'role': role, 'parts': [{'text': message['text']}]})
+
+    state_part = {'text': build_chat_state_message(lead_data, summary)}
+    if contents and contents[-1]['role'] == 'user':
+        contents[-1]['parts'].insert(0, state_part)
+    else:
+        contents.append({'role': 'user', 'parts': [state_part]})
+    return contents
+
+
+def parse_chat_turn(data):
+    """
+    Lê o payload do /api/chat e monta o estado da rodada (sem tocar no banco).
+
+    Dois formatos de payload:
+    - Legado: 'conversationHistory' com a conversa inteira (index*.html).
+    - Sessão: só 'message' (a nova mensagem do usuário) + 'leadId'; o
+      histórico é remontado no servidor a partir de 'elo_chat_messages'.
+    """
+    turn = {
+        'lead_data': data.get('leadData', {}),
+        'lead_id': data.get('leadId'),
+        'session_mode': 'conversationHistory' not in data and 'message' in data,
+        'stored_history': [],
+        'user_message': None,
+    }
+
+    if turn['session_mode']:
+        turn['user_message'] = {'role': 'user', 'text': data.get('message') or ''}
+        if not turn['user_message']['text'].strip():
+            raise ChatTurnError("message é obrigatório.", 400)
+        turn['history'] = [turn['user_message']]
+    else:
+        turn['history'] = data.get('conversationHistory', [])
+
+    return turn
+
+
+def set_stored_history(turn, stored_history):
+    turn['stored_history'] = stored_history
+    turn['history'] = stored_history + [turn['user_message']]
+
+
+def needs_stored_history(turn):
+    return turn['session_mode'] and turn['lead_id']
+
+
+def stored_history_failed(turn, error):
+    """Registra a falha ao carregar o histórico salvo e devolve o ChatTurnError (500) a levantar."""
+    record_error("chat_history", error)
+    log.exception(f"[DB-Chat] Erro ao carregar o histórico do Lead ID {turn['lead_id']}: {error}")
+    return ChatTurnError("Erro ao carregar o histórico da conversa.", 500)
+
+
+def prepare_chat_turn(data):
+    """parse_chat_turn + carrega o histórico salvo no modo sessão."""
+    turn = parse_chat_turn(data)
+    if needs_stored_history(turn):
+        try:
+            with db_cursor() as cur:
+                set_stored_history(turn, load_conversation(cur, turn['lead_id']))
+        except PoolTimeoutError:
+            raise
+        except Exception as e_hist:
+            raise stored_history_failed(turn, e_hist)
+    return turn
+
+
+# Janela do histórico: só as últimas CHAT_HISTORY_KEEP_MESSAGES mensagens vão
+# literais para o Gemini; as mais antigas viram um resumo curto, guardado por
+# lead e atualizado só com as mensagens que acabaram de sair da janela. O
+# estado que importa (os 6 campos) já vai no prompt via lead_data.
+CHAT_HISTORY_TOKEN_BUDGET = int(os.environ.get("CHAT_HISTORY_TOKEN_BUDGET", 1500))
+CHAT_HISTORY_KEEP_MESSAGES = int(os.environ.get("CHAT_HISTORY_KEEP_MESSAGES", 8))
+CHAT_SUMMARY_MAX_TOKENS = int(os.environ.get("CHAT_SUMMARY_MAX_TOKENS", 300))
+CHAT_SUMMARY_LINE_CHARS = 160
+CHAT_SUMMARY_CACHE_MAX = int(os.environ.get("CHAT_SUMMARY_CACHE_MAX", 2000))
+CHAT_TOKEN_LOG_SIZE = 200
+
+
+def estimate_tokens(text):
+    """Estimativa barata (~4 caracteres por token), sem chamar count_tokens na rede."""
+    return max(1, len(text or '') // 4)
+
+
+class RollingSummaryCache:
+    """LRU lead_id -> (quantas mensagens já foram resumidas, linhas do resumo)."""
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, lead_id):
+        with self._lock:
+            entry = self._data.get(lead_id)
+            if entry is None:
+                return 0, []
+            self._data.move_to_end(lead_id)
+            return entry[0], list(entry[1])
+
+    def put(self, lead_id, summarized, lines):
+        with self._lock:
+            self._data[lead_id] = (summarized, lines)
+            self._data.move_to_end(lead_id)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+
+summary_cache = RollingSummaryCache(CHAT_SUMMARY_CACHE_MAX)
+chat_token_stats = {"turns": 0, "estimated_full_tokens": 0, "estimated_sent_tokens": 0, "prompt_tokens": 0}
+chat_token_log = deque(maxlen=CHAT_TOKEN_LOG_SIZE)
+_chat_token_lock = threading.Lock()
+
+
+def _summary_line(message):
+    who = 'Usuário' if message.get('role') == 'user' else 'Bot'
+    text = ' '.join((message.get('text') or '').split())
+    if len(text) > CHAT_SUMMARY_LINE_CHARS:
+        text = text[:CHAT_SUMMARY_LINE_CHARS - 3] + '...'
+    return f"{who}: {text}"
+
+
+def window_history(turn):
+    """
+    Devolve (mensagens que vão literais, resumo das anteriores) respeitando
+    CHAT_HISTORY_TOKEN_BUDGET. O resumo só cresce: se o corte anda para trás
+    (orçamento folgou), a janela começa depois do que já foi resumido.
+    """
+    history = turn['history']
+    lead_id = turn['lead_id']
+    summarized, lines = summary_cache.get(lead_id) if lead_id else (0, [])
+    if summarized > len(history):
+        summarized, lines = 0, []
+
+    tokens = [estimate_tokens(m.get('text')) for m in history]
+    cutoff = max(summarized, len(history) - CHAT_HISTORY_KEEP_MESSAGES)
+    summary_budget = min(CHAT_SUMMARY_MAX_TOKENS, CHAT_HISTORY_TOKEN_BUDGET // 4)
+    while len(history) - cutoff > 2 and sum(tokens[cutoff:]) + summary_budget > CHAT_HISTORY_TOKEN_BUDGET:
+        cutoff += 1
+
+    if cutoff > summarized:
+        lines.extend(_summary_line(m) for m in history[summarized:cutoff])
+        summarized = cutoff
+        while len(lines) > 1 and estimate_tokens('\n'.join(lines)) > CHAT_SUMMARY_MAX_TOKENS:
+            lines.pop(0)
+        if lead_id:
+            summary_cache.put(lead_id, summarized, lines)
+
+    window = history[summarized:]
+    summary = '\n'.join(lines)
+    turn['token_window'] = {
+        "history_messages": len(history),
+        "sent_messages": len(window),
+        "estimated_full_tokens": sum(tokens),
+        "estimated_sent_tokens": sum(tokens[summarized:]) + (estimate_tokens(summary) if lines else 0),
+    }
+    return window, summary
+
+
+def record_prompt_tokens(turn, response):
+    """Guarda os tokens de entrada da rodada (estimados e os reais do usage_metadata)."""
+    record_llm_usage("chat", response)
+    window = turn.get('token_window')
+    if not window:
+        return
+    usage = getattr(response, 'usage_metadata', None)
+    prompt_tokens = getattr(usage, 'prompt_token_count', 0) or 0
+    entry = dict(window, prompt_tokens=prompt_tokens)  # (sem lead_id: vai para o /api/cache-stats)
+    with _chat_token_lock:
+        chat_token_stats["turns"] += 1
+        chat_token_stats["estimated_full_tokens"] += window["estimated_full_tokens"]
+        chat_token_stats["estimated_sent_tokens"] += window["estimated_sent_tokens"]
+        chat_token_stats["prompt_tokens"] += prompt_tokens
+        chat_token_log.append(entry)
+    log.info("[Tokens] Janela do histórico enviada", extra=entry)
+
+
+CHAT_CONTEXT_CACHE = os.environ.get("CHAT_CONTEXT_CACHE", "0") == "1"  # cache explícito do prompt de sistema no Gemini
+CHAT_CONTEXT_CACHE_TTL = int(os.environ.get("CHAT_CONTEXT_CACHE_TTL", 3600))  # segundos
+CHAT_GENERATION_CONFIG = {"temperature": 0.7, "response_mime_type": "application/json"}
+
+_chat_model = None
+_chat_model_expires = None
+_chat_model_lock = threading.Lock()
+
+
+def _create_cached_chat_model():
+    """Cria o CachedContent com o prompt de sistema e um modelo apontando para ele."""
+    cached = genai.caching.CachedContent.create(
+        model=f"models/{CHAT_MODEL_NAME}",
+        display_name="elo-chat-system-prompt",
+        system_instruction=CHAT_SYSTEM_PROMPT,
+        ttl=datetime.timedelta(seconds=CHAT_CONTEXT_CACHE_TTL),
+    )
+    return genai.GenerativeModel.from_cached_content(
+        cached_content=cached,
+        generation_config=CHAT_GENERATION_CONFIG,
+        safety_settings=SAFETY_SETTINGS,
+    )
+
+
+_fallback_models = {}
+
+
+def get_fallback_chat_model():
+    """Modelo de fallback do chat (LLM_FALLBACK_MODEL), mesmo prompt de sistema, sem cache de contexto."""
+    if 'chat' not in _fallback_models:
+        _fallback_models['chat'] = genai.GenerativeModel(
+            LLM_FALLBACK_MODEL,
+            system_instruction=CHAT_SYSTEM_PROMPT,
+            generation_config=CHAT_GENERATION_CONFIG,
+            safety_settings=SAFETY_SETTINGS,
+        )
+    return _fallback_models['chat']
+
+
+def get_fallback_text_model():
+    if 'text' not in _fallback_models:
+        _fallback_models['text'] = genai.GenerativeModel(LLM_FALLBACK_MODEL)
+    return _fallback_models['text']
+
+
+def get_chat_model():
+    """
+    Modelo do chat, criado uma vez por worker (o prompt de sistema é fixo).
+    Com CHAT_CONTEXT_CACHE=1 usa cache de contexto explícito e o recria
+    um minuto antes do TTL; se o provedor recusar (ex.: prompt abaixo do
+    mínimo de tokens para cache), segue sem cache.
+    """
+    global _chat_model, _chat_model_expires, CHAT_CONTEXT_CACHE
+    now = time.monotonic()
+    if _chat_model is not None and (_chat_model_expires is None or now < _chat_model_expires):
+        return _chat_model
+    with _chat_model_lock:
+        if _chat_model is not None and (_chat_model_expires is None or now < _chat_model_expires):
+            return _chat_model
+        if CHAT_CONTEXT_CACHE:
+            try:
+                _chat_model = _create_cached_chat_model()
+                _chat_model_expires = now + max(CHAT_CONTEXT_CACHE_TTL - 60, 60)
+                log.info("[Gemini] Cache de contexto do chat criado.")
+                return _chat_model
+            except Exception as e_cache:
+                CHAT_CONTEXT_CACHE = False
+                log.warning(f"[Gemini] Cache de contexto indisponível, seguindo sem ele: {e_cache}")
+        _chat_model = genai.GenerativeModel(
+            CHAT_MODEL_NAME,
+            system_instruction=CHAT_SYSTEM_PROMPT,
+            generation_config=CHAT_GENERATION_CONFIG,
+            safety_settings=SAFETY_SETTINGS,
+        )
+        _chat_model_expires = None
+        return _chat_model
+
+
+def build_chat_request(turn):
+    """Conteúdo enviado ao Gemini: histórico (em janela) + estado da rodada."""
+    window, summary = window_history(turn)
+    log.info("[Gemini] Chamando IA", extra={"lead_id": turn['lead_id'], "lead_data": log_payload(turn['lead_data'])})
+    return build_chat_contents(window, turn['lead_data'], summary)
+
+
+def call_chat_model(turn, stream=False):
+    """Chama o LLM para a rodada (stream=True devolve um LLMStream, com a vaga já reservada)."""
+    contents = build_chat_request(turn)
+    policy = LLM_POLICIES["chat"]
+    if stream:
+        return llm_tail.stream(policy, lambda variant, timeout: llm_backend.generate_chat(
+            contents, stream=True, variant=variant, timeout=timeout))
+    return llm_tail.call(policy, lambda variant, timeout: llm_backend.generate_chat(contents, variant=variant, timeout=timeout))
+
+
+CHAT_UPDATE_LEAD_SQL = """
+UPDATE elo_leads SET 
+    nome = COALESCE(%s, nome),
+    email = COALESCE(%s, email),
+    empresa_ramo = COALESCE(%s, empresa_ramo),
+    cargo = COALESCE(%s, cargo),
+    ja_e_cliente = COALESCE(%s, ja_e_cliente),
+    whatsapp = COALESCE(%s, whatsapp), 
+    historico_chat = COALESCE(%s::jsonb, historico_chat),
+    chat_atualizado_em = NOW()
+WHERE id = %s
+RETURNING id;
+"""
+# Como não temos mais a trava de email, a lógica de INSERT é mais simples
+CHAT_INSERT_LEAD_SQL = """
+INSERT INTO elo_leads (nome, email, empresa_ramo, cargo, ja_e_cliente, whatsapp, historico_chat, status, chat_atualizado_em)
+VALUES (%s, %s, %s, %s, %s, %s, %s::jsonb, 'Coletando', NOW())
+RETURNING id;
+"""
+
+
+def merge_chat_turn(turn, gemini_response):
+    """Mescla os dados extraídos nesta rodada com os que o lead já tinha."""
+    bot_response_text = gemini_response.get('botResponse', 'Desculpe, não entendi. Pode repetir?')
+    extracted_data = gemini_response.get('extractedData', {})
+    
+    new_lead_data = turn['lead_data'].copy()
+    
+    for key, value in extracted_data.items():
+        if key in LEAD_FIELDS and value:
+            new_lead_data[key] = value
+            
+    bot_message = {'role': 'bot', 'text': bot_response_text, 'time': 'now'}
+    # No modo sessão a conversa vai para 'elo_chat_messages' e o JSONB fica intacto
+    current_history_json = None if turn['session_mode'] else json.dumps(turn['history'] + [bot_message])
+    return {
+        "bot_response_text": bot_response_text,
+        "bot_message": bot_message,
+        "new_lead_data": new_lead_data,
+        "history_json": current_history_json,
+    }
+
+
+def chat_lead_write(turn, merged):
+    """(sql, params) do UPDATE (lead já existe) ou INSERT (primeira rodada) do lead."""
+    new_lead_data = merged['new_lead_data']
+    params = [new_lead_data.get(field) for field in ('nome', 'email', 'empresa_ramo', 'cargo', 'ja_e_cliente', 'whatsapp')]
+    params.append(merged['history_json'])
+    if turn['lead_id']:
+        return CHAT_UPDATE_LEAD_SQL, params + [turn['lead_id']]
+    return CHAT_INSERT_LEAD_SQL, params
+
+
+def build_chat_response(merged, lead_id):
+    is_complete = all(merged['new_lead_data'].get(field) for field in LEAD_FIELDS)
+    if is_complete:
+        log.info("[IA] Coleta de dados (6/6) completa!")
+
+    return {
+        "botResponse": merged['bot_response_text'],
+        "leadData": merged['new_lead_data'],
+        "leadId": lead_id,
+        "isComplete": is_complete
+    }
+
+
+def chat_turn_steps(turn, merged, deferred):
+    """
+    Passos de banco da rodada (ver run_db_steps): grava o lead, marca o
+    contato já conhecido e, no modo sessão, as mensagens novas. Com o UPDATE
+    adiado pelo write-behind, só as mensagens. Devolve o id final do lead.
+    """
+    lead_id = turn['lead_id']
+    new_messages = [turn['user_message'], merged['bot_message']]
+    if deferred:
+        # (Só o UPDATE do lead fica para depois: as mensagens da sessão são a fonte do histórico)
+        yield from append_conversation_steps(lead_id, turn['stored_history'], new_messages)
+        return lead_id
+
+    if lead_id:
+        log.info(f"[DB-Chat] Executando UPDATE para Lead ID: {lead_id}")
+    else:
+        log.info("[DB-Chat] Executando INSERT (sem trava de email).")
+    rows = yield chat_lead_write(turn, merged)
+    final_lead_id = rows[0][0]
+    yield from link_known_contact_steps(final_lead_id, turn, merged)
+
+    if turn['session_mode']:
+        yield from append_conversation_steps(final_lead_id, turn['stored_history'], new_messages)
+    log.info(f"[DB-Chat] Lead salvo/atualizado com ID: {final_lead_id}")
+    return final_lead_id
+
+
+def chat_turn_db_failed(turn, error):
+    """
+    A gravação da rodada falhou (inclusive PoolTimeoutError): a resposta da
+    IA já foi paga, então ela volta mesmo assim, com o lead_id que já havia.
+    """
+    record_error("chat_db", error)
+    log.exception(f"[DB-Chat] Erro ao salvar o lead: {error}")
+    if turn['session_mode'] and turn['lead_id']:
+        conversation_cache.invalidate(turn['lead_id'])
+    return turn['lead_id']
+
+
+def finish_chat_turn(turn, gemini_response):
+    """Mescla os dados extraídos, salva o lead (e a conversa) e monta a resposta da API."""
+    merged = merge_chat_turn(turn, gemini_response)
+    deferred = lead_write_behind.enqueue(turn, merged)
+    if deferred and not turn['session_mode']:
+        return build_chat_response(merged, turn['lead_id'])
+
+    try:
+        if turn['lead_id'] and not deferred:
+            lead_write_behind.discard(turn['lead_id'])
+        with db_cursor() as cur:
+            lead_id = run_db_steps(cur, chat_turn_steps(turn, merged, deferred))
+    except Exception as e_db:
+        lead_id = chat_turn_db_failed(turn, e_db)
+    return build_chat_response(merged, lead_id)
+
+
+# Extração local ("fast path"): quando a rodada é só um email, um WhatsApp
+# com DDD ou um "sim"/"não" respondendo exatamente o próximo campo da ordem
+# do prompt, preenchemos o campo e respondemos com o texto fixo das regras
+# 3/4 sem chamar o Gemini. Qualquer ambiguidade cai no modelo.
+_FAST_PREFIX = r'(?:(?:o\s+)?(?:meu|minha)\s+)?(?:e-?mail|whats\s*app|whats|zap|wpp|telefone|celular|n[uú]mero)?\s*(?:[ée]|:|-)?\s*'
+EMAIL_RE = re.compile(_FAST_PREFIX + r'(?P<valor>[A-Za-z0-9._%+-]+@[A-Za-z0-9-]+(?:\.[A-Za-z0-9-]+)*\.[A-Za-z]{2,})\s*[.!]?', re.IGNORECASE)
+PHONE_RE = re.compile(_FAST_PREFIX + r'(?P<valor>\+?[\d\s().-]{10,20})\s*[.!]?', re.IGNORECASE)
+CNPJ_RE = re.compile(r'\d{2}\.?\d{3}\.?\d{3}/?\d{4}-?\d{2}')
+# (Só respostas inequívocas: "s", "n", "sou", "isso", "claro"... vão para o modelo)
+YES_NO_RE = re.compile(
+    r'(?:(?P<sim>sim|j[aá]\s+sou(?:\s+sim)?|sou\s+sim)'
+    r'|(?P<nao>n[aã]o|ainda\s+n[aã]o|n[aã]o\s+sou(?:\s+ainda)?))\s*[.!]*',
+    re.IGNORECASE
+)
+FAST_PATH_REPLIES = {
+    'email': "Você já é cliente da [SUA_GRÁFICA BOT]? (Sim ou Não)",
+    'ja_e_cliente': "Ótimo! E qual o seu WhatsApp com DDD? (para agilizar o contato)",
+    'whatsapp': "Perfeito{nome}! Já anotei todos os seus dados. 😊",
+}
+fast_path_stats = {"llm_calls": 0, "llm_calls_skipped": 0}
+_fast_path_lock = threading.Lock()
+
+
+def is_valid_cnpj(value):
+    digits = re.sub(r'\D', '', value or '')
+    if len(digits) != 14 or digits == digits[0] * 14:
+        return False
+    for size in (12, 13):
+        weights = list(range(size - 7, 1, -1)) + list(range(9, 1, -1))
+        total = sum(int(d) * w for d, w in zip(digits[:size], weights))
+        check = 0 if total % 11 < 2 else 11 - total % 11
+        if int(digits[size]) != check:
+            return False
+    return True
+
+
+def parse_br_phone(text):
+    """'11 98765-4321', '+55 (11) 98765-4321'... -> '(11) 98765-4321'; None se não for celular/fixo com DDD."""
+    match = PHONE_RE.fullmatch(text)
+    if not match or any(is_valid_cnpj(c) for c in CNPJ_RE.findall(text)):
+        return None
+    digits = re.sub(r'\D', '', match.group('valor'))
+    if len(digits) in (12, 13) and digits.startswith('55'):
+        digits = digits[2:]
+    if len(digits) not in (10, 11) or digits[0] == '0' or digits[1] == '0':
+        return None
+    if len(digits) == 11 and digits[2] != '9':
+        return None
+    return f"({digits[:2]}) {digits[2:-4]}-{digits[-4:]}"
+
+
+def parse_email(text):
+    match = EMAIL_RE.fullmatch(text)
+    return match.group('valor').lower() if match else None
+
+
+def parse_yes_no(text):
+    match = YES_NO_RE.fullmatch(text)
+    if not match:
+        return None
+    return 'Sim' if match.group('sim') else 'Não'
+
+
+FAST_PATH_PARSERS = {'email': parse_email, 'ja_e_cliente': parse_yes_no, 'whatsapp': parse_br_phone}
+
+
+def try_fast_path(turn):
+    """Devolve uma resposta no formato do Gemini se a rodada for inequívoca, senão None."""
+    lead_data = turn['lead_data']
+    next_field = next((f for f in LEAD_FIELDS if not lead_data.get(f)), None)
+    parser = FAST_PATH_PARSERS.get(next_field)
+    last_message = turn['history'][-1] if turn['history'] else None
+    if parser is None or not last_message or last_message.get('role') != 'user':
+        return None
+
+    value = parser(last_message.get('text', '').strip())
+    if value is None:
+        return None
+
+    with _fast_path_lock:
+        fast_path_stats["llm_calls_skipped"] += 1
+    CACHE_REQUESTS.labels("chat_fast_path", "llm_calls_skipped").inc()
+    nome = lead_data.get('nome')
+    log.info(f"[FastPath] '{next_field}' extraído localmente; chamada ao Gemini evitada.")
+    return {
+        "botResponse": FAST_PATH_REPLIES[next_field].format(nome=f", {nome}" if nome else ""),
+        "extractedData": {next_field: value},
+    }
+
+
+def count_llm_call():
+    with _fast_path_lock:
+        fast_path_stats["llm_calls"] += 1
+    CACHE_REQUESTS.labels("chat_fast_path", "llm_calls").inc()
+
+
+class BotResponseStreamParser:
+    """
+    Extrai o valor de "botResponse" de um JSON que ainda está chegando em pedaços.
+
+    feed() recebe o próximo pedaço e devolve só o texto novo já decodificado
+    (escapes JSON incluídos). Escapes cortados no meio ficam para o próximo
+    pedaço. O JSON completo fica em `buffer` para o json.loads final.
+    """
+    KEY_RE = re.compile(r'"botResponse"\s*:\s*"')
+    ESCAPES = {'"': '"', '\\': '\\', '/': '/', 'b': '\b', 'f': '\f', 'n': '\n', 'r': '\r', 't': '\t'}
+
+    def __init__(self):
+        self.buffer = ''
+        self.pos = None
+        self.done = False
+
+    def feed(self, chunk):
+        self.buffer += chunk
+        if self.done:
+            return ''
+        if self.pos is None:
+            match = self.KEY_RE.search(self.buffer)
+            if not match:
+                return ''
+            self.pos = match.end()
+
+        buf, i, out = self.buffer, self.pos, []
+        while i < len(buf):
+            c = buf[i]
+            if c == '"':
+                self.done = True
+                i += 1
+                break
+            if c != '\\':
+                out.append(c)
+                i += 1
+                continue
+            if i + 1 >= len(buf):
+                break
+            esc = buf[i + 1]
+            if esc != 'u':
+                out.append(self.ESCAPES.get(esc, esc))
+                i += 2
+                continue
+            if i + 6 > len(buf):
+                break
+            code = int(buf[i + 2:i + 6], 16)
+            if 0xD800 <= code < 0xDC00:
+                # Par substituto (emoji etc.): precisa do segundo \uXXXX
+                if i + 12 > len(buf):
+                    break
+                low = int(buf[i + 8:i + 12], 16)
+                out.append(chr(0x10000 + ((code - 0xD800) << 10) + (low - 0xDC00)))
+                i += 12
+            else:
+                out.append(chr(code))
+                i += 6
+        self.pos = i
+        return ''.join(out)
+
+
+def sse_event(event, payload):
+    return f"event: {event}\ndata: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+
+def sse_replay(stored):
+    """Resposta guardada de uma rodada (Idempotency-Key) reenviada como SSE: um 'token' com o texto todo e o 'done'."""
+    chat_response = json.loads(stored[1])
+    events = [sse_event('token', {"text": chat_response['botResponse']}), sse_event('done', chat_response)]
+    return Response(events, mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no', 'Idempotent-Replayed': 'true'})
+
+# --- 4.3 [HELPER] Cache da Isca por Ramo ---
+# O prompt da isca só depende do ramo, e a maioria dos leads vem de poucas
+# dezenas de ramos. Camada 1: LRU em memória com TTL (por worker). Camada 2:
+# tabela 'elo_isca_cache' (sobrevive a restart e é compartilhada entre os
+# workers). Misses simultâneos do mesmo ramo no mesmo processo esperam uma
+# única chamada ao modelo (single-flight).
+ISCA_CACHE_MAX = int(os.environ.get("ISCA_CACHE_MAX", 500))
+ISCA_CACHE_TTL = float(os.environ.get("ISCA_CACHE_TTL", 6 * 3600))  # segundos, camada em memória
+ISCA_CACHE_DB_TTL_DAYS = int(os.environ.get("ISCA_CACHE_DB_TTL_DAYS", 30))
+
+CREATE_ELO_ISCA_CACHE_TABLE_SQL = """
+CREATE TABLE IF NOT EXISTS elo_isca_cache (
+    ramo_key VARCHAR(255) PRIMARY KEY,
+    ramo_exemplo VARCHAR(255),
+    isca TEXT NOT NULL,
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
+);
+"""
+
+ISCA_CACHE_SELECT_SQL = "SELECT isca FROM elo_isca_cache WHERE ramo_key = %s AND created_at > NOW() - make_interval(days => %s::integer)"
+ISCA_CACHE_UPSERT_SQL = """
+INSERT INTO elo_isca_cache (ramo_key, ramo_exemplo, isca) VALUES (%s, %s, %s)
+ON CONFLICT (ramo_key) DO UPDATE SET
+    ramo_exemplo = EXCLUDED.ramo_exemplo, isca = EXCLUDED.isca, created_at = NOW()
+"""
+LEAD_SET_ISCA_SQL = """
+UPDATE elo_leads 
+SET 
+    isca = %s, 
+    status = %s,
+    email_enviado = %s
+WHERE id = %s
+"""
+
+
+def strip_accents_lower(text):
+    """'Agência de MKT' -> 'agencia de mkt'."""
+    text = unicodedata.normalize('NFKD', text or '')
+    return ''.join(c for c in text if not unicodedata.combining(c)).lower()
+
+
+def normalize_ramo(ramo):
+    """
+    ' Farmácia', 'farmacia' e 'FARMÁCIA' viram a mesma chave: 'farmacia'. Só
+    caixa, acentos e pontuação/espaços; plural fica como veio (cortar o 's'
+    estraga palavras como 'país' e 'mais').
+    """
+    words = re.findall(r'[a-z0-9]+', strip_accents_lower(ramo))
+    return ' '.join(words)[:255]
+
+
+class IscaCache:
+    """Cache em duas camadas (memória + Postgres) com single-flight e contadores."""
+
+    def __init__(self, max_entries, ttl, db_ttl_days):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.db_ttl_days = db_ttl_days
+        self._data = OrderedDict()
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self._stats = {"memory_hits": 0, "db_hits": 0, "misses": 0, "coalesced": 0, "model_calls": 0}
+
+    def count(self, name):
+        with self._lock:
+            self._stats[name] += 1
+        CACHE_REQUESTS.labels("isca", name).inc()
+
+    def memory_get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or time.monotonic() - entry[1] > self.ttl:
+                self._data.pop(key, None)
+                return None
+            self._data.move_to_end(key)
+            return entry[0]
+
+    def memory_put(self, key, isca):
+        with self._lock:
+            self._data[key] = (isca, time.monotonic())
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def cached(self, key):
+        """Isca da camada de memória (contando o acerto), ou None."""
+        isca = self.memory_get(key)
+        if isca is not None:
+            self.count("memory_hits")
+        return isca
+
+    def db_get_steps(self, key):
+        rows = yield ISCA_CACHE_SELECT_SQL, (key, self.db_ttl_days)
+        return rows[0][0] if rows else None
+
+    def db_put_steps(self, key, ramo, isca):
+        yield ISCA_CACHE_UPSERT_SQL, (key, ramo[:255], isca)
+
+    def found_in_db(self, isca):
+        """Conta o resultado da leitura do banco pelo líder do single-flight; False = gerar com o modelo."""
+        if isca is not None:
+            self.count("db_hits")
+            return True
+        self.count("misses")
+        self.count("model_calls")
+        return False
+
+    def db_failed(self, error):
+        """O banco é só uma camada de cache: a falha vira aviso e a isca segue sem ele."""
+        log.warning(f"[Cache-Isca] Falha ao acessar o cache no banco (seguindo sem ele): {error}")
+
+    def _db(self, steps):
+        try:
+            with db_cursor() as cur:
+                return run_db_steps(cur, steps)
+        except Exception as e_db:
+            self.db_failed(e_db)
+            return None
 
-app = Flask(__name__)
-CORS(app)
+    def get_or_generate(self, ramo, generate):
+        """Devolve a isca do ramo; só chama generate(ramo) se nenhuma camada tiver."""
+        key = normalize_ramo(ramo)
+        isca = self.cached(key)
+        if isca is not None:
+            return isca
 
-try:
-    DATABASE_URL = os.environ.get("DATABASE_URL")
-    GEMINI_API_KEY = os.environ.get("GEMINI_API_KEY")
-    SALES_WEBHOOK_URL = os.environ.get("SALES_WEBHOOK_URL") 
-    N8N_SECRET_KEY = os.environ.get("N8N_SECRET_KEY", "sua-chave-secreta-padrao") 
+        with self._lock:
+            flight = self._inflight.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._inflight[key] = {"event": threading.Event(), "value": None, "error": None}
 
-    if not DATABASE_URL or not GEMINI_API_KEY:
-        print("❌ ERRO CRÍTICO: DATABASE_URL ou GEMINI_API_KEY não encontradas.")
-    if not SALES_WEBHOOK_URL:
-        print("⚠️ AVISO: SALES_WEBHOOK_URL não configurada.")
-    if not N8N_SECRET_KEY:
-        print("⚠️ AVISO: N8N_SECRET_KEY não configurada. A atualização de status pelo N8N pode falhar.")
-        
-    genai.configure(api_key=GEMINI_API_KEY)
-    # Modelo global para endpoints SEM instrução de sistema dinâmica
-    model = genai.GenerativeModel('gemini-2.5-flash-preview-09-2025') 
-    print("✅  [Gemini] Modelo ('gemini-2.5-flash-preview-09-2025') inicializado.")
+        if not leader:
+            self.count("coalesced")
+            flight["event"].wait()
+            if flight["error"] is not None:
+                raise flight["error"]
+            return flight["value"]
 
-except Exception as e:
-    model = None
-    print(f"❌ Erro ao carregar chaves ou configurar Gemini: {e}")
-    traceback.print_exc()
-
-# --- 3. [HELPER] SQL para Criar/Atualizar Tabelas ---
-CREATE_ELO_LEADS_TABLE_SQL = """
-CREATE TABLE IF NOT EXISTS elo_leads (
-    id SERIAL PRIMARY KEY,
-    created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
-    nome VARCHAR(255),
-    email VARCHAR(255), -- UNIQUE FOI REMOVIDO PARA TESTES
-    empresa_ramo VARCHAR(255),
-    cargo VARCHAR(255),
-    cnpj_fornecido VARCHAR(50),
-    status_lead VARCHAR(50) DEFAULT 'Frio',
-    recomendacoes_ia JSONB, 
-    historico_chat JSONB,
-    email_enviado BOOLEAN DEFAULT false,
-    ja_e_cliente VARCHAR(50) 
-);
-"""
-CREATE_ELO_ORCAR_TABLE_SQL = """
-CREATE TABLE IF NOT EXISTS elo_orçar (
-    id SERIAL PRIMARY KEY,
-    created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
-    produto_desejado TEXT,
-    quantidade_estimada VARCHAR(100),
-    prazo_entrega VARCHAR(255),
-    tipo_de_gravacao VARCHAR(255),
-    cidade_entrega VARCHAR(255),
-    estado_entrega VARCHAR(100),
-    lead_id INTEGER REFERENCES elo_leads(id)
-);
-"""
-ADD_NEW_COLUMNS_SQL = """
-ALTER TABLE elo_leads 
-ADD COLUMN IF NOT EXISTS whatsapp VARCHAR(50),
-ADD COLUMN IF NOT EXISTS isca TEXT,
-ADD COLUMN IF NOT EXISTS status VARCHAR(100) DEFAULT 'Novo';
-"""
-# (SQL para remover a trava de email)
-DROP_UNIQUE_CONSTRAINT_SQL = """
-ALTER TABLE elo_leads 
-DROP CONSTRAINT IF EXISTS elo_leads_email_key;
-"""
+        try:
+            isca = self._db(self.db_get_steps(key))
+            if not self.found_in_db(isca):
+                isca = generate(ramo)
+                self._db(self.db_put_steps(key, ramo, isca))
+            self.memory_put(key, isca)
+            flight["value"] = isca
+            return isca
+        except Exception as e:
+            flight["error"] = e
+            raise
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+            flight["event"].set()
 
-# --- 4. [HELPER] Função de Setup do Banco (ATUALIZADA) ---
-def setup_database():
-    """Conecta ao banco e garante que TODAS as tabelas e colunas existam."""
-    conn = None
-    try:
-        if not DATABASE_URL:
-            print("⚠️ AVISO [DB]: DATABASE_URL não configurada.")
-            return
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats["memory_entries"] = len(self._data)
+        return stats
+
+
+isca_cache = IscaCache(ISCA_CACHE_MAX, ISCA_CACHE_TTL, ISCA_CACHE_DB_TTL_DAYS)
 
-        print("ℹ️  [DB] Conectando ao PostgreSQL para verificar tabelas...")
-        conn = psycopg2.connect(DATABASE_URL)
-        cur = conn.cursor()
+
+def build_recommendations_prompt(ramo):
+    return f"""
+        Você é um especialista de marketing sênior da [SUA_GRÁFICA BOT].
+        Um cliente do ramo de "{ramo}" pediu 5 ideias de brindes. 
+        
+        Gere uma lista com 5 ideias de brindes que se encaixam perfeitamente nesse nicho. 
+        Para cada brinde, dê o NOME DO BRINDE e uma frase curta (1 linha) explicando POR QUE ele é bom para esse ramo.
         
-        print("ℹ️  [DB] Verificando 'elo_leads' (base)...")
-        cur.execute(CREATE_ELO_LEADS_TABLE_SQL)
+        Separe as ideias por faixas de preço:
         
-        print("ℹ️  [DB] Verificando 'elo_orçar'...")
-        cur.execute(CREATE_ELO_ORCAR_TABLE_SQL)
+        **Brindes de Alto Impacto (Premium):**
+        1. [Nome do Brinde 1]: [Explicação de 1 linha]
+        2. [Nome do Brinde 2]: [Explicação de 1 linha]
         
-        print("ℹ️  [DB] Verificando colunas 'whatsapp', 'isca', 'status' em 'elo_leads'...")
-        cur.execute(ADD_NEW_COLUMNS_SQL)
+        **Brindes do Dia-a-Dia (Custo-Benefício):**
+        3. [Nome do Brinde 3]: [Explicação de 1 linha]
+        4. [Nome do Brinde 4]: [Explicação de 1 linha]
         
-        # (Adicionado - Garante que a trava de email saiu para os testes)
-        print("ℹ️  [DB] Removendo trava 'UNIQUE' do email para testes...")
-        cur.execute(DROP_UNIQUE_CONSTRAINT_SQL)
+        **Brindes de Grande Volume (Econômico):**
+        5. [Nome do Brinde 5]: [Explicação de 1 linha]
+        """
 
-        conn.commit()
-        cur.close()
-        print("✅  [DB] Tabelas e colunas verificadas/criadas com sucesso.")
-        
-    except psycopg2.Error as e:
-        print(f"❌ ERRO [DB] ao configurar as tabelas: {e}")
-        if conn: conn.rollback()
-    except Exception as e:
-        print(f"❌ ERRO Inesperado [DB] em setup_database: {e}")
-    finally:
-        if conn: conn.close()
+
+ISCA_GENERATION_CONFIG = {"temperature": 0.5}
+
+
+def generate_isca(ramo):
+    log.info(f"[Gemini] Gerando recomendações para o ramo: {ramo}")
+    prompt = build_recommendations_prompt(ramo)
+    response = llm_tail.call(LLM_POLICIES["isca"],
+                             lambda variant, timeout: llm_backend.generate_text(prompt, variant=variant, timeout=timeout))
+    record_llm_usage("isca", response)
+    return response.text
+
+# --- 4.5 [HELPER] Exportação de Leads + Orçamentos ---
+# Uma linha por (lead, orçamento); lead sem orçamento sai uma vez com as
+# colunas do orçamento vazias. Lido por um cursor nomeado (server-side) em
+# lotes de EXPORT_FETCH_SIZE e escrito direto na resposta, então a memória
+# não cresce com o tamanho da exportação. A ordem é (lead_id, orcamento_id):
+# para retomar uma exportação interrompida, mande after=<lead_id>:<orcamento_id>
+# da última linha recebida inteira (orcamento_id vazio = 0). A exportação
+# tem chave própria e SEM padrão: sem EXPORT_SECRET_KEY o endpoint responde 404.
+EXPORT_SECRET_KEY = os.environ.get("EXPORT_SECRET_KEY")
+EXPORT_FETCH_SIZE = int(os.environ.get("EXPORT_FETCH_SIZE", 2000))
+EXPORT_MAX_CONCURRENT = int(os.environ.get("EXPORT_MAX_CONCURRENT", 2))  # por processo (cada uma segura 1 conexão)
+
+EXPORT_LEAD_COLUMNS = [
+    ('lead_id', 'l.id'), ('lead_created_at', 'l.created_at'), ('nome', 'l.nome'), ('email', 'l.email'),
+    ('empresa_ramo', 'l.empresa_ramo'), ('cargo', 'l.cargo'), ('cnpj_fornecido', 'l.cnpj_fornecido'),
+    ('status_lead', 'l.status_lead'), ('status', 'l.status'), ('ja_e_cliente', 'l.ja_e_cliente'),
+    ('whatsapp', 'l.whatsapp'), ('email_enviado', 'l.email_enviado'),
+]
+EXPORT_QUOTE_COLUMNS = [
+    ('orcamento_id', 'o.id'), ('orcamento_created_at', 'o.created_at'), ('produto_desejado', 'o.produto_desejado'),
+    ('quantidade_estimada', 'o.quantidade_estimada'), ('prazo_entrega', 'o.prazo_entrega'),
+    ('tipo_de_gravacao', 'o.tipo_de_gravacao'), ('cidade_entrega', 'o.cidade_entrega'),
+    ('estado_entrega', 'o.estado_entrega'),
+]
+EXPORT_CHAT_COLUMN = ('historico_chat', 'l.historico_chat')
+EXPORT_FORMATS = {'csv': 'text/csv; charset=utf-8', 'ndjson': 'application/x-ndjson'}
+
+_export_slots = threading.BoundedSemaphore(EXPORT_MAX_CONCURRENT)
+
+
+class ExportParamsError(Exception):
+    pass
+
+
+def parse_export_params(args):
+    """Valida os filtros da query string. Levanta ExportParamsError com a mensagem para o cliente."""
+    fmt = args.get('format', 'csv')
+    if fmt not in EXPORT_FORMATS:
+        raise ExportParamsError(f"format deve ser um de: {', '.join(EXPORT_FORMATS)}.")
+
+    dates = {}
+    for name in ('since', 'until'):
+        if args.get(name):
+            try:
+                dates[name] = datetime.datetime.fromisoformat(args[name])
+            except ValueError:
+                raise ExportParamsError(f"{name} deve ser uma data ISO (ex.: 2025-01-31).")
+
+    after = (0, 0)
+    if args.get('after'):
+        try:
+            lead_part, _, quote_part = args['after'].partition(':')
+            after = (int(lead_part), int(quote_part or 0))
+        except ValueError:
+            raise ExportParamsError("after deve ser <lead_id>:<orcamento_id>.")
+
+    statuses = [st.strip() for st in args.get('status', '').split(',') if st.strip()]
+    return {
+        "format": fmt,
+        "since": dates.get('since'),
+        "until": dates.get('until'),
+        "statuses": statuses,
+        "after": after,
+        "include_chat": args.get('include_chat', '1') != '0',
+    }
+
+
+def build_export_query(params):
+    """Devolve (nomes das colunas, SQL, parâmetros) para os filtros dados."""
+    columns = list(EXPORT_LEAD_COLUMNS)
+    if params['include_chat']:
+        columns.append(EXPORT_CHAT_COLUMN)
+    columns += EXPORT_QUOTE_COLUMNS
+
+    after_lead, after_quote = params['after']
+    where = ["l.id >= %s", "(l.id > %s OR COALESCE(o.id, 0) > %s)"]
+    values = [after_lead, after_lead, after_quote]
+    if params['since']:
+        where.append("l.created_at >= %s")
+        values.append(params['since'])
+    if params['until']:
+        where.append("l.created_at < %s")
+        values.append(params['until'])
+    if params['statuses']:
+        where.append("l.status = ANY(%s)")
+        values.append(params['statuses'])
+
+    sql = (f"SELECT {', '.join(expr for _, expr in columns)} "
+           "FROM elo_leads l LEFT JOIN elo_orçar o ON o.lead_id = l.id "
+           f"WHERE {' AND '.join(where)} "
+           "ORDER BY l.id, COALESCE(o.id, 0)")
+    return [name for name, _ in columns], sql, values
+
+
+def _export_value(value):
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    return value
+
+
+def export_csv_chunks(names, batches):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(names)
+    for rows in batches:
+        for row in rows:
+            writer.writerow([json.dumps(v, ensure_ascii=False) if isinstance(v, (dict, list)) else _export_value(v)
+                             for v in row])
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+def export_ndjson_chunks(names, batches):
+    for rows in batches:
+        yield ''.join(json.dumps(dict(zip(names, row)), ensure_ascii=False, default=_export_value) + '\n'
+                      for row in rows)
+
+
+def fetch_export_batches(conn, sql, values):
+    """Lê o resultado por um cursor nomeado, EXPORT_FETCH_SIZE linhas por vez."""
+    with conn.cursor() as setup:
+        setup.execute("SET TRANSACTION READ ONLY")
+    with conn.cursor(name=f"export_{uuid.uuid4().hex}", cursor_factory=TimedCursor) as cur:
+        cur.itersize = EXPORT_FETCH_SIZE
+        cur.execute(sql, values)
+        while True:
+            rows = cur.fetchmany(EXPORT_FETCH_SIZE)
+            if not rows:
+                break
+            yield rows
+
+# --- 4.6 [HELPER] Pontuação de Leads (Quente/Frio) ---
+# Quente = cargo com alguma das palavras de LEAD_SCORE_HOT_CARGOS E um CNPJ
+# informado (qualquer coisa fora de LEAD_SCORE_CNPJ_NEGATIVES). As palavras
+# viram UMA regex compilada e o texto é comparado sem acento/caixa. Mudou a
+# regra? Rode `python rescore_leads.py` para repontuar os leads existentes.
+LEAD_SCORE_HOT_CARGOS = os.environ.get("LEAD_SCORE_HOT_CARGOS", "marketing,comprador,diretor,compras,ceo,agencia,mkt")
+LEAD_SCORE_CNPJ_NEGATIVES = os.environ.get("LEAD_SCORE_CNPJ_NEGATIVES", "nao,não,n")
+RESCORE_CHUNK_SIZE = int(os.environ.get("RESCORE_CHUNK_SIZE", 5000))
+
+
+class LeadScorer:
+    """Matcher pré-compilado das regras de 'Quente'/'Frio'."""
+
+    def __init__(self, hot_cargos, cnpj_negatives):
+        keywords = sorted({strip_accents_lower(k).strip() for k in hot_cargos.split(',')} - {''}, key=len, reverse=True)
+        self.hot_cargo_re = re.compile('|'.join(map(re.escape, keywords))) if keywords else None
+        self.cnpj_negatives = {strip_accents_lower(n).strip() for n in cnpj_negatives.split(',')} | {''}
+
+    def score(self, cargo, cnpj):
+        if not cargo or not cnpj or self.hot_cargo_re is None:
+            return 'Frio'
+        if strip_accents_lower(cnpj).strip() in self.cnpj_negatives:
+            return 'Frio'
+        return 'Quente' if self.hot_cargo_re.search(strip_accents_lower(cargo)) else 'Frio'
+
+
+lead_scorer = LeadScorer(LEAD_SCORE_HOT_CARGOS, LEAD_SCORE_CNPJ_NEGATIVES)
+
+RESCORE_SELECT_SQL = "SELECT id, cargo, cnpj_fornecido, status_lead FROM elo_leads WHERE id > %s ORDER BY id LIMIT %s"
+
+
+def rescore_leads(chunk_size=RESCORE_CHUNK_SIZE, dry_run=False, scorer=None):
+    """
+    Repontua TODOS os leads com as regras atuais, em lotes por id (keyset).
+    Cada lote é uma transação: um SELECT e, se algo mudou, um único UPDATE
+    ... FROM (VALUES ...). Devolve o relatório (lidos, alterados, leads/s).
+    """
+    scorer = scorer or lead_scorer
+    started = time.monotonic()
+    report = {"lidos": 0, "alterados": 0, "quentes": 0, "lotes": 0}
+    last_id = 0
+    while True:
+        with db_cursor() as cur:
+            cur.execute(RESCORE_SELECT_SQL, (last_id, chunk_size))
+            rows = cur.fetchall()
+            if not rows:
+                break
+            changes = []
+            for lead_id, cargo, cnpj, current in rows:
+                status = scorer.score(cargo, cnpj)
+                report["quentes"] += status == 'Quente'
+                if status != current:
+                    changes.append((lead_id, status))
+            if changes and not dry_run:
+                psycopg2.extras.execute_values(cur, """
+                    UPDATE elo_leads AS l SET status_lead = v.status_lead
+                    FROM (VALUES %s) AS v (id, status_lead)
+                    WHERE l.id = v.id
+                """, changes, template="(%s::integer, %s::varchar)", page_size=len(changes))
+
+        last_id = rows[-1][0]
+        report["lidos"] += len(rows)
+        report["alterados"] += len(changes)
+        report["lotes"] += 1
+        elapsed = time.monotonic() - started
+        log.info(f"[Rescore] Lote {report['lotes']}: {report['lidos']} lidos, {report['alterados']} alterados "
+                 f"({report['lidos'] / elapsed:.0f} leads/s).")
+
+    elapsed = time.monotonic() - started
+    report["segundos"] = round(elapsed, 3)
+    report["leads_por_segundo"] = round(report["lidos"] / elapsed, 1) if elapsed else 0.0
+    report["dry_run"] = dry_run
+    return report
 
 # --- 5. Endpoints da API ---
 
@@ -124,10 +1887,20 @@ def setup_database():
 def index():
     return jsonify({"message": "API [SUA_GRÁFICA BOT] (v3.1 - Funil N8N) está rodando!"})
 
+@app.route('/widget/')
+@app.route('/widget/<page>')
+def widget_page(page='index.html'):
+    """Páginas do widget (no-cache + ETag: sempre revalidam, quase sempre 304)."""
+    return serve_widget_file(page, immutable=False)
+
+@app.route('/widget/assets/<name>')
+def widget_asset(name):
+    """CSS/JS/imagens do widget, com o hash do conteúdo no nome (cache immutable)."""
+    return serve_widget_file(name, immutable=True)
+
 @app.route('/api/save-lead', methods=['POST'])
 def save_lead():
     """(Endpoint de finalização - usado para o CNPJ)"""
-    print("\n--- Recebido trigger para /api/save-lead (Finalização/CNPJ) ---")
     data = request.get_json()
     
     lead_id = data.get('lead_id')
@@ -138,208 +1911,167 @@ def save_lead():
     if not data or not lead_id:
         return jsonify({"error": "lead_id é obrigatório."}), 400
 
-    status = 'Frio'
-    cargos_quentes = ['marketing', 'comprador', 'diretor', 'compras', 'ceo', 'agencia', 'mkt']
-    if cargo and cnpj and any(c in cargo.lower() for c in cargos_quentes) and cnpj.lower() not in ['nao', 'não', 'n', '']:
-        status = 'Quente'
+    status = lead_scorer.score(cargo, cnpj)
 
-    conn = None
     try:
-        conn = psycopg2.connect(DATABASE_URL)
-        cur = conn.cursor()
         historico_json = json.dumps(historico)
+        with db_cursor() as cur:
+            log.info(f"[DB] Executando UPDATE para Lead ID: {lead_id} (CNPJ/Final)")
+            sql = """
+            UPDATE elo_leads SET 
+                cnpj_fornecido = COALESCE(%s, cnpj_fornecido),
+                status_lead = %s,
+                historico_chat = %s
+            WHERE id = %s
+            RETURNING id;
+            """
+            cur.execute(sql, (cnpj, status, historico_json, lead_id))
+            final_lead_id = cur.fetchone()[0]
         
-        print(f"ℹ️  [DB] Executando UPDATE para Lead ID: {lead_id} (CNPJ/Final)")
-        sql = """
-        UPDATE elo_leads SET 
-            cnpj_fornecido = COALESCE(%s, cnpj_fornecido),
-            status_lead = %s,
-            historico_chat = %s
-        WHERE id = %s
-        RETURNING id;
-        """
-        cur.execute(sql, (cnpj, status, historico_json, lead_id))
-        final_lead_id = cur.fetchone()[0]
-        
-        conn.commit()
-        print(f"✅  [DB] Lead finalizado com ID: {final_lead_id} (Status: {status})")
+        log.info(f"[DB] Lead finalizado com ID: {final_lead_id} (Status: {status})")
         return jsonify({"success": True, "lead_id": final_lead_id, "status": status}), 201
         
+    except PoolTimeoutError:
+        raise
     except Exception as e:
-        print(f"❌ ERRO [DB] ao salvar o lead (final): {e}")
-        traceback.print_exc()
-        if conn: conn.rollback()
+        record_error("save_lead", e)
+        log.exception(f"[DB] Erro ao salvar o lead (final): {e}")
         return jsonify({"error": f"Erro ao salvar o lead: {e}"}), 500
-    finally:
-        if conn:
-            cur.close()
-            conn.close()
 
 # --- (ENDPOINT DE CHAT CORRIGIDO) ---
 @app.route('/api/chat', methods=['POST'])
+@idempotent('chat', 'leadId')
 def chat():
     """
-    Recebe o histórico da conversa e os dados do lead,
-    retorna a resposta da IA e os dados extraídos.
+    Recebe o histórico da conversa (ou só a nova mensagem, no modo sessão)
+    e os dados do lead, retorna a resposta da IA e os dados extraídos.
     """
-    print("\n--- Recebido trigger para /api/chat ---")
-    if not model: # 'model' aqui se refere ao 'model' global
+    if not llm_backend.available():
         return jsonify({"error": "Serviço de IA não está disponível."}), 503
 
-    data = request.get_json()
-    history = data.get('conversationHistory', [])
-    lead_data = data.get('leadData', {})
-    lead_id = data.get('leadId')
+    try:
+        turn = prepare_chat_turn(request.get_json())
+    except ChatTurnError as e_turn:
+        return jsonify({"error": e_turn.message}), e_turn.status
 
-    # 1. Define o "cérebro" da IA (System Prompt ATUALIZADO)
-    system_prompt = f"""
-    Você é o [SUA_GRÁFICA BOT], um assistente virtual amigável e proativo da [SUA_GRÁFICA BOT].
-    Seu objetivo principal é coletar os seguintes 6 dados do cliente: "nome", "empresa_ramo", "cargo", "email", "ja_e_cliente", "whatsapp".
-    
-    Estes são os dados que já temos: {lead_data}
-    
-    REGRAS DA CONVERSA:
-    1.  Converse naturalmente. Peça o próximo dado FALTANDO da lista (nome -> empresa_ramo -> cargo -> email -> ja_e_cliente -> whatsapp).
-    2.  NÃO peça por dados que já estão preenchidos na lista {lead_data}.
-    3.  Após coletar o "email", a próxima pergunta DEVE ser "Você já é cliente da [SUA_GRÁFICA BOT]? (Sim ou Não)".
-    4.  Após coletar o "ja_e_cliente", a próxima pergunta DEVE ser "Ótimo! E qual o seu WhatsApp com DDD? (para agilizar o contato)".
-    5.  Se o usuário fornecer vários dados de uma vez, capture todos.
-    
-    FORMATO DA RESPOSTA (JSON obrigatório):
-    {{
-        "botResponse": "O texto da sua resposta para o usuário.",
-        "extractedData": {{
-            "nome": "[O nome extraído ESTA RODADA]",
-            "empresa_ramo": "[O ramo extraído ESTA RODADA]",
-            "cargo": "[O cargo extraído ESTA RODADA]",
-            "email": "[O email extraído ESTA RODADA]",
-            "ja_e_cliente": "[O 'Sim' ou 'Não' extraído ESTA RODADA]",
-            "whatsapp": "[O whatsapp extraído ESTA RODADA]"
-        }}
-    }}
+    try:
+        gemini_response = try_fast_path(turn)
+        if gemini_response is None:
+            count_llm_call()
+            response = call_chat_model(turn)
+            record_prompt_tokens(turn, response)
+            
+            with observe_stage("json_parse"):
+                gemini_response = json.loads(response.text)
+            log.info("[Gemini] Resposta da IA", extra={"resposta": log_payload(gemini_response)})
+
+        return jsonify(finish_chat_turn(turn, gemini_response))
+
+    except LLMOverloadedError:
+        raise
+    except Exception as e_gen:
+        record_error("chat", e_gen)
+        log.exception(f"[Gemini] Erro ao gerar resposta do chat: {e_gen}")
+        return jsonify({"error": "Erro ao processar a resposta da IA."}), 500
+
+@app.route('/api/chat-stream', methods=['POST'])
+def chat_stream():
     """
-    
-    gemini_history = []
-    for message in history:
-        role = 'user' if message['role'] == 'user' else 'model'
-        gemini_history.append({'role': role, 'parts': [{'text': message['text']}]})
+    Mesmo contrato do /api/chat, mas responde via Server-Sent Events:
+    - event 'token': {"text": "..."} com cada pedaço novo do botResponse;
+    - event 'done': {botResponse, leadData, leadId, isComplete} depois de salvar;
+    - event 'error': {"error": "..."} se a IA falhar no meio do caminho.
+    Aceita Idempotency-Key (as mesmas chaves do /api/chat; a repetição recebe
+    o texto todo num único 'token').
+    """
+    if not llm_backend.available():
+        return jsonify({"error": "Serviço de IA não está disponível."}), 503
 
+    data = request.get_json()
     try:
-        print(f"ℹ️  [Gemini] Chamando IA com dados: {lead_data}")
+        key = idempotency_key('chat', 'leadId', data, request.headers, request.get_data())
+    except ValueError as e_key:
+        return jsonify({"error": str(e_key)}), 400
+    if key is not None:
+        action, stored = idempotency_store.begin(*key)
+        if action == 'replay' and stored[0] == 200:
+            return sse_replay(stored)
+        if action != 'run':
+            return idempotency_response(action, stored)
 
-        # --- [A CORREÇÃO ESTÁ AQUI] ---
-        # 1. Cria um novo modelo LOCAL com a instrução de sistema dinâmica
-        chat_model = genai.GenerativeModel(
-            'gemini-2.5-flash-preview-09-2025',
-            system_instruction=system_prompt
-        )
-        
-        # 2. Chama generate_content NESSE modelo (sem o system_instruction como kwarg)
-        response = chat_model.generate_content(
-            gemini_history, # Passa o histórico
-            generation_config=genai.types.GenerationConfig(
-                temperature=0.7,
-                response_mime_type="application/json"
-            ),
-            safety_settings={'HATE': 'BLOCK_NONE', 'HARASSMENT': 'BLOCK_NONE', 'SEXUAL' : 'BLOCK_NONE', 'DANGEROUS' : 'BLOCK_NONE'}
-            # 'system_instruction' foi REMOVIDO daqui
-        )
-        # --- [FIM DA CORREÇÃO] ---
-        
-        gemini_response = json.loads(response.text)
-        print(f"✅  [Gemini] Resposta da IA: {gemini_response}")
-        
-        bot_response_text = gemini_response.get('botResponse', 'Desculpe, não entendi. Pode repetir?')
-        extracted_data = gemini_response.get('extractedData', {})
-        
-        is_complete = False
-        new_lead_data = lead_data.copy()
-        
-        for key, value in extracted_data.items():
-            if key in ['nome', 'email', 'empresa_ramo', 'cargo', 'ja_e_cliente', 'whatsapp'] and value:
-                new_lead_data[key] = value
-                
-        current_history_json = json.dumps(history + [
-            {'role': 'bot', 'text': bot_response_text, 'time': 'now'}
-        ])
-        
-        conn = None
-        try:
-            conn = psycopg2.connect(DATABASE_URL)
-            cur = conn.cursor()
-            
-            if lead_id:
-                print(f"ℹ️  [DB-Chat] Executando UPDATE para Lead ID: {lead_id}")
-                sql = """
-                UPDATE elo_leads SET 
-                    nome = COALESCE(%s, nome),
-                    email = COALESCE(%s, email),
-                    empresa_ramo = COALESCE(%s, empresa_ramo),
-                    cargo = COALESCE(%s, cargo),
-                    ja_e_cliente = COALESCE(%s, ja_e_cliente),
-                    whatsapp = COALESCE(%s, whatsapp), 
-                    historico_chat = %s
-                WHERE id = %s
-                RETURNING id;
-                """
-                cur.execute(sql, (
-                    new_lead_data.get('nome'), new_lead_data.get('email'), 
-                    new_lead_data.get('empresa_ramo'), new_lead_data.get('cargo'),
-                    new_lead_data.get('ja_e_cliente'), new_lead_data.get('whatsapp'),
-                    current_history_json, lead_id
-                ))
-                final_lead_id = cur.fetchone()[0]
+    state = {"open": key is not None}
 
-            else:
-                # Como não temos mais a trava de email, a lógica de INSERT é mais simples
-                print("ℹ️  [DB-Chat] Executando INSERT (sem trava de email).")
-                sql = """
-                INSERT INTO elo_leads (nome, email, empresa_ramo, cargo, ja_e_cliente, whatsapp, historico_chat, status)
-                VALUES (%s, %s, %s, %s, %s, %s, %s, 'Coletando')
-                RETURNING id;
-                """
-                cur.execute(sql, (
-                    new_lead_data.get('nome'), new_lead_data.get('email'),
-                    new_lead_data.get('empresa_ramo'), new_lead_data.get('cargo'),
-                    new_lead_data.get('ja_e_cliente'), new_lead_data.get('whatsapp'),
-                    current_history_json
-                ))
-                final_lead_id = cur.fetchone()[0]
+    def abort_key():
+        if state["open"]:
+            state["open"] = False
+            idempotency_store.abort(key[0])
 
-            conn.commit()
-            lead_id = final_lead_id 
-            print(f"✅  [DB-Chat] Lead salvo/atualizado com ID: {lead_id}")
+    try:
+        turn = prepare_chat_turn(data)
+        fast_response = try_fast_path(turn)
+        llm_stream = None
+        if fast_response is None:
+            # A vaga é reservada ANTES de abrir o stream, para ainda dar tempo de responder 429/503
+            count_llm_call()
+            llm_stream = call_chat_model(turn, stream=True)
+    except ChatTurnError as e_turn:
+        if state["open"]:
+            state["open"] = False
+            idempotency_store.complete(*key, (e_turn.status, json.dumps({"error": e_turn.message}), 'application/json'))
+        return jsonify({"error": e_turn.message}), e_turn.status
+    except BaseException:
+        abort_key()
+        raise
 
-        except Exception as e_db:
-            print(f"❌ ERRO [DB-Chat] ao salvar o lead: {e_db}")
-            traceback.print_exc()
-            if conn: conn.rollback()
-        finally:
-            if conn:
-                cur.close()
-                conn.close()
-        
-        if (new_lead_data.get('nome') and 
-            new_lead_data.get('empresa_ramo') and 
-            new_lead_data.get('cargo') and 
-            new_lead_data.get('email') and
-            new_lead_data.get('ja_e_cliente') and
-            new_lead_data.get('whatsapp')):
-            
-            is_complete = True
-            print("✅  [IA] Coleta de dados (6/6) completa!")
+    def close():
+        if llm_stream is not None:
+            llm_stream.close()
+        abort_key()
 
-        return jsonify({
-            "botResponse": bot_response_text,
-            "leadData": new_lead_data,
-            "leadId": lead_id,
-            "isComplete": is_complete
-        })
+    def finish(gemini_response):
+        result = finish_chat_turn(turn, gemini_response)
+        if state["open"]:
+            state["open"] = False
+            idempotency_store.complete(*key, (200, json.dumps(result, ensure_ascii=False), 'application/json'))
+        return sse_event('done', result)
 
-    except Exception as e_gen:
-        print(f"❌ ERRO [Gemini] ao gerar resposta do chat: {e_gen}")
-        traceback.print_exc()
-        return jsonify({"error": "Erro ao processar a resposta da IA."}), 500
+    def generate():
+        if fast_response is not None:
+            try:
+                yield sse_event('token', {"text": fast_response['botResponse']})
+                yield finish(fast_response)
+            finally:
+                abort_key()
+            return
+
+        parser = BotResponseStreamParser()
+        try:
+            for chunk in llm_stream:
+                text = parser.feed(chunk.text)
+                if text:
+                    yield sse_event('token', {"text": text})
+            record_prompt_tokens(turn, llm_stream.response)
+
+            gemini_response = json.loads(parser.buffer)
+            log.info("[Gemini] Resposta da IA (stream)", extra={"resposta": log_payload(gemini_response)})
+            yield finish(gemini_response)
+
+        except Exception as e_gen:
+            record_error("chat_stream", e_gen)
+            log.exception(f"[Gemini] Erro ao gerar resposta do chat (stream): {e_gen}")
+            message = e_gen.message if isinstance(e_gen, LLMOverloadedError) else "Erro ao processar a resposta da IA."
+            yield sse_event('error', {"error": message})
+        finally:
+            close()
+
+    response = Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+    # (Se o cliente cair antes do primeiro evento, o gerador nem começa)
+    response.call_on_close(close)
+    return response
 
 @app.route('/api/generate-recommendations', methods=['POST'])
 def generate_recommendations():
@@ -347,8 +2079,7 @@ def generate_recommendations():
     Gera a "Isca" de MKT, salva na coluna 'isca' 
     e atualiza o 'status' para o N8N.
     """
-    print("\n--- Recebido trigger para /api/generate-recommendations ---")
-    if not model:
+    if not llm_backend.available():
         return jsonify({"error": "Serviço de IA não está disponível."}), 503
         
     data = request.get_json()
@@ -359,81 +2090,40 @@ def generate_recommendations():
         return jsonify({"error": "ID do Lead e Ramo são obrigatórios."}), 400
 
     try:
-        prompt = f"""
-        Você é um especialista de marketing sênior da [SUA_GRÁFICA BOT].
-        Um cliente do ramo de "{ramo}" pediu 5 ideias de brindes. 
-        
-        Gere uma lista com 5 ideias de brindes que se encaixam perfeitamente nesse nicho. 
-        Para cada brinde, dê o NOME DO BRINDE e uma frase curta (1 linha) explicando POR QUE ele é bom para esse ramo.
-        
-        Separe as ideias por faixas de preço:
-        
-        **Brindes de Alto Impacto (Premium):**
-        1. [Nome do Brinde 1]: [Explicação de 1 linha]
-        2. [Nome do Brinde 2]: [Explicação de 1 linha]
-        
-        **Brindes do Dia-a-Dia (Custo-Benefício):**
-        3. [Nome do Brinde 3]: [Explicação de 1 linha]
-        4. [Nome do Brinde 4]: [Explicação de 1 linha]
-        
-        **Brindes de Grande Volume (Econômico):**
-        5. [Nome do Brinde 5]: [Explicação de 1 linha]
-        """
-        
-        print(f"ℹ️  [Gemini] Gerando recomendações para o ramo: {ramo}")
-        response = model.generate_content(
-            prompt,
-            generation_config=genai.types.GenerationConfig(temperature=0.5),
-            safety_settings={'HATE': 'BLOCK_NONE', 'HARASSMENT': 'BLOCK_NONE', 'SEXUAL' : 'BLOCK_NONE', 'DANGEROUS' : 'BLOCK_NONE'}
-        )
-        
-        recomendacoes_texto = response.text
-        print(f"✅  [Gemini] Recomendações (Isca) geradas.")
+        recomendacoes_texto = isca_cache.get_or_generate(ramo, generate_isca)
+        log.info(f"[Gemini] Recomendações (Isca) prontas (ramo normalizado: '{normalize_ramo(ramo)}').")
 
-        conn = None
         try:
-            conn = psycopg2.connect(DATABASE_URL)
-            cur = conn.cursor()
-            
-            cur.execute("""
-                UPDATE elo_leads 
-                SET 
-                    isca = %s, 
-                    status = %s,
-                    email_enviado = %s
-                WHERE id = %s
-            """, (
-                recomendacoes_texto,
-                'Aguardando Envio N8N',
-                False,
-                lead_id
-            ))
+            with db_cursor() as cur:
+                cur.execute(LEAD_SET_ISCA_SQL, (
+                    recomendacoes_texto,
+                    STATUS_AGUARDANDO_N8N,
+                    False,
+                    lead_id
+                ))
             
-            conn.commit()
-            print(f"✅  [DB] Isca salva e status atualizado para 'Aguardando Envio N8N' no Lead ID: {lead_id}")
+            log.info(f"[DB] Isca salva e status atualizado para '{STATUS_AGUARDANDO_N8N}' no Lead ID: {lead_id}")
 
         except Exception as e_db:
-            print(f"❌ ERRO [DB] ao ATUALIZAR lead com a isca: {e_db}")
-            if conn: conn.rollback()
-        finally:
-            if conn:
-                cur.close()
-                conn.close()
+            log.error(f"[DB] Erro ao ATUALIZAR lead com a isca: {e_db}")
 
         return jsonify({"success": True, "message": "Isca gerada e salva no DB."})
 
+    except LLMOverloadedError:
+        raise
     except Exception as e_gen:
-        print(f"❌ ERRO [Gemini] ao gerar recomendações: {e_gen}")
-        traceback.print_exc()
+        record_error("generate_recommendations", e_gen)
+        log.exception(f"[Gemini] Erro ao gerar recomendações: {e_gen}")
         return jsonify({"error": "Erro ao gerar as recomendações."}), 500
 
 @app.route('/api/save-quote', methods=['POST'])
+@idempotent('save-quote', 'lead_id')
 def save_quote():
     """
     Recebe os dados do orçamento, salva na tabela 'elo_orçar'
-    e dispara o Webhook de VENDAS (N8N) para o orçamentista.
+    e enfileira o Webhook de VENDAS (N8N) para o orçamentista na outbox
+    (entregue em segundo plano pelo OutboxDispatcher).
     """
-    print("\n--- Recebido trigger para /api/save-quote (ORÇAMENTO) ---")
     
     data = request.get_json()
     lead_id = data.get('lead_id')
@@ -449,121 +2139,363 @@ def save_quote():
     if not lead_id or not produto or not quantidade:
         return jsonify({"error": "lead_id, produto e quantidade são obrigatórios."}), 400
 
-    conn = None
     try:
-        conn = psycopg2.connect(DATABASE_URL)
-        cur = conn.cursor()
-        
-        print(f"ℹ️  [DB] Salvando orçamento para Lead ID: {lead_id}...")
-        sql_orcar = """
-        INSERT INTO elo_orçar 
-            (lead_id, produto_desejado, quantidade_estimada, prazo_entrega, tipo_de_gravacao, cidade_entrega, estado_entrega)
-        VALUES 
-            (%s, %s, %s, %s, %s, %s, %s)
-        RETURNING id;
-        """
-        cur.execute(sql_orcar, (lead_id, produto, quantidade, prazo, gravacao, cidade, estado))
-        orcamento_id = cur.fetchone()[0]
-        print(f"✅  [DB] Orçamento ID: {orcamento_id} salvo com sucesso.")
+        with db_cursor() as cur:
+            log.info(f"[DB] Salvando orçamento para Lead ID: {lead_id}...")
+            sql_orcar = """
+            INSERT INTO elo_orçar 
+                (lead_id, produto_desejado, quantidade_estimada, prazo_entrega, tipo_de_gravacao, cidade_entrega, estado_entrega)
+            VALUES 
+                (%s, %s, %s, %s, %s, %s, %s)
+            RETURNING id;
+            """
+            cur.execute(sql_orcar, (lead_id, produto, quantidade, prazo, gravacao, cidade, estado))
+            orcamento_id = cur.fetchone()[0]
+            log.info(f"[DB] Orçamento ID: {orcamento_id} salvo com sucesso.")
 
-        print(f"ℹ️  [DB] Buscando dados do Lead ID: {lead_id} para o webhook...")
-        cur.execute("SELECT nome, email, empresa_ramo, cargo, ja_e_cliente, whatsapp FROM elo_leads WHERE id = %s", (lead_id,))
-        lead_info = cur.fetchone()
+            log.info(f"[DB] Buscando dados do Lead ID: {lead_id} para o webhook...")
+            cur.execute("SELECT nome, email, empresa_ramo, cargo, ja_e_cliente, whatsapp FROM elo_leads WHERE id = %s", (lead_id,))
+            lead_info = cur.fetchone()
         
-        if not lead_info:
-            print(f"❌ ERRO [Webhook]: Não foi possível encontrar o lead (ID: {lead_id}) para disparar o webhook.")
-            conn.commit()
-            return jsonify({"success": True, "orcamento_id": orcamento_id, "webhook_status": "erro_lead_nao_encontrado"}), 201
+            if not lead_info:
+                log.error(f"[Webhook] Não foi possível encontrar o lead (ID: {lead_id}) para disparar o webhook.")
+                return jsonify({"success": True, "orcamento_id": orcamento_id, "webhook_status": "erro_lead_nao_encontrado"}), 201
 
-        if SALES_WEBHOOK_URL:
-            webhook_payload = {
-                "lead_id": lead_id,
-                "orcamento_id": orcamento_id,
-                "nome": lead_info[0],
-                "email": lead_info[1],
-                "empresa_ramo": lead_info[2],
-                "cargo": lead_info[3],
-                "ja_e_cliente": lead_info[4],
-                "whatsapp": lead_info[5],
-                "produto_desejado": produto,
-                "quantidade_estimada": quantidade,
-                "prazo_entrega": prazo,
-                "tipo_de_gravacao": gravacao,
-                "cidade_entrega": cidade,
-                "estado_entrega": estado
-            }
-            
-            print(f"ℹ️  [Webhook] Disparando webhook de VENDAS para: {SALES_WEBHOOK_URL}")
-            try:
-                requests.post(SALES_WEBHOOK_URL, json=webhook_payload, timeout=3)
-                print("✅  [Webhook] Webhook de VENDAS disparado.")
-            except requests.RequestException as e_req:
-                print(f"❌ ERRO [Webhook] Falha ao disparar o webhook: {e_req}")
+            if SALES_WEBHOOK_URL:
+                webhook_payload = {
+                    "lead_id": lead_id,
+                    "orcamento_id": orcamento_id,
+                    "nome": lead_info[0],
+                    "email": lead_info[1],
+                    "empresa_ramo": lead_info[2],
+                    "cargo": lead_info[3],
+                    "ja_e_cliente": lead_info[4],
+                    "whatsapp": lead_info[5],
+                    "produto_desejado": produto,
+                    "quantidade_estimada": quantidade,
+                    "prazo_entrega": prazo,
+                    "tipo_de_gravacao": gravacao,
+                    "cidade_entrega": cidade,
+                    "estado_entrega": estado
+                }
+
+                # Mesma transação do orçamento: ou os dois são gravados, ou nenhum
+                outbox_id = enqueue_webhook(cur, webhook_payload)
+                log.info(f"[Webhook] Webhook de VENDAS enfileirado na outbox (ID: {outbox_id}).")
         
-        else:
-            print("⚠️  [Webhook] SALES_WEBHOOK_URL não configurada. Webhook não disparado.")
+            else:
+                log.warning("[Webhook] SALES_WEBHOOK_URL não configurada. Webhook não disparado.")
 
-        conn.commit()
-        return jsonify({"success": True, "orcamento_id": orcamento_id, "webhook_status": "disparado" if SALES_WEBHOOK_URL else "nao_configurado"}), 201
+        if SALES_WEBHOOK_URL:
+            outbox_dispatcher.wake()
+        return jsonify({"success": True, "orcamento_id": orcamento_id, "webhook_status": "enfileirado" if SALES_WEBHOOK_URL else "nao_configurado"}), 201
 
+    except PoolTimeoutError:
+        raise
     except Exception as e:
-        print(f"❌ ERRO [DB] ao salvar o orçamento: {e}")
-        traceback.print_exc()
-        if conn: conn.rollback()
+        record_error("save_quote", e)
+        log.exception(f"[DB] Erro ao salvar o orçamento: {e}")
         return jsonify({"error": f"Erro ao salvar o orçamento: {e}"}), 500
-    finally:
-        if conn:
-            cur.close()
-            conn.close()
+
+N8N_CLAIM_MAX = int(os.environ.get("N8N_CLAIM_MAX", 500))
+N8N_CLAIM_LEASE = int(os.environ.get("N8N_CLAIM_LEASE", 900))  # segundos até um lead "alugado" voltar para a fila
+N8N_BATCH_MAX = int(os.environ.get("N8N_BATCH_MAX", 1000))
+
+N8N_CLAIM_SQL = """
+WITH pendentes AS (
+    SELECT id FROM elo_leads
+    WHERE status = %s
+      AND id > %s
+      AND (n8n_claimed_at IS NULL OR n8n_claimed_at < NOW() - make_interval(secs => %s))
+    ORDER BY id
+    LIMIT %s
+    FOR UPDATE SKIP LOCKED
+)
+UPDATE elo_leads AS l SET n8n_claimed_at = NOW()
+FROM pendentes
+WHERE l.id = pendentes.id
+RETURNING l.id, l.nome, l.email, l.empresa_ramo, l.cargo, l.ja_e_cliente, l.whatsapp, l.isca;
+"""
+N8N_LEAD_COLUMNS = ['id', 'nome', 'email', 'empresa_ramo', 'cargo', 'ja_e_cliente', 'whatsapp', 'isca']
+
+
+def n8n_authorized(endpoint, secret=None):
+    auth_header = request.headers.get('Authorization') or ''
+    expected = f"Bearer {secret or N8N_SECRET_KEY}"
+    if not hmac.compare_digest(auth_header.encode('utf-8'), expected.encode('utf-8')):
+        log.error(f"[Auth] Tentativa de acesso não autorizada ao {endpoint}.")
+        return False
+    return True
+
+
+@app.route('/api/n8n/claim-leads', methods=['POST'])
+def claim_leads_n8n():
+    """
+    Endpoint SEGURO para o N8N pegar um lote de leads com a isca pronta.
+
+    Body (opcional): {"limit": 100, "after_id": 0}. Os leads devolvidos ficam
+    reservados por N8N_CLAIM_LEASE segundos (FOR UPDATE SKIP LOCKED: duas
+    execuções em paralelo nunca recebem o mesmo lead). Para paginar, mande o
+    'next_cursor' como 'after_id' até 'has_more' ser false.
+    """
+    if not n8n_authorized('/api/n8n/claim-leads'):
+        return jsonify({"error": "Não autorizado"}), 401
+
+    data = request.get_json(silent=True) or {}
+    try:
+        limit = min(int(data.get('limit', 100)), N8N_CLAIM_MAX)
+        after_id = int(data.get('after_id') or 0)
+    except (TypeError, ValueError):
+        return jsonify({"error": "limit e after_id devem ser números."}), 400
+    if limit < 1:
+        return jsonify({"error": "limit deve ser maior que zero."}), 400
+
+    try:
+        with db_cursor() as cur:
+            cur.execute(N8N_CLAIM_SQL, (STATUS_AGUARDANDO_N8N, after_id, N8N_CLAIM_LEASE, limit))
+            rows = sorted(cur.fetchall())
+
+        leads = [dict(zip(N8N_LEAD_COLUMNS, row)) for row in rows]
+        log.info(f"[DB-N8N] {len(leads)} lead(s) reservados para envio.")
+        return jsonify({
+            "leads": leads,
+            "next_cursor": leads[-1]['id'] if leads else after_id,
+            "has_more": len(leads) == limit,
+        }), 200
+
+    except PoolTimeoutError:
+        raise
+    except Exception as e:
+        record_error("n8n_claim", e)
+        log.exception(f"[DB-N8N] Erro ao reservar leads: {e}")
+        return jsonify({"error": f"Erro ao reservar leads: {e}"}), 500
+
 
 @app.route('/api/update-status-n8n', methods=['POST'])
 def update_status_n8n():
     """
     Endpoint SEGURO para o N8N chamar DEPOIS de enviar o e-mail da isca.
+
+    Aceita um lead ({"lead_id", "new_status"}) ou um lote inteiro
+    ({"updates": [{"lead_id", "new_status"}, ...]}), aplicado num único UPDATE.
     """
-    print("\n--- Recebido trigger para /api/update-status-n8n ---")
     
-    auth_header = request.headers.get('Authorization')
-    if not auth_header or auth_header != f"Bearer {N8N_SECRET_KEY}":
-        print("❌ ERRO [Auth]: Tentativa de acesso não autorizada ao /api/update-status-n8n.")
+    if not n8n_authorized('/api/update-status-n8n'):
         return jsonify({"error": "Não autorizado"}), 401
         
     data = request.get_json()
+    if 'updates' in data:
+        return update_status_n8n_batch(data.get('updates'))
+
     lead_id = data.get('lead_id')
     new_status = data.get('new_status')
 
     if not lead_id or not new_status:
         return jsonify({"error": "lead_id e new_status são obrigatórios."}), 400
 
-    conn = None
     try:
-        conn = psycopg2.connect(DATABASE_URL)
-        cur = conn.cursor()
-        
-        print(f"ℹ️  [DB-N8N] Atualizando status do Lead ID: {lead_id} para '{new_status}'...")
-        cur.execute("""
-            UPDATE elo_leads 
-            SET status = %s, email_enviado = %s
-            WHERE id = %s
-        """, (new_status, True, lead_id))
+        with db_cursor() as cur:
+            log.info(f"[DB-N8N] Atualizando status do Lead ID: {lead_id} para '{new_status}'...")
+            cur.execute("""
+                UPDATE elo_leads 
+                SET status = %s, email_enviado = %s, n8n_claimed_at = NULL
+                WHERE id = %s
+            """, (new_status, True, lead_id))
         
-        conn.commit()
-        print("✅  [DB-N8N] Status atualizado com sucesso.")
+        log.info("[DB-N8N] Status atualizado com sucesso.")
         return jsonify({"success": True, "lead_id": lead_id, "new_status": new_status}), 200
 
+    except PoolTimeoutError:
+        raise
+    except Exception as e:
+        record_error("n8n_status", e)
+        log.exception(f"[DB-N8N] Erro ao atualizar o status: {e}")
+        return jsonify({"error": f"Erro ao atualizar o status: {e}"}), 500
+
+
+def update_status_n8n_batch(updates):
+    if not isinstance(updates, list) or not updates:
+        return jsonify({"error": "updates deve ser uma lista não vazia."}), 400
+    if len(updates) > N8N_BATCH_MAX:
+        return jsonify({"error": f"Máximo de {N8N_BATCH_MAX} updates por lote."}), 400
+
+    pairs = {}
+    for item in updates:
+        lead_id = item.get('lead_id') if isinstance(item, dict) else None
+        new_status = item.get('new_status') if isinstance(item, dict) else None
+        if not lead_id or not new_status:
+            return jsonify({"error": "Cada update precisa de lead_id e new_status."}), 400
+        try:
+            pairs[int(lead_id)] = new_status  # (repetido no lote: vale o último)
+        except (TypeError, ValueError):
+            return jsonify({"error": f"lead_id inválido: {lead_id}"}), 400
+
+    try:
+        with db_cursor() as cur:
+            log.info(f"[DB-N8N] Atualizando status de {len(pairs)} lead(s) em lote...")
+            updated = psycopg2.extras.execute_values(cur, """
+                UPDATE elo_leads AS l
+                SET status = v.new_status, email_enviado = TRUE, n8n_claimed_at = NULL
+                FROM (VALUES %s) AS v (id, new_status)
+                WHERE l.id = v.id
+                RETURNING l.id
+            """, list(pairs.items()), template="(%s::integer, %s::varchar)", page_size=len(pairs), fetch=True)
+
+        updated_ids = sorted(r[0] for r in updated)
+        not_found = sorted(set(pairs) - set(updated_ids))
+        log.info(f"[DB-N8N] {len(updated_ids)} status atualizados ({len(not_found)} não encontrados).")
+        return jsonify({"success": True, "updated": len(updated_ids), "not_found": not_found}), 200
+
+    except PoolTimeoutError:
+        raise
     except Exception as e:
-        print(f"❌ ERRO [DB-N8N] ao atualizar o status: {e}")
-        traceback.print_exc()
-        if conn: conn.rollback()
+        record_error("n8n_status", e)
+        log.exception(f"[DB-N8N] Erro ao atualizar status em lote: {e}")
         return jsonify({"error": f"Erro ao atualizar o status: {e}"}), 500
-    finally:
-        if conn:
-            cur.close()
-            conn.close()
+
+@app.route('/api/export/leads', methods=['GET'])
+def export_leads():
+    """
+    Endpoint SEGURO (Bearer EXPORT_SECRET_KEY) que exporta leads + orçamentos em stream.
+
+    Query string: format=csv|ndjson, since/until (datas ISO, sobre a criação
+    do lead), status=a,b,c, include_chat=0 (deixa de fora o historico_chat)
+    e after=<lead_id>:<orcamento_id> para retomar de onde parou.
+    """
+    if not EXPORT_SECRET_KEY:
+        return jsonify({"error": "Exportação desativada (EXPORT_SECRET_KEY não configurada)."}), 404
+    if not n8n_authorized('/api/export/leads', secret=EXPORT_SECRET_KEY):
+        return jsonify({"error": "Não autorizado"}), 401
+
+    try:
+        params = parse_export_params(request.args)
+    except ExportParamsError as e_params:
+        return jsonify({"error": str(e_params)}), 400
+    names, sql, values = build_export_query(params)
+
+    if not _export_slots.acquire(blocking=False):
+        response = jsonify({"error": "Já existem exportações em andamento. Tente novamente em instantes."})
+        response.headers["Retry-After"] = "30"
+        return response, 429
+    try:
+        conn = db.db_pool.getconn()
+    except PoolTimeoutError:
+        _export_slots.release()
+        raise
+    except Exception as e:
+        _export_slots.release()
+        record_error("export", e)
+        log.exception(f"[Export] Erro ao abrir a conexão da exportação: {e}")
+        return jsonify({"error": f"Erro ao exportar: {e}"}), 500
+    state = {"open": True, "rows": 0}
+
+    def release():
+        if state["open"]:
+            state["open"] = False
+            discard = False
+            try:
+                conn.rollback()  # (só leitura: encerra a transação do cursor nomeado)
+            except psycopg2.Error:
+                discard = True
+            db.db_pool.putconn(conn, discard=discard)
+            _export_slots.release()
+
+    def counted(batches):
+        for rows in batches:
+            state["rows"] += len(rows)
+            yield rows
+
+    def generate():
+        chunks = export_csv_chunks if params['format'] == 'csv' else export_ndjson_chunks
+        try:
+            yield from chunks(names, counted(fetch_export_batches(conn, sql, values)))
+            log.info("[Export] Exportação concluída", extra={"linhas": state["rows"], "format": params['format']})
+        except Exception as e:
+            # (Com o stream já aberto não dá mais para mudar o status: o cliente retoma com 'after')
+            record_error("export", e)
+            log.exception(f"[Export] Erro no meio da exportação após {state['rows']} linhas: {e}")
+        finally:
+            release()
+
+    filename = f"leads_{datetime.date.today().isoformat()}.{params['format']}"
+    response = Response(generate(), mimetype=EXPORT_FORMATS[params['format']], headers={
+        'Content-Disposition': f'attachment; filename="{filename}"',
+        'Cache-Control': 'no-store',
+        'X-Accel-Buffering': 'no',
+    })
+    response.call_on_close(release)
+    return response
+
+# Endpoints de operação (pool, LLM, caches, /metrics): só com "Authorization: Bearer
+# <OPS_SECRET_KEY>" (no Prometheus: bearer_token). Sem a chave configurada eles
+# respondem 404, então um deploy que esqueceu a variável não os expõe.
+OPS_SECRET_KEY = os.environ.get("OPS_SECRET_KEY")
+
+
+def ops_denial(auth_header):
+    """None se o cabeçalho traz a chave de operação; senão (mensagem, status) da recusa."""
+    if not OPS_SECRET_KEY:
+        return "Não encontrado", 404
+    expected = f"Bearer {OPS_SECRET_KEY}"
+    if not hmac.compare_digest((auth_header or '').encode('utf-8'), expected.encode('utf-8')):
+        log.warning("[Auth] Tentativa de acesso não autorizada a um endpoint de operação.")
+        return "Não autorizado", 401
+    return None
+
+
+def ops_only(view):
+    """Protege a view com a chave de operação (ver ops_denial)."""
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        denied = ops_denial(request.headers.get('Authorization'))
+        if denied:
+            return jsonify({"error": denied[0]}), denied[1]
+        return view(*args, **kwargs)
+    return wrapper
+
+
+@app.route('/api/pool-stats', methods=['GET'])
+@ops_only
+def pool_stats():
+    """Estatísticas do pool de conexões do PostgreSQL deste processo."""
+    return jsonify(db.db_pool.stats())
+
+@app.route('/api/llm-stats', methods=['GET'])
+@ops_only
+def llm_stats():
+    """Backend de LLM em uso, contadores do controle de admissão e das tentativas (deadline/hedge/fallback) deste processo."""
+    return jsonify(dict(llm_limiter.stats(), tentativas=llm_tail.stats()))
+
+@app.route('/api/cache-stats', methods=['GET'])
+@ops_only
+def cache_stats():
+    """Contadores dos caches em memória deste processo."""
+    return jsonify({
+        "isca": isca_cache.stats(),
+        "conversas": {"hits": conversation_cache.hits, "misses": conversation_cache.misses},
+        "chat_fast_path": dict(fast_path_stats),
+        "chat_tokens": dict(chat_token_stats, recent=list(chat_token_log)[-20:]),
+        "logs": dict(log_stats, fila=log_queue_size()),
+        "idempotencia": idempotency_store.stats(),
+        "chat_write_behind": lead_write_behind.stats(),
+    })
+
+@app.route('/metrics', methods=['GET'])
+@ops_only
+def metrics():
+    """Métricas no formato do Prometheus (somadas entre os workers no modo multiprocesso)."""
+    registry = REGISTRY
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    return Response(generate_latest(registry), mimetype=CONTENT_TYPE_LATEST)
 
 # --- 7. Execução do App (Pronto para Render/Gunicorn) ---
+# Sob o gunicorn/uvicorn as migrações ficam fora do import (ver a seção 4);
+# o servidor de desenvolvimento (um processo só) migra ao subir.
 if __name__ == "__main__":
-    setup_database()
     port = int(os.environ.get("PORT", 5001))
+    setup_database()
+    outbox_dispatcher.start()
     app.run(host='0.0.0.0', port=port, debug=False) # Debug=False é melhor para produção
 
@@ -0,0 +1,520 @@
+"""
+Modo ASGI (asyncio) da API [SUA_GRÁFICA BOT].
+
+No gunicorn com workers sync, cada /api/chat ou /api/generate-recommendations
+prende um worker durante toda a chamada ao Gemini. Aqui essas duas rotas
+rodam em asyncio: LLM via llm_backend.*_async (Gemini: generate_content_async),
+com um controle de admissão assíncrono na frente, e Postgres via o pool
+assíncrono do psycopg 3, então um processo segura centenas de conversas em
+voo. As demais rotas continuam sendo o app Flask de app.py, e os contratos
+JSON são exatamente os mesmos. O Flask roda pelo WSGIMiddleware do a2wsgi,
+num pool de ASGI_WSGI_THREADS threads: requisições síncronas (inclusive o
+/api/chat-stream, que segura a sua thread até o fim do stream) rodam em
+paralelo até esse limite, sem bloquear o event loop.
+
+Uso (as migrações ficam num passo antes, ver migrate.py):
+    python migrate.py && uvicorn asgi_app:application --host 0.0.0.0 --port $PORT
+"""
+import asyncio
+import functools
+import itertools
+import json
+import os
+import time
+from contextlib import asynccontextmanager
+
+from a2wsgi import WSGIMiddleware
+from psycopg import AsyncCursor
+from psycopg_pool import AsyncConnectionPool, PoolTimeout
+from quart import Quart, Response, g, jsonify, request
+
+import app as core
+from elo import db, idempotency, observability
+
+log = core.log
+
+ASGI_DB_POOL_MIN = int(os.environ.get("ASGI_DB_POOL_MIN", 1))
+ASGI_DB_POOL_MAX = int(os.environ.get("ASGI_DB_POOL_MAX", 20))
+ASGI_WSGI_THREADS = int(os.environ.get("ASGI_WSGI_THREADS", 16))  # rotas Flask rodando ao mesmo tempo
+ASYNC_ROUTES = {
+    ('POST', '/api/chat'),
+    ('POST', '/api/generate-recommendations'),
+    ('GET', '/api/llm-stats'),
+}
+
+quart_app = Quart(__name__)
+
+
+class TimedAsyncCursor(AsyncCursor):
+    """Cursor que registra o tempo de cada execute no estágio 'db_query' (como o TimedCursor de elo/db.py)."""
+
+    async def execute(self, query, params=None, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await super().execute(query, params, **kwargs)
+        finally:
+            core.STAGE_SECONDS.labels("db_query").observe(time.perf_counter() - started)
+
+
+db_pool = AsyncConnectionPool(
+    db.DATABASE_URL,
+    min_size=ASGI_DB_POOL_MIN,
+    max_size=ASGI_DB_POOL_MAX,
+    timeout=db.DB_POOL_TIMEOUT,
+    max_idle=db.DB_POOL_HEALTHCHECK_IDLE * 10,
+    check=AsyncConnectionPool.check_connection,
+    kwargs={"cursor_factory": TimedAsyncCursor},
+    open=False,
+) if db.DATABASE_URL else None
+
+
+@quart_app.before_serving
+async def open_db_pool():
+    if db_pool is not None:
+        await db_pool.open()
+        log.info(f"[DB-Async] Pool assíncrono aberto (máx. {ASGI_DB_POOL_MAX} conexões).")
+
+
+@quart_app.before_serving
+async def start_outbox_dispatcher():
+    core.outbox_dispatcher.start()
+
+
+@quart_app.after_serving
+async def close_db_pool():
+    if db_pool is not None:
+        await db_pool.close()
+
+
+@asynccontextmanager
+async def db_cursor():
+    """Versão assíncrona do db_cursor() de elo/db.py: commit no fim, rollback se der erro."""
+    if db_pool is None:
+        raise RuntimeError("DATABASE_URL não configurada.")
+    started = time.perf_counter()
+    async with db_pool.connection() as conn:
+        core.STAGE_SECONDS.labels("db_connect").observe(time.perf_counter() - started)
+        observability.DB_POOL_IN_USE.inc()
+        try:
+            async with conn.cursor() as cur:
+                yield cur
+        finally:
+            observability.DB_POOL_IN_USE.dec()
+
+
+async def run_db_steps(cur, steps):
+    """db.run_db_steps no cursor assíncrono: os mesmos passos de banco do app Flask."""
+    rows = None
+    try:
+        while True:
+            await cur.execute(*steps.send(rows))
+            rows = await cur.fetchall() if cur.description is not None else None
+    except StopIteration as done:
+        return done.value
+
+
+@quart_app.errorhandler(PoolTimeout)
+async def handle_pool_timeout(e):
+    observability.DB_POOL_TIMEOUTS.inc()
+    core.record_error("db_pool", e)
+    log.error(f"[DB-Async] Pool saturado: {e}")
+    response = jsonify({"error": "Serviço temporariamente sobrecarregado. Tente novamente em instantes."})
+    response.headers["Retry-After"] = "1"
+    return response, 503
+
+
+class AsyncAdmissionLimiter(core.AdmissionLimiter):
+    """AdmissionLimiter de app.py com a fila de espera em asyncio (não bloqueia o event loop)."""
+
+    def __init__(self, *args):
+        super().__init__(*args)
+        self._async_cond = None
+
+    async def acquire_async(self):
+        started = time.perf_counter()
+        if self._async_cond is None:
+            self._async_cond = asyncio.Condition()
+        async with self._async_cond:
+            with self._lock:
+                self._check_gates()
+                if self._in_flight >= self.max_concurrent and self._waiting >= self.max_waiting:
+                    self._reject("rejected_queue_full", "Serviço de IA sobrecarregado. Tente novamente em instantes.",
+                                 503, self.wait_timeout)
+            if self._in_flight >= self.max_concurrent:
+                self._waiting += 1
+                core.LLM_WAITING.inc()
+                try:
+                    await asyncio.wait_for(
+                        self._async_cond.wait_for(lambda: self._in_flight < self.max_concurrent),
+                        timeout=self.wait_timeout
+                    )
+                except asyncio.TimeoutError:
+                    with self._lock:
+                        self._reject("rejected_timeout", "Serviço de IA sobrecarregado. Tente novamente em instantes.",
+                                     503, self.wait_timeout)
+                finally:
+                    self._waiting -= 1
+                    core.LLM_WAITING.dec()
+            with self._lock:
+                self._in_flight += 1
+                self._stats["admitted"] += 1
+        core.LLM_IN_FLIGHT.inc()
+        core.STAGE_SECONDS.labels("llm_wait").observe(time.perf_counter() - started)
+
+    async def release_async(self):
+        async with self._async_cond:
+            with self._lock:
+                self._in_flight -= 1
+            self._async_cond.notify()
+        core.LLM_IN_FLIGHT.dec()
+
+
+llm_limiter = AsyncAdmissionLimiter(
+    core.LLM_MAX_CONCURRENT, core.LLM_MAX_WAITING, core.LLM_WAIT_TIMEOUT,
+    core.LLM_RATE_PER_SEC, core.LLM_RATE_BURST, core.LLM_PROVIDER_COOLDOWN
+)
+
+
+@quart_app.errorhandler(core.LLMOverloadedError)
+async def handle_llm_overloaded(e):
+    core.record_error("llm_admission", e)
+    log.warning(f"[LLM] Requisição recusada ({e.status}): {e.message}")
+    response = jsonify({"error": e.message})
+    response.headers["Retry-After"] = str(e.retry_after)
+    return response, e.status
+
+
+class AsyncTailLatencyRunner(core.TailLatencyRunner):
+    """
+    TailLatencyRunner de app.py com as tentativas em tasks do asyncio (as
+    perdedoras são canceladas e devolvem a vaga na hora).
+    """
+
+    async def _attempt_async(self, make_call, variant, timeout):
+        started = time.perf_counter()
+        try:
+            return await make_call(variant, timeout)
+        except Exception as e:
+            raised = self._attempt_error(e)
+            if raised is e:
+                raise
+            raise raised from e
+        finally:
+            core.STAGE_SECONDS.labels("llm_call").observe(time.perf_counter() - started)
+            await self.limiter.release_async()
+
+    async def call_async(self, policy, make_call):
+        await self.limiter.acquire_async()  # (vaga da 1ª tentativa)
+        self._start_call()
+        started = time.monotonic()
+        deadline_at = started + policy.deadline
+        pending = policy.schedule()
+        running = {}  # task -> (tipo, início)
+        last_error = None
+        try:
+            while True:
+                now = time.monotonic()
+                for kind in self._next_attempts(policy, pending, now - started, idle=not running):
+                    variant = 'fallback' if kind == 'fallback' else 'primary'
+                    running[asyncio.ensure_future(self._attempt_async(make_call, variant, deadline_at - now))] = (kind, now)
+                if not running:
+                    break
+                done, _ = await asyncio.wait(running, timeout=self._wake_in(started, deadline_at, pending),
+                                             return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    won, result = self._settle(policy, *running.pop(task), task)
+                    if won:
+                        self._finish(policy, running, 'lost')
+                        return result
+                    last_error = result or last_error
+                if time.monotonic() >= deadline_at:
+                    break
+        finally:
+            for task in running:
+                task.cancel()
+        raise self._give_up(policy, running, last_error)
+
+
+llm_tail = AsyncTailLatencyRunner(llm_limiter, 1, core.LLM_HEDGE_BUDGET)  # (o pool de threads da versão síncrona não é usado aqui)
+
+
+@quart_app.before_request
+async def start_request():
+    g.metrics_started = time.perf_counter()
+    g.request_id = core.begin_request_log(core.incoming_request_id(request.headers))
+
+
+@quart_app.after_request
+async def add_cors_headers(response):
+    # Mesmo comportamento do CORS(app) do Flask (qualquer origem)
+    response.headers.setdefault("Access-Control-Allow-Origin", "*")
+    started = g.pop('metrics_started', None)
+    if started is not None:
+        endpoint = request.url_rule.rule if request.url_rule else 'desconhecido'
+        elapsed = time.perf_counter() - started
+        core.HTTP_REQUEST_SECONDS.labels(endpoint, request.method, response.status_code).observe(elapsed)
+        log.info("Requisição atendida", extra={"method": request.method, "endpoint": endpoint,
+                                                "status": response.status_code, "ms": round(elapsed * 1000, 1)})
+    if 'request_id' in g:
+        response.headers['X-Request-ID'] = g.request_id
+    return response
+
+
+# --- Idempotency-Key ---
+
+class AsyncIdempotencyStore(idempotency.IdempotencyStore):
+    """IdempotencyStore de elo/idempotency.py com a espera em asyncio (mesma tabela, mesmos passos de banco e mesmas regras)."""
+    new_event = asyncio.Event
+
+    async def _db_claim_async(self, key, fingerprint):
+        async with db_cursor() as cur:
+            return await run_db_steps(cur, self.claim_steps(key, fingerprint))
+
+    async def begin_async(self, key, fingerprint):
+        found = self.memory_lookup(key, fingerprint)
+        if found:
+            return found
+        leader, event = self.join_inflight(key)
+        if not leader:
+            try:
+                await asyncio.wait_for(event.wait(), idempotency.IDEMPOTENCY_WAIT_TIMEOUT)
+            except asyncio.TimeoutError:
+                pass
+            return self.memory_lookup(key, fingerprint) or self._busy()
+
+        deadline = time.monotonic() + idempotency.IDEMPOTENCY_WAIT_TIMEOUT
+        try:
+            for attempt in itertools.count():
+                claim = await self._db_claim_async(key, fingerprint)
+                found = self.claim_outcome(key, fingerprint, claim, deadline, attempt == 0)
+                if found:
+                    return found
+                await asyncio.sleep(idempotency.IDEMPOTENCY_POLL_INTERVAL)
+        except PoolTimeout:
+            self._finish(key)
+            raise
+        except Exception as e_db:
+            return self.db_unavailable(e_db)
+
+    async def _release_async(self, key, statement, failure):
+        try:
+            async with db_cursor() as cur:
+                await cur.execute(*statement)
+        except Exception as e_db:
+            log.warning(f"[Idempotência] {failure}: {e_db}")
+        finally:
+            self._finish(key)
+
+    async def complete_async(self, key, fingerprint, response):
+        await self._release_async(key, self.complete_statement(key, fingerprint, response),
+                                  "Falha ao guardar a resposta no banco")
+
+    async def abort_async(self, key):
+        await self._release_async(key, (idempotency.IDEMPOTENCY_RELEASE_SQL, (key,)), "Falha ao liberar a chave no banco")
+
+
+idempotency_store = AsyncIdempotencyStore(idempotency.IDEMPOTENCY_TTL, idempotency.IDEMPOTENCY_MEMORY_MAX)
+
+
+def idempotent(scope, lead_field):
+    """Versão assíncrona do decorator idempotent de elo/idempotency.py."""
+    def decorator(view):
+        @functools.wraps(view)
+        async def wrapper(*args, **kwargs):
+            try:
+                key = core.idempotency_key(scope, lead_field, await request.get_json(silent=True),
+                                           request.headers, await request.get_data())
+            except ValueError as e_key:
+                return jsonify({"error": str(e_key)}), 400
+            if key is None:
+                return await view(*args, **kwargs)
+
+            action, stored = await idempotency_store.begin_async(*key)
+            if action != 'run':
+                body, status, content_type, headers = idempotency.idempotency_reply(action, stored)
+                return Response(body, status=status, content_type=content_type, headers=headers)
+            try:
+                response = await quart_app.make_response(await view(*args, **kwargs))
+            except Exception:
+                await idempotency_store.abort_async(key[0])
+                raise
+            if response.status_code >= 500:
+                await idempotency_store.abort_async(key[0])
+            else:
+                body = await response.get_data(as_text=True)
+                await idempotency_store.complete_async(*key, (response.status_code, body, response.content_type))
+            return response
+        return wrapper
+    return decorator
+
+
+# --- Chat ---
+
+async def finish_chat_turn(turn, gemini_response):
+    """finish_chat_turn de app.py, com os mesmos passos de banco (chat_turn_steps) no pool assíncrono."""
+    merged = core.merge_chat_turn(turn, gemini_response)
+    # (O write-behind é o mesmo de elo/write_behind.py: a fila grava pelo pool psycopg2 numa thread)
+    deferred = core.lead_write_behind.enqueue(turn, merged)
+    if deferred and not turn['session_mode']:
+        return core.build_chat_response(merged, turn['lead_id'])
+
+    try:
+        if turn['lead_id'] and not deferred and core.lead_write_behind.enabled:
+            await asyncio.to_thread(core.lead_write_behind.discard, turn['lead_id'])
+        async with db_cursor() as cur:
+            lead_id = await run_db_steps(cur, core.chat_turn_steps(turn, merged, deferred))
+    except Exception as e_db:
+        lead_id = core.chat_turn_db_failed(turn, e_db)
+    return core.build_chat_response(merged, lead_id)
+
+
+@quart_app.route('/api/chat', methods=['POST'])
+@idempotent('chat', 'leadId')
+async def chat():
+    if not core.llm_backend.available():
+        return jsonify({"error": "Serviço de IA não está disponível."}), 503
+
+    try:
+        turn = core.parse_chat_turn(await request.get_json())
+        if core.needs_stored_history(turn):
+            try:
+                async with db_cursor() as cur:
+                    core.set_stored_history(turn, await run_db_steps(cur, core.conversation_steps(turn['lead_id'])))
+            except PoolTimeout:
+                raise
+            except Exception as e_hist:
+                raise core.stored_history_failed(turn, e_hist)
+    except core.ChatTurnError as e_turn:
+        return jsonify({"error": e_turn.message}), e_turn.status
+
+    try:
+        gemini_response = core.try_fast_path(turn)
+        if gemini_response is None:
+            core.count_llm_call()
+            contents = core.build_chat_request(turn)
+            response = await llm_tail.call_async(
+                core.LLM_POLICIES["chat"],
+                lambda variant, timeout: core.llm_backend.generate_chat_async(contents, variant=variant, timeout=timeout))
+            core.record_prompt_tokens(turn, response)
+            with core.observe_stage("json_parse"):
+                gemini_response = json.loads(response.text)
+            log.info("[Gemini] Resposta da IA", extra={"resposta": core.log_payload(gemini_response)})
+
+        return jsonify(await finish_chat_turn(turn, gemini_response))
+
+    except core.LLMOverloadedError:
+        raise
+    except Exception as e_gen:
+        core.record_error("chat", e_gen)
+        log.exception(f"[Gemini] Erro ao gerar resposta do chat: {e_gen}")
+        return jsonify({"error": "Erro ao processar a resposta da IA."}), 500
+
+
+# --- Recomendações (Isca) ---
+
+_isca_inflight = {}  # (os voos do isca_cache de app.py são threading.Event; aqui, asyncio.Future)
+
+
+async def generate_isca(ramo):
+    log.info(f"[Gemini] Gerando recomendações para o ramo: {ramo}")
+    prompt = core.build_recommendations_prompt(ramo)
+    response = await llm_tail.call_async(
+        core.LLM_POLICIES["isca"],
+        lambda variant, timeout: core.llm_backend.generate_text_async(prompt, variant=variant, timeout=timeout))
+    core.record_llm_usage("isca", response)
+    return response.text
+
+
+async def _isca_db(steps):
+    try:
+        async with db_cursor() as cur:
+            return await run_db_steps(cur, steps)
+    except Exception as e_db:
+        core.isca_cache.db_failed(e_db)
+        return None
+
+
+async def get_or_generate_isca(ramo):
+    """IscaCache.get_or_generate de app.py (mesmas camadas e contadores), com single-flight via asyncio.Future."""
+    cache = core.isca_cache
+    key = core.normalize_ramo(ramo)
+    isca = cache.cached(key)
+    if isca is not None:
+        return isca
+
+    flight = _isca_inflight.get(key)
+    if flight is not None:
+        cache.count("coalesced")
+        return await asyncio.shield(flight)
+
+    flight = _isca_inflight[key] = asyncio.get_running_loop().create_future()
+    try:
+        isca = await _isca_db(cache.db_get_steps(key))
+        if not cache.found_in_db(isca):
+            isca = await generate_isca(ramo)
+            await _isca_db(cache.db_put_steps(key, ramo, isca))
+        cache.memory_put(key, isca)
+        flight.set_result(isca)
+        return isca
+    except Exception as e:
+        flight.set_exception(e)
+        flight.exception()  # marca como lida caso ninguém esteja esperando
+        raise
+    finally:
+        _isca_inflight.pop(key, None)
+
+
+@quart_app.route('/api/generate-recommendations', methods=['POST'])
+async def generate_recommendations():
+    if not core.llm_backend.available():
+        return jsonify({"error": "Serviço de IA não está disponível."}), 503
+
+    data = await request.get_json()
+    lead_id = data.get('lead_id')
+    ramo = data.get('ramo')
+
+    if not lead_id or not ramo:
+        return jsonify({"error": "ID do Lead e Ramo são obrigatórios."}), 400
+
+    try:
+        recomendacoes_texto = await get_or_generate_isca(ramo)
+        log.info(f"[Gemini] Recomendações (Isca) prontas (ramo normalizado: '{core.normalize_ramo(ramo)}').")
+
+        try:
+            async with db_cursor() as cur:
+                await cur.execute(core.LEAD_SET_ISCA_SQL, (recomendacoes_texto, core.STATUS_AGUARDANDO_N8N, False, lead_id))
+            log.info(f"[DB] Isca salva e status atualizado para '{core.STATUS_AGUARDANDO_N8N}' no Lead ID: {lead_id}")
+        except Exception as e_db:
+            log.error(f"[DB] Erro ao ATUALIZAR lead com a isca: {e_db}")
+
+        return jsonify({"success": True, "message": "Isca gerada e salva no DB."})
+
+    except core.LLMOverloadedError:
+        raise
+    except Exception as e_gen:
+        core.record_error("generate_recommendations", e_gen)
+        log.exception(f"[Gemini] Erro ao gerar recomendações: {e_gen}")
+        return jsonify({"error": "Erro ao gerar as recomendações."}), 500
+
+
+@quart_app.route('/api/llm-stats', methods=['GET'])
+async def llm_stats():
+    denied = core.ops_denial(request.headers.get('Authorization'))
+    if denied:
+        return jsonify({"error": denied[0]}), denied[1]
+    return jsonify(dict(llm_limiter.stats(), tentativas=llm_tail.stats()))
+
+
+# --- Aplicação ASGI final ---
+# (O WsgiToAsgi do asgiref rodaria todas as rotas Flask numa única thread compartilhada)
+flask_asgi = WSGIMiddleware(core.app, workers=ASGI_WSGI_THREADS)
+
+
+async def application(scope, receive, send):
+    """Rotas de ASYNC_ROUTES -> Quart (async); todo o resto -> Flask (inclusive os preflights de CORS)."""
+    if scope['type'] == 'lifespan' or (
+        scope['type'] == 'http' and (scope['method'], scope['path']) in ASYNC_ROUTES
+    ):
+        await quart_app(scope, receive, send)
+    else:
+        await flask_asgi(scope, receive, send)
@@ -0,0 +1,133 @@
+"""
+Micro-benchmark do setup por rodada do /api/chat: antes x depois.
+
+- antes:  um GenerativeModel novo por rodada, com lead_data interpolado no
+          prompt de sistema (prompt diferente a cada rodada);
+- depois: modelo único do worker (get_chat_model) + mensagem de estado.
+
+Mede o custo de montar a chamada (sem rede) e os tokens de entrada por
+rodada: estimados localmente, ou reais com --count-tokens (precisa de
+GEMINI_API_KEY).
+
+Uso:
+    python bench/bench_chat_prompt.py [--turns 12] [--repeat 200] [--count-tokens]
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import app  # noqa: E402
+from app import genai  # noqa: E402
+
+LEGACY_SYSTEM_PROMPT = """
+    Você é o [SUA_GRÁFICA BOT], um assistente virtual amigável e proativo da [SUA_GRÁFICA BOT].
+    Seu objetivo principal é coletar os seguintes 6 dados do cliente: "nome", "empresa_ramo", "cargo", "email", "ja_e_cliente", "whatsapp".
+    
+    Estes são os dados que já temos: {lead_data}
+    
+    REGRAS DA CONVERSA:
+    1.  Converse naturalmente. Peça o próximo dado FALTANDO da lista (nome -> empresa_ramo -> cargo -> email -> ja_e_cliente -> whatsapp).
+    2.  NÃO peça por dados que já estão preenchidos na lista {lead_data}.
+    3.  Após coletar o "email", a próxima pergunta DEVE ser "Você já é cliente da [SUA_GRÁFICA BOT]? (Sim ou Não)".
+    4.  Após coletar o "ja_e_cliente", a próxima pergunta DEVE ser "Ótimo! E qual o seu WhatsApp com DDD? (para agilizar o contato)".
+    5.  Se o usuário fornecer vários dados de uma vez, capture todos.
+    
+    FORMATO DA RESPOSTA (JSON obrigatório):
+    {{
+        "botResponse": "O texto da sua resposta para o usuário.",
+        "extractedData": {{
+            "nome": "[O nome extraído ESTA RODADA]",
+            "empresa_ramo": "[O ramo extraído ESTA RODADA]",
+            "cargo": "[O cargo extraído ESTA RODADA]",
+            "email": "[O email extraído ESTA RODADA]",
+            "ja_e_cliente": "[O 'Sim' ou 'Não' extraído ESTA RODADA]",
+            "whatsapp": "[O whatsapp extraído ESTA RODADA]"
+        }}
+    }}
+    """
+
+SAMPLE_ANSWERS = [
+    ("Maria", {"nome": "Maria"}),
+    ("Tenho um restaurante", {"empresa_ramo": "Restaurante"}),
+    ("Sou a dona, cuido do marketing também", {"cargo": "Dona / Marketing"}),
+    ("maria@restaurante.com.br", {"email": "maria@restaurante.com.br"}),
+    ("Não", {"ja_e_cliente": "Não"}),
+    ("11 98765-4321", {"whatsapp": "(11) 98765-4321"}),
+]
+
+
+def build_conversation(turns):
+    history = [{'role': 'bot', 'text': "Olá! Sou o assistente de IA. Para começar, qual seu nome?"}]
+    lead_data, snapshots = {}, []
+    for i in range(turns):
+        answer, extracted = SAMPLE_ANSWERS[i % len(SAMPLE_ANSWERS)]
+        history.append({'role': 'user', 'text': answer})
+        snapshots.append((list(history), dict(lead_data)))
+        lead_data.update(extracted)
+        history.append({'role': 'bot', 'text': "Perfeito! E qual o próximo dado? " * 2})
+    return snapshots
+
+
+def legacy_setup(history, lead_data):
+    model = genai.GenerativeModel(app.CHAT_MODEL_NAME, system_instruction=LEGACY_SYSTEM_PROMPT.format(lead_data=lead_data))
+    contents = [{'role': 'user' if m['role'] == 'user' else 'model', 'parts': [{'text': m['text']}]} for m in history]
+    return model, contents, LEGACY_SYSTEM_PROMPT.format(lead_data=lead_data)
+
+
+def new_setup(history, lead_data):
+    turn = {'history': history, 'lead_id': None, 'lead_data': lead_data}
+    window, summary = app.window_history(turn)
+    return app.get_chat_model(), app.build_chat_contents(window, lead_data, summary), app.CHAT_SYSTEM_PROMPT
+
+
+def contents_text(contents):
+    return ''.join(p['text'] for c in contents for p in c['parts'])
+
+
+def measure(setup, snapshots, repeat, count_tokens):
+    timings, tokens, system_prompts = [], [], set()
+    for history, lead_data in snapshots:
+        for _ in range(repeat):
+            started = time.perf_counter()
+            setup(history, lead_data)
+            timings.append((time.perf_counter() - started) * 1e6)
+        model, contents, system_prompt = setup(history, lead_data)
+        system_prompts.add(system_prompt)
+        if count_tokens:
+            tokens.append(model.count_tokens(contents).total_tokens)
+        else:
+            tokens.append(app.estimate_tokens(system_prompt) + app.estimate_tokens(contents_text(contents)))
+    return {
+        "setup_us_p50": statistics.median(timings),
+        "setup_us_mean": statistics.fmean(timings),
+        "input_tokens_total": sum(tokens),
+        "input_tokens_last_turn": tokens[-1],
+        "distinct_system_prompts": len(system_prompts),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--turns', type=int, default=12)
+    parser.add_argument('--repeat', type=int, default=200)
+    parser.add_argument('--count-tokens', action='store_true', help="usa model.count_tokens (chamada de rede)")
+    args = parser.parse_args()
+
+    snapshots = build_conversation(args.turns)
+    results = {
+        "antes": measure(legacy_setup, snapshots, args.repeat, args.count_tokens),
+        "depois": measure(new_setup, snapshots, args.repeat, args.count_tokens),
+    }
+    kind = "reais" if args.count_tokens else "estimados"
+    print(f"{'':8} {'setup p50 (µs)':>15} {'setup média (µs)':>17} {f'tokens {kind}':>16} {'última rodada':>14} {'prompts distintos':>18}")
+    for name, r in results.items():
+        print(f"{name:8} {r['setup_us_p50']:15.1f} {r['setup_us_mean']:17.1f} {r['input_tokens_total']:16d} "
+              f"{r['input_tokens_last_turn']:14d} {r['distinct_system_prompts']:18d}")
+
+
+if __name__ == "__main__":
+    main()
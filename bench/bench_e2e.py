@@ -0,0 +1,387 @@
+"""
+Benchmark ponta a ponta: funis completos contra a API rodando local, offline.
+
+Sobe tudo localmente:
+- o Gemini é o backend stub (LLM_BACKEND=stub: JSON fixo por entrada,
+  latência --latency, opcionalmente uma fração --tail-rate de chamadas lentas);
+- o Postgres é o de DATABASE_URL (num schema descartável, --schema) ou, sem
+  ela, um cluster temporário criado com initdb/pg_ctl (precisa dos binários
+  do Postgres no PATH ou em --pg-bin);
+- o SALES_WEBHOOK_URL aponta para um servidor HTTP local que só conta os POSTs;
+- a API sobe com gunicorn (workers sync) ou uvicorn (asgi_app), --server.
+
+O banco recebe as migrações e --seed-leads leads sintéticos (+ orçamentos).
+Para cada nível de --concurrency, cada usuário virtual faz --funnels-per-user
+funis: 6 rodadas de /api/chat (modo sessão) -> /api/save-lead ->
+/api/generate-recommendations -> /api/save-quote. Sai, por nível: vazão
+(funis/s e req/s), p50/p95/p99 por endpoint, erros e consultas/checkouts do
+banco por funil (lidos do /metrics: elo_stage_duration_seconds{stage=
+"db_query"|"db_connect"}, que inclui a entrega da outbox). O resultado vai
+para um JSON em --out; com --compare <json anterior>, mostra a diferença.
+
+Uso:
+    python bench/bench_e2e.py [--concurrency 1,5,10,25] [--funnels-per-user 4] [--latency 0.2]
+                              [--server gunicorn|uvicorn] [--workers 4] [--seed-leads 100000]
+                              [--compare bench/results/e2e-anterior.json]
+"""
+import argparse
+import datetime
+import http.client
+import http.server
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import psycopg2  # noqa: E402
+from prometheus_client.parser import text_string_to_metric_families  # noqa: E402
+
+from elo import db, migrations  # noqa: E402
+from bench_query_plans import SEED_LEADS_SQL, SEED_QUOTES_SQL  # noqa: E402
+from load_test_asgi import ROOT, free_port, wait_ready  # noqa: E402
+
+ENDPOINTS = ['/api/chat', '/api/save-lead', '/api/generate-recommendations', '/api/save-quote']
+RAMOS = ['Construtora', 'Farmácia', 'Escola', 'Academia', 'Restaurante']
+CARGOS = ['Compras', 'Marketing', 'RH', 'Diretoria']
+OPS_TOKEN = uuid.uuid4().hex  # OPS_SECRET_KEY da API local (para ler o /metrics)
+
+
+# --- Stand-ins locais ---
+
+class WebhookSink:
+    """Servidor HTTP local no lugar do N8N: responde 200 e conta os POSTs."""
+
+    def __init__(self):
+        sink = self
+        self.received = 0
+        self._lock = threading.Lock()
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                with sink._lock:
+                    sink.received += 1
+                self.send_response(200)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        self._server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f"http://127.0.0.1:{self._server.server_address[1]}/"
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self._server.shutdown()
+
+
+class LocalPostgres:
+    """Cluster Postgres temporário (initdb + pg_ctl), apagado no fim."""
+
+    def __init__(self, pg_bin):
+        self.pg_bin = pg_bin
+        self.data_dir = tempfile.mkdtemp(prefix="elo-bench-pg-")
+        self.port = free_port()
+        self.url = f"postgresql://postgres@127.0.0.1:{self.port}/postgres"
+
+    def _bin(self, name):
+        return os.path.join(self.pg_bin, name) if self.pg_bin else shutil.which(name)
+
+    def start(self):
+        subprocess.run([self._bin('initdb'), '-D', self.data_dir, '-U', 'postgres', '--auth=trust'],
+                       check=True, stdout=subprocess.DEVNULL)
+        subprocess.run([self._bin('pg_ctl'), '-D', self.data_dir, '-w', '-l', os.path.join(self.data_dir, 'log'),
+                        '-o', f"-p {self.port} -c listen_addresses=127.0.0.1 -c max_connections=300", 'start'],
+                       check=True, stdout=subprocess.DEVNULL)
+
+    def stop(self):
+        subprocess.run([self._bin('pg_ctl'), '-D', self.data_dir, '-m', 'fast', 'stop'], stdout=subprocess.DEVNULL)
+        shutil.rmtree(self.data_dir, ignore_errors=True)
+
+
+def with_search_path(url, schema):
+    return url + ('&' if '?' in url else '?') + f"options=-csearch_path%3D{schema}"
+
+
+def prepare_database(url, schema, seed_leads):
+    conn = psycopg2.connect(url)
+    conn.autocommit = True
+    try:
+        with conn.cursor() as cur:
+            cur.execute(f"DROP SCHEMA IF EXISTS {schema} CASCADE; CREATE SCHEMA {schema}; SET search_path = {schema};")
+            migrations.run_migrations(conn)
+            cur.execute(SEED_LEADS_SQL, (seed_leads,))
+            cur.execute(SEED_QUOTES_SQL)
+            cur.execute("ANALYZE")
+    finally:
+        conn.close()
+
+
+def drop_schema(url, schema):
+    conn = psycopg2.connect(url)
+    conn.autocommit = True
+    try:
+        with conn.cursor() as cur:
+            cur.execute(f"DROP SCHEMA IF EXISTS {schema} CASCADE")
+    finally:
+        conn.close()
+
+
+# --- Cliente ---
+
+class FunnelClient:
+    """Um usuário virtual: uma conexão HTTP (keep-alive quando o servidor deixa) e as latências por endpoint."""
+
+    def __init__(self, port, samples):
+        self.conn = http.client.HTTPConnection('127.0.0.1', port, timeout=120)
+        self.samples = samples  # endpoint -> [(ok, segundos)]
+
+    def post(self, path, payload):
+        body = json.dumps(payload)
+        started = time.perf_counter()
+        try:
+            self.conn.request('POST', path, body=body, headers={'Content-Type': 'application/json'})
+            response = self.conn.getresponse()
+            data = response.read()
+            ok = 200 <= response.status < 300
+        except OSError:
+            self.conn.close()
+            ok, data = False, b''
+        self.samples[path].append((ok, time.perf_counter() - started))
+        if not ok:
+            raise RuntimeError(f"{path} falhou")
+        return json.loads(data) if data else {}
+
+    def funnel(self, n, run_id):
+        ramo = RAMOS[n % len(RAMOS)]
+        answers = [f"Cliente {n}", ramo, CARGOS[n % len(CARGOS)], f"cliente{n}.{run_id}@bench.local",
+                   "sim" if n % 2 else "não", f"(11) 9{(n * 7919) % 100000000:08d}"]
+        lead_id, lead_data = None, {}
+        for answer in answers:
+            result = self.post('/api/chat', {"message": answer, "leadId": lead_id, "leadData": lead_data})
+            lead_id, lead_data = result['leadId'], result['leadData']
+        self.post('/api/save-lead', {"lead_id": lead_id, "cargo": lead_data.get('cargo'),
+                                     "cnpj_fornecido": "12.345.678/0001-90", "historico_chat": []})
+        self.post('/api/generate-recommendations', {"lead_id": lead_id, "ramo": ramo})
+        self.post('/api/save-quote', {"lead_id": lead_id, "quote_data": {
+            "produto_desejado": "Caneca personalizada", "quantidade_estimada": "500", "prazo_entrega": "30 dias",
+            "tipo_de_gravacao": "Laser", "cidade_entrega": "São Paulo", "estado_entrega": "SP"}})
+
+
+def read_db_counts(port):
+    """(consultas, checkouts) acumulados no servidor, somados entre os workers."""
+    conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+    conn.request('GET', '/metrics', headers={'Authorization': f'Bearer {OPS_TOKEN}'})
+    text = conn.getresponse().read().decode('utf-8')
+    counts = {"db_query": 0.0, "db_connect": 0.0}
+    for family in text_string_to_metric_families(text):
+        if family.name != 'elo_stage_duration_seconds':
+            continue
+        for sample in family.samples:
+            if sample.name.endswith('_count') and sample.labels.get('stage') in counts:
+                counts[sample.labels['stage']] += sample.value
+    return counts["db_query"], counts["db_connect"]
+
+
+def percentiles(latencies):
+    if len(latencies) < 2:
+        value = latencies[0] * 1000 if latencies else 0.0
+        return value, value, value
+    q = statistics.quantiles(latencies, n=100)
+    return q[49] * 1000, q[94] * 1000, q[98] * 1000
+
+
+def run_step(port, concurrency, funnels_per_user, run_id, first_funnel):
+    samples = {path: [] for path in ENDPOINTS}
+    queries_before, checkouts_before = read_db_counts(port)
+    failed = 0
+
+    def user(u):
+        client = FunnelClient(port, {path: [] for path in ENDPOINTS})
+        failures = 0
+        for i in range(funnels_per_user):
+            try:
+                client.funnel(first_funnel + u * funnels_per_user + i, run_id)
+            except (RuntimeError, KeyError, ValueError):
+                failures += 1
+        return client.samples, failures
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for user_samples, failures in pool.map(user, range(concurrency)):
+            failed += failures
+            for path, values in user_samples.items():
+                samples[path].extend(values)
+    elapsed = time.perf_counter() - started
+    queries_after, checkouts_after = read_db_counts(port)
+
+    total = concurrency * funnels_per_user
+    completed = total - failed
+    requests_ok = sum(ok for values in samples.values() for ok, _ in values)
+    endpoints = {}
+    for path, values in samples.items():
+        p50, p95, p99 = percentiles(sorted(s for ok, s in values if ok))
+        endpoints[path] = {"requests": len(values), "errors": sum(not ok for ok, _ in values),
+                           "p50_ms": round(p50, 1), "p95_ms": round(p95, 1), "p99_ms": round(p99, 1)}
+    return {
+        "concurrency": concurrency,
+        "funnels": completed,
+        "funnel_errors": failed,
+        "elapsed_s": round(elapsed, 2),
+        "funnels_per_s": round(completed / elapsed, 2),
+        "requests_per_s": round(requests_ok / elapsed, 1),
+        "db_queries_per_funnel": round((queries_after - queries_before) / max(completed, 1), 1),
+        "db_checkouts_per_funnel": round((checkouts_after - checkouts_before) / max(completed, 1), 1),
+        "endpoints": endpoints,
+    }
+
+
+# --- Relatório ---
+
+def print_step(step):
+    print(f"\nconcorrência {step['concurrency']}: {step['funnels']} funis ({step['funnel_errors']} com erro) em "
+          f"{step['elapsed_s']}s | {step['funnels_per_s']} funis/s, {step['requests_per_s']} req/s | banco por funil: "
+          f"{step['db_queries_per_funnel']} consultas, {step['db_checkouts_per_funnel']} checkouts")
+    print(f"  {'endpoint':32} {'req':>6} {'erros':>6} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    for path, e in step['endpoints'].items():
+        print(f"  {path:32} {e['requests']:6d} {e['errors']:6d} {e['p50_ms']:9.1f} {e['p95_ms']:9.1f} {e['p99_ms']:9.1f}")
+
+
+def _delta(new, old):
+    return f"{(new - old) / old * 100:+.1f}%" if old else "n/a"
+
+
+def print_comparison(result, baseline):
+    print(f"\nComparação com {baseline['meta'].get('commit', '?')} ({baseline['meta'].get('started_at', '?')}):")
+    old_steps = {s['concurrency']: s for s in baseline['steps']}
+    for step in result['steps']:
+        old = old_steps.get(step['concurrency'])
+        if old is None:
+            continue
+        print(f"  concorrência {step['concurrency']}: funis/s {_delta(step['funnels_per_s'], old['funnels_per_s'])}, "
+              f"consultas/funil {step['db_queries_per_funnel']} (era {old['db_queries_per_funnel']})")
+        for path, e in step['endpoints'].items():
+            o = old['endpoints'].get(path)
+            if o:
+                print(f"    {path:32} p50 {_delta(e['p50_ms'], o['p50_ms']):>8}  p95 {_delta(e['p95_ms'], o['p95_ms']):>8}  "
+                      f"p99 {_delta(e['p99_ms'], o['p99_ms']):>8}")
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def server_command(args, port):
+    if args.server == 'uvicorn':
+        return [sys.executable, '-m', 'uvicorn', '--port', str(port), '--log-level', 'warning', 'asgi_app:application']
+    return [sys.executable, '-m', 'gunicorn', '-w', str(args.workers), '--timeout', '120',
+            '-b', f'127.0.0.1:{port}', 'app:app']
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--concurrency', default='1,5,10,25', help="níveis de concorrência, separados por vírgula")
+    parser.add_argument('--funnels-per-user', type=int, default=4)
+    parser.add_argument('--latency', type=float, default=0.2, help="latência do modelo stub (s)")
+    parser.add_argument('--tail-rate', type=float, default=0.0, help="fração de chamadas lentas do stub")
+    parser.add_argument('--tail-latency', type=float, default=5.0)
+    parser.add_argument('--server', choices=['gunicorn', 'uvicorn'], default='gunicorn')
+    parser.add_argument('--workers', type=int, default=4, help="workers do gunicorn")
+    parser.add_argument('--seed-leads', type=int, default=100_000)
+    parser.add_argument('--schema', default='bench_e2e')
+    parser.add_argument('--pg-bin', help="diretório do initdb/pg_ctl (sem DATABASE_URL)")
+    parser.add_argument('--out', help="JSON de saída (padrão: bench/results/e2e-<data>.json)")
+    parser.add_argument('--compare', help="JSON de uma execução anterior")
+    parser.add_argument('--keep', action='store_true', help="não apaga o schema no fim")
+    args = parser.parse_args()
+    levels = [int(c) for c in args.concurrency.split(',')]
+
+    local_pg = None
+    base_url = db.DATABASE_URL
+    if not base_url:
+        if not (args.pg_bin or shutil.which('initdb')):
+            sys.exit("Sem DATABASE_URL e sem initdb/pg_ctl (use --pg-bin): não há Postgres para o benchmark.")
+        local_pg = LocalPostgres(args.pg_bin)
+        local_pg.start()
+        base_url = local_pg.url
+
+    sink = WebhookSink()
+    metrics_dir = tempfile.mkdtemp(prefix="elo-bench-metrics-")
+    port = free_port()
+    proc = None
+    started_at = datetime.datetime.now().isoformat(timespec='seconds')
+    try:
+        print(f"Preparando o banco (schema '{args.schema}', {args.seed_leads} leads sintéticos)...")
+        prepare_database(base_url, args.schema, args.seed_leads)
+
+        env = dict(os.environ, DATABASE_URL=with_search_path(base_url, args.schema), DB_MIGRATE_ON_START='0',
+                   LLM_BACKEND='stub', LLM_STUB_LATENCY=str(args.latency), LLM_STUB_TAIL_RATE=str(args.tail_rate),
+                   LLM_STUB_TAIL_LATENCY=str(args.tail_latency), SALES_WEBHOOK_URL=sink.url,
+                   OUTBOX_DISPATCHER_MODE='thread', PROMETHEUS_MULTIPROC_DIR=metrics_dir, LOG_LEVEL='WARNING',
+                   OPS_SECRET_KEY=OPS_TOKEN,
+                   LLM_MAX_CONCURRENT=str(max(levels) * 2), LLM_MAX_WAITING=str(max(levels) * 4))
+        proc = subprocess.Popen(server_command(args, port), cwd=ROOT, env=env,
+                                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        wait_ready(port)
+        print(f"API ({args.server}) em 127.0.0.1:{port}, modelo stub de {args.latency}s, webhook em {sink.url}")
+
+        run_id = uuid.uuid4().hex[:8]
+        steps, next_funnel = [], 0
+        for concurrency in levels:
+            step = run_step(port, concurrency, args.funnels_per_user, run_id, next_funnel)
+            next_funnel += concurrency * args.funnels_per_user
+            steps.append(step)
+            print_step(step)
+
+        quotes = sum(s['endpoints']['/api/save-quote']['requests'] - s['endpoints']['/api/save-quote']['errors']
+                     for s in steps)
+        deadline = time.monotonic() + 30
+        while sink.received < quotes and time.monotonic() < deadline:
+            time.sleep(0.5)
+        print(f"\nWebhooks entregues ao sink: {sink.received} de {quotes} orçamentos.")
+
+        result = {
+            "meta": {"commit": git_commit(), "command": ' '.join(['python', 'bench/bench_e2e.py'] + sys.argv[1:]),
+                     "started_at": started_at, "server": args.server,
+                     "workers": args.workers, "latency_s": args.latency, "tail_rate": args.tail_rate,
+                     "funnels_per_user": args.funnels_per_user, "seed_leads": args.seed_leads,
+                     "webhooks_delivered": sink.received, "quotes": quotes},
+            "steps": steps,
+        }
+        out = args.out or os.path.join(ROOT, 'bench', 'results', f"e2e-{started_at.replace(':', '')}.json")
+        os.makedirs(os.path.dirname(os.path.abspath(out)), exist_ok=True)
+        with open(out, 'w', encoding='utf-8') as f:
+            json.dump(result, f, indent=2, ensure_ascii=False)
+        print(f"Resultado salvo em {out}")
+
+        if args.compare:
+            with open(args.compare, encoding='utf-8') as f:
+                print_comparison(result, json.load(f))
+    finally:
+        if proc is not None:
+            proc.terminate()
+            proc.wait(timeout=30)
+        sink.close()
+        shutil.rmtree(metrics_dir, ignore_errors=True)
+        if local_pg is not None:
+            local_pg.stop()
+        elif not args.keep:
+            drop_schema(base_url, args.schema)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+"""
+Benchmark de planos de consulta: antes x depois das migrações de índices.
+
+Cria um schema descartável (--schema, padrão 'bench_plans') no banco de
+DATABASE_URL, aplica as migrações v1-v2 (tabelas base + merged_into), gera
+--leads leads sintéticos (+ orçamentos para ~1/3 deles) direto no Postgres
+com generate_series, roda EXPLAIN (ANALYZE, BUFFERS) nas consultas quentes, aplica
+as migrações seguintes (índices) e repete. No fim imprime o tipo de plano e
+o tempo de cada consulta e apaga o schema (a não ser com --keep). Use um
+banco de testes: são ~1 GB com 1M de leads.
+
+Uso:
+    DATABASE_URL=postgres://... python bench/bench_query_plans.py [--leads 1000000] [--repeat 5] [--keep]
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import psycopg2  # noqa: E402
+
+import app as core  # noqa: E402
+from elo import db, dedup, migrations  # noqa: E402
+
+SEED_LEADS_SQL = """
+INSERT INTO elo_leads (created_at, nome, email, empresa_ramo, cargo, whatsapp, status, status_lead)
+SELECT NOW() - (g %% 365) * INTERVAL '1 day',
+       'Lead ' || g,
+       'lead' || g || '@empresa' || (g %% 5000) || '.com.br',
+       (ARRAY['Construtora', 'Farmácia', 'Escola', 'Academia', 'Restaurante'])[1 + g %% 5],
+       (ARRAY['Compras', 'Marketing', 'RH', 'Diretoria'])[1 + g %% 4],
+       '+55 11 9' || lpad((g %% 100000000)::text, 8, '0'),
+       CASE WHEN g %% 50 = 0 THEN 'Aguardando Envio N8N'
+            WHEN g %% 10 = 0 THEN 'Email Enviado'
+            ELSE 'Novo' END,
+       CASE WHEN g %% 7 = 0 THEN 'Quente' ELSE 'Frio' END
+FROM generate_series(1, %s) AS g;
+"""
+SEED_QUOTES_SQL = """
+INSERT INTO elo_orçar (produto_desejado, quantidade_estimada, cidade_entrega, estado_entrega, lead_id)
+SELECT 'Caneca personalizada', '500', 'São Paulo', 'SP', id
+FROM elo_leads WHERE id % 3 = 0;
+"""
+
+# (nome, SQL, parâmetros): as consultas que os endpoints fazem (ou vão fazer).
+HOT_QUERIES = [
+    ("orçamentos do lead", "SELECT * FROM elo_orçar WHERE lead_id = %s", (123456,)),
+    ("lead por contato (dedup do chat)", dedup.FIND_LEAD_BY_CONTACT_SQL,
+     {"lead_id": 0, "email": "Lead123456@empresa3456.com.br ", "whatsapp": "(11) 90012-3456"}),
+    ("página por status", "SELECT id FROM elo_leads WHERE status = %s AND id > %s ORDER BY id LIMIT 100",
+     ("Email Enviado", 500000)),
+    ("fila do N8N", "SELECT id FROM elo_leads WHERE status = %s AND id > %s ORDER BY id LIMIT 100",
+     (core.STATUS_AGUARDANDO_N8N, 0)),
+]
+
+
+def plan_summary(cur, sql, params, repeat):
+    """Devolve (nós do plano, mediana do tempo de execução em ms)."""
+    timings = []
+    for _ in range(repeat):
+        cur.execute("EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) " + sql, params)
+        plan = cur.fetchone()[0][0]
+        timings.append(plan["Execution Time"])
+    nodes = []
+    stack = [plan["Plan"]]
+    while stack:
+        node = stack.pop()
+        label = node["Node Type"]
+        if node.get("Index Name"):
+            label += f" ({node['Index Name']})"
+        nodes.append(label)
+        stack.extend(reversed(node.get("Plans", [])))
+    return " > ".join(nodes), statistics.median(timings)
+
+
+def run_plans(cur, repeat):
+    cur.execute("ANALYZE elo_leads; ANALYZE elo_orçar;")
+    return {name: plan_summary(cur, sql, params, repeat) for name, sql, params in HOT_QUERIES}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--leads', type=int, default=1_000_000)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--schema', default='bench_plans')
+    parser.add_argument('--keep', action='store_true', help="não apaga o schema no fim")
+    args = parser.parse_args()
+
+    if not db.DATABASE_URL:
+        sys.exit("DATABASE_URL não configurada.")
+
+    conn = psycopg2.connect(db.DATABASE_URL, options=f"-c search_path={args.schema}")
+    conn.autocommit = True
+    cur = conn.cursor()
+    try:
+        cur.execute(f"DROP SCHEMA IF EXISTS {args.schema} CASCADE; CREATE SCHEMA {args.schema};")
+        migrations.run_migrations(conn, upto=2)  # (tabelas base + merged_into, sem os índices da v3)
+
+        started = time.monotonic()
+        cur.execute(SEED_LEADS_SQL, (args.leads,))
+        cur.execute(SEED_QUOTES_SQL)
+        print(f"{args.leads} leads sintéticos gerados em {time.monotonic() - started:.1f}s")
+
+        before = run_plans(cur, args.repeat)
+        started = time.monotonic()
+        migrations.run_migrations(conn)
+        print(f"Migrações de índices aplicadas em {time.monotonic() - started:.1f}s\n")
+        after = run_plans(cur, args.repeat)
+
+        for name, _, _ in HOT_QUERIES:
+            (plan_before, ms_before), (plan_after, ms_after) = before[name], after[name]
+            print(f"{name}")
+            print(f"  antes : {ms_before:9.2f} ms  {plan_before}")
+            print(f"  depois: {ms_after:9.2f} ms  {plan_after}")
+    finally:
+        if not args.keep:
+            cur.execute(f"DROP SCHEMA IF EXISTS {args.schema} CASCADE")
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+"""
+Load test: gunicorn (workers sync) x uvicorn (asgi_app) com o Gemini stubado.
+
+Sobe os dois servidores em portas locais com LLM_BACKEND=stub (modelo local
+que demora LLM_STUB_LATENCY segundos), dispara --requests POSTs em
+/api/chat com --concurrency clientes simultâneos e compara vazão e
+latência. Precisa de gunicorn e uvicorn instalados; o Postgres é opcional
+(sem DATABASE_URL as escritas falham rápido e a resposta sai igual).
+
+Uso:
+    python bench/load_test_asgi.py [--concurrency 200] [--requests 400] [--latency 2] [--sync-workers 4]
+"""
+import argparse
+import http.client
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+PAYLOAD = json.dumps({
+    "conversationHistory": [{"role": "user", "text": "Oi, meu nome é Teste e quero orçar uns brindes"}],
+    "leadData": {},
+    "leadId": None,
+})
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def wait_ready(port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=1)
+            conn.request('GET', '/')
+            if conn.getresponse().status == 200:
+                return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError(f"Servidor na porta {port} não subiu.")
+
+
+def one_request(port):
+    started = time.perf_counter()
+    try:
+        conn = http.client.HTTPConnection('127.0.0.1', port, timeout=120)
+        conn.request('POST', '/api/chat', body=PAYLOAD, headers={'Content-Type': 'application/json'})
+        status = conn.getresponse().status
+    except OSError:
+        status = 0
+    return status, time.perf_counter() - started
+
+
+def run_load(port, total, concurrency):
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(lambda _: one_request(port), range(total)))
+    elapsed = time.perf_counter() - started
+    latencies = sorted(r[1] for r in results if r[0] == 200)
+    q = statistics.quantiles(latencies, n=100) if len(latencies) > 1 else latencies * 99
+    return {
+        "ok": len(latencies),
+        "errors": total - len(latencies),
+        "elapsed_s": elapsed,
+        "rps": len(latencies) / elapsed,
+        "p50_s": q[49] if q else 0,
+        "p95_s": q[94] if q else 0,
+    }
+
+
+def serve(cmd, port, env):
+    proc = subprocess.Popen(cmd, cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_ready(port)
+    except Exception:
+        proc.kill()
+        raise
+    return proc
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--concurrency', type=int, default=200)
+    parser.add_argument('--requests', type=int, default=400)
+    parser.add_argument('--latency', type=float, default=2.0, help="latência do modelo stub (s)")
+    parser.add_argument('--sync-workers', type=int, default=4)
+    args = parser.parse_args()
+
+    env = dict(os.environ, LLM_BACKEND='stub', LLM_STUB_LATENCY=str(args.latency), OUTBOX_DISPATCHER_MODE='worker',
+               # (o limitador fica largo: aqui se mede o modelo de concorrência, não o controle de admissão)
+               LLM_MAX_CONCURRENT=str(args.concurrency), LLM_MAX_WAITING=str(args.requests))
+    modes = {
+        f"gunicorn sync x{args.sync_workers}": lambda port: [
+            sys.executable, '-m', 'gunicorn', '-w', str(args.sync_workers), '--timeout', '600',
+            '-b', f'127.0.0.1:{port}', 'app:app'],
+        "uvicorn asgi x1": lambda port: [
+            sys.executable, '-m', 'uvicorn', '--port', str(port), '--log-level', 'warning',
+            'asgi_app:application'],
+    }
+
+    print(f"{args.requests} requisições, {args.concurrency} simultâneas, modelo stub de {args.latency}s\n")
+    print(f"{'modo':22} {'ok':>5} {'erros':>6} {'req/s':>8} {'p50 (s)':>8} {'p95 (s)':>8}")
+    for name, cmd in modes.items():
+        port = free_port()
+        proc = serve(cmd(port), port, env)
+        try:
+            r = run_load(port, args.requests, args.concurrency)
+        finally:
+            proc.terminate()
+            proc.wait(timeout=30)
+        print(f"{name:22} {r['ok']:5d} {r['errors']:6d} {r['rps']:8.1f} {r['p50_s']:8.2f} {r['p95_s']:8.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,31 @@
+"""
+Gera widget/dist a partir de widget/src: assets com hash no nome, páginas
+apontando para eles, versões .br/.gz pré-comprimidas e o manifest.json.
+
+Uso (no passo de build do deploy, depois do pip install):
+    python build_static.py [--dist widget/dist]
+"""
+import os
+
+from cli import parser, report
+
+from elo.widget import WIDGET_DIST_DIR, WIDGET_ENCODINGS, WIDGET_SRC_DIR, build_widget
+
+
+def file_sizes(dist_dir, manifest):
+    """nome -> {'bytes': ..., 'br': ..., 'gzip': ...} de cada arquivo gerado."""
+    sizes = {}
+    for name, meta in sorted(manifest["files"].items()):
+        sizes[name] = {"bytes": os.path.getsize(os.path.join(dist_dir, name))}
+        sizes[name].update({enc: os.path.getsize(os.path.join(dist_dir, name + suffix))
+                            for enc, suffix in WIDGET_ENCODINGS if enc in meta["encodings"]})
+    return sizes
+
+
+if __name__ == "__main__":
+    arg_parser = parser(__doc__)
+    arg_parser.add_argument('--src', default=WIDGET_SRC_DIR)
+    arg_parser.add_argument('--dist', default=WIDGET_DIST_DIR)
+    args = arg_parser.parse_args()
+    manifest = build_widget(args.src, args.dist)
+    report("[Widget] Tamanhos do build.", file_sizes(args.dist, manifest))
@@ -0,0 +1,26 @@
+"""
+Base comum dos scripts de operação (rescore_leads.py, merge_leads.py, build_static.py).
+
+Os resultados saem pelo mesmo logger JSON da API (nível em LOG_LEVEL), em
+vez de print.
+"""
+import argparse
+import sys
+
+from elo.db import DATABASE_URL
+from elo.observability import log
+
+
+def parser(doc):
+    """ArgumentParser que mostra a docstring do script no --help."""
+    return argparse.ArgumentParser(description=doc, formatter_class=argparse.RawDescriptionHelpFormatter)
+
+
+def require_database():
+    if not DATABASE_URL:
+        sys.exit("DATABASE_URL não configurada.")
+
+
+def report(message, result):
+    """Loga o resultado do script (o dict vai inteiro em 'resultado')."""
+    log.info(message, extra={"resultado": result})
@@ -0,0 +1,10 @@
+"""
+Módulos de infraestrutura da API [SUA_GRÁFICA BOT] (o app Flask e as rotas
+ficam em app.py; o modo ASGI em asgi_app.py).
+
+A configuração vem de variáveis de ambiente lidas no import de cada módulo,
+então o .env é carregado aqui, antes de qualquer um deles.
+"""
+from dotenv import load_dotenv
+
+load_dotenv()
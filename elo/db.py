@@ -0,0 +1,192 @@
+"""Pool de conexões do PostgreSQL (psycopg2) e execução dos passos de banco."""
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import psycopg2
+import psycopg2.extensions
+import psycopg2.pool
+
+from elo.observability import DB_POOL_IN_USE, DB_POOL_TIMEOUTS, STAGE_SECONDS
+
+DATABASE_URL = os.environ.get("DATABASE_URL")
+
+# --- Pool de Conexões do PostgreSQL ---
+# Cada endpoint abria (e fechava) uma conexão nova: TCP + TLS + auth custava
+# mais que as próprias queries. Agora todos pegam emprestado deste pool.
+DB_POOL_MIN = int(os.environ.get("DB_POOL_MIN", 1))
+DB_POOL_MAX = int(os.environ.get("DB_POOL_MAX", 10))
+DB_POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", 5))  # segundos esperando uma conexão livre
+DB_POOL_HEALTHCHECK_IDLE = float(os.environ.get("DB_POOL_HEALTHCHECK_IDLE", 30))  # testa conexões paradas há mais que isso
+
+# Chaves de pg_advisory_lock (uma por operação que só pode rodar num processo por vez)
+DB_MIGRATIONS_LOCK_KEY = 72_614_001
+MERGE_LEADS_LOCK_KEY = DB_MIGRATIONS_LOCK_KEY + 1
+
+
+class PoolTimeoutError(Exception):
+    """Nenhuma conexão ficou livre dentro de DB_POOL_TIMEOUT (pool saturado)."""
+
+
+class DatabasePool:
+    """
+    Pool de conexões limitado, compartilhado por todas as threads do processo.
+
+    - No máximo `maxconn` conexões abertas; quem passar disso espera até
+      `timeout` segundos e recebe PoolTimeoutError (vira 503 na API).
+    - Conexões paradas há mais de `healthcheck_idle` segundos são testadas
+      com SELECT 1 antes de serem entregues; as quebradas são descartadas.
+    - O pool real só é criado no primeiro uso (seguro com o fork do gunicorn).
+    """
+
+    def __init__(self, dsn, minconn, maxconn, timeout, healthcheck_idle):
+        self.dsn = dsn
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.healthcheck_idle = healthcheck_idle
+        self._pool = None
+        self._pool_lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(maxconn)
+        self._stats_lock = threading.Lock()
+        self._last_used = {}
+        self._in_use = 0
+        self._stats = {"checkouts": 0, "timeouts": 0, "discarded": 0, "healthchecks": 0, "wait_seconds_total": 0.0}
+
+    def _get_pool(self):
+        if self._pool is None:
+            with self._pool_lock:
+                if self._pool is None:
+                    if not self.dsn:
+                        raise psycopg2.OperationalError("DATABASE_URL não configurada.")
+                    self._pool = psycopg2.pool.ThreadedConnectionPool(self.minconn, self.maxconn, self.dsn)
+        return self._pool
+
+    def _is_alive(self, conn):
+        with self._stats_lock:
+            self._stats["healthchecks"] += 1
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def getconn(self):
+        started = time.monotonic()
+        if not self._slots.acquire(timeout=self.timeout):
+            with self._stats_lock:
+                self._stats["timeouts"] += 1
+            DB_POOL_TIMEOUTS.inc()
+            raise PoolTimeoutError(f"Nenhuma conexão livre em {self.timeout}s (máx. {self.maxconn}).")
+        try:
+            pool = self._get_pool()
+            conn = pool.getconn()
+            last_used = self._last_used.get(id(conn))
+            stale = last_used is not None and time.monotonic() - last_used > self.healthcheck_idle
+            if conn.closed or (stale and not self._is_alive(conn)):
+                pool.putconn(conn, close=True)
+                with self._stats_lock:
+                    self._stats["discarded"] += 1
+                conn = pool.getconn()
+        except Exception:
+            self._slots.release()
+            raise
+        elapsed = time.monotonic() - started
+        with self._stats_lock:
+            self._in_use += 1
+            self._stats["checkouts"] += 1
+            self._stats["wait_seconds_total"] += elapsed
+        STAGE_SECONDS.labels("db_connect").observe(elapsed)
+        DB_POOL_IN_USE.inc()
+        return conn
+
+    def putconn(self, conn, discard=False):
+        discard = discard or bool(conn.closed)
+        try:
+            self._get_pool().putconn(conn, close=discard)
+        finally:
+            if discard:
+                self._last_used.pop(id(conn), None)
+            else:
+                self._last_used[id(conn)] = time.monotonic()
+            with self._stats_lock:
+                self._in_use -= 1
+                if discard:
+                    self._stats["discarded"] += 1
+            DB_POOL_IN_USE.dec()
+            self._slots.release()
+
+    def stats(self):
+        with self._stats_lock:
+            stats = dict(self._stats)
+            stats["in_use"] = self._in_use
+        stats["max_size"] = self.maxconn
+        stats["idle"] = len(self._pool._pool) if self._pool is not None else 0
+        stats["open"] = stats["idle"] + stats["in_use"]
+        stats["wait_seconds_total"] = round(stats["wait_seconds_total"], 4)
+        return stats
+
+    def closeall(self):
+        if self._pool is not None:
+            self._pool.closeall()
+
+
+db_pool = DatabasePool(DATABASE_URL, DB_POOL_MIN, DB_POOL_MAX, DB_POOL_TIMEOUT, DB_POOL_HEALTHCHECK_IDLE)
+
+
+class TimedCursor(psycopg2.extensions.cursor):
+    """Cursor que registra o tempo de cada execute no estágio 'db_query'."""
+
+    def execute(self, query, vars=None):
+        started = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            STAGE_SECONDS.labels("db_query").observe(time.perf_counter() - started)
+
+
+@contextmanager
+def db_cursor():
+    """
+    Empresta uma conexão do pool e entrega um cursor.
+    Faz commit se o bloco terminar bem, rollback se der erro, e sempre
+    devolve a conexão (descartando-a se ela quebrou no meio do caminho).
+    """
+    conn = db_pool.getconn()
+    discard = False
+    try:
+        cur = conn.cursor(cursor_factory=TimedCursor)
+        try:
+            yield cur
+            conn.commit()
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            discard = True
+            raise
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            if not cur.closed:
+                cur.close()
+    finally:
+        db_pool.putconn(conn, discard=discard)
+
+
+def run_db_steps(cur, steps):
+    """
+    Executa no cursor um gerador de passos de banco. Cada passo é um
+    (sql, params); o gerador recebe de volta as linhas do execute (None se
+    o comando não devolve linhas) e o seu `return` é o valor final. Assim o
+    SQL e as decisões de uma operação ficam num lugar só, sem I/O, e o
+    asgi_app.run_db_steps executa os mesmos passos no cursor assíncrono.
+    """
+    rows = None
+    try:
+        while True:
+            cur.execute(*steps.send(rows))
+            rows = cur.fetchall() if cur.description is not None else None
+    except StopIteration as done:
+        return done.value
@@ -0,0 +1,179 @@
+"""Deduplicação de leads por email/WhatsApp normalizados."""
+import os
+import re
+import time
+
+import psycopg2.extras
+
+from elo.db import MERGE_LEADS_LOCK_KEY, db_cursor
+from elo.observability import log
+
+# --- Deduplicação de Leads por Contato ---
+# Sem a trava UNIQUE do email, cada sessão nova sem leadId cria um lead. As
+# chaves normalizadas abaixo (email sem caixa/espaços; WhatsApp só com
+# dígitos e sem o 55) têm índices de expressão. Quando o chat captura um
+# email/WhatsApp que já pertence a outro lead, o lead da sessão só ganha
+# merged_into apontando para o canônico: a sessão continua com o próprio
+# leadId e o próprio histórico (entregar o id do canônico a quem digitou o
+# contato vazaria a conversa do dono e sobrescreveria o historico_chat dele).
+# O `python merge_leads.py` junta os grupos depois e apaga os duplicados.
+LEAD_EMAIL_KEY_SQL = "lower(btrim({}))"
+LEAD_WHATSAPP_KEY_SQL = r"regexp_replace(regexp_replace({}, '\D', '', 'g'), '^55(\d{{10,11}})$', '\1')"
+MERGE_LEADS_SCAN_CHUNK = int(os.environ.get("MERGE_LEADS_SCAN_CHUNK", 20000))
+MERGE_LEADS_INSERT_PAGE = int(os.environ.get("MERGE_LEADS_INSERT_PAGE", 5000))
+
+ADD_MERGED_INTO_SQL = "ALTER TABLE elo_leads ADD COLUMN IF NOT EXISTS merged_into INTEGER REFERENCES elo_leads(id);"
+CREATE_CONTACT_KEY_INDEXES_SQL = [
+    f"CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_elo_leads_email_key ON elo_leads ({LEAD_EMAIL_KEY_SQL.format('email')}) "
+    "WHERE merged_into IS NULL",
+    f"CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_elo_leads_whatsapp_key ON elo_leads ({LEAD_WHATSAPP_KEY_SQL.format('whatsapp')}) "
+    "WHERE merged_into IS NULL",
+]
+
+# (O parâmetro passa pela MESMA expressão da coluna, então o índice é usado)
+FIND_LEAD_BY_CONTACT_SQL = f"""
+SELECT id FROM elo_leads
+WHERE merged_into IS NULL AND id <> %(lead_id)s AND (
+    {LEAD_EMAIL_KEY_SQL.format('email')} = {LEAD_EMAIL_KEY_SQL.format('%(email)s')}
+    OR {LEAD_WHATSAPP_KEY_SQL.format('whatsapp')} = {LEAD_WHATSAPP_KEY_SQL.format('%(whatsapp)s')}
+)
+ORDER BY id
+LIMIT 1;
+"""
+LINK_KNOWN_CONTACT_SQL = "UPDATE elo_leads SET merged_into = %s WHERE id = %s AND merged_into IS NULL"
+
+
+def new_contact_params(turn, merged):
+    """Email/WhatsApp capturados NESTA rodada (parâmetros do FIND_LEAD_BY_CONTACT_SQL), ou None."""
+    previous, current = turn['lead_data'], merged['new_lead_data']
+    contact = {field: current.get(field) if current.get(field) != previous.get(field) else None
+               for field in ('email', 'whatsapp')}
+    # (Valores que virariam chave vazia casariam com qualquer outro lead sem contato)
+    if contact['email'] and '@' not in str(contact['email']):
+        contact['email'] = None
+    if contact['whatsapp'] and len(re.sub(r'\D', '', str(contact['whatsapp']))) < 8:
+        contact['whatsapp'] = None
+    if not any(contact.values()):
+        return None
+    return dict(contact, lead_id=turn['lead_id'] or 0)
+
+
+def link_known_contact_steps(lead_id, turn, merged):
+    """
+    Passos de banco (ver run_db_steps): se a rodada trouxe um email/WhatsApp
+    de outro lead, marca o lead da sessão (já gravado) com merged_into =
+    canônico. Devolve o id canônico ou None.
+    """
+    params = new_contact_params(turn, merged)
+    if params is None:
+        return None
+    rows = yield FIND_LEAD_BY_CONTACT_SQL, dict(params, lead_id=lead_id)
+    if not rows:
+        return None
+    canonical_id = rows[0][0]
+    yield LINK_KNOWN_CONTACT_SQL, (canonical_id, lead_id)
+    log.info(f"[Dedup] Contato já conhecido: Lead ID {lead_id} marcado como duplicado do {canonical_id}.")
+    return canonical_id
+
+
+class _LeadUnion:
+    """Union-find por id; a raiz de cada grupo é sempre o MENOR id (o lead mais antigo)."""
+
+    def __init__(self):
+        self.parent = {}
+
+    def find(self, x):
+        root = x
+        while self.parent.get(root, root) != root:
+            root = self.parent[root]
+        while self.parent.get(x, x) != root:
+            self.parent[x], x = root, self.parent[x]
+        return root
+
+    def union(self, a, b):
+        ra, rb = self.find(a), self.find(b)
+        if ra != rb:
+            self.parent[max(ra, rb)] = min(ra, rb)
+
+
+MERGE_SCAN_SQL = f"""
+SELECT id, {LEAD_EMAIL_KEY_SQL.format('email')}, {LEAD_WHATSAPP_KEY_SQL.format('whatsapp')}, merged_into
+FROM elo_leads
+WHERE id > %s AND (email IS NOT NULL OR whatsapp IS NOT NULL OR merged_into IS NOT NULL)
+ORDER BY id LIMIT %s
+"""
+MERGE_FILL_CANONICAL_SQL = """
+UPDATE elo_leads AS c SET
+    nome = COALESCE(c.nome, d.nome),
+    email = COALESCE(c.email, d.email),
+    empresa_ramo = COALESCE(c.empresa_ramo, d.empresa_ramo),
+    cargo = COALESCE(c.cargo, d.cargo),
+    cnpj_fornecido = COALESCE(c.cnpj_fornecido, d.cnpj_fornecido),
+    ja_e_cliente = COALESCE(c.ja_e_cliente, d.ja_e_cliente),
+    whatsapp = COALESCE(c.whatsapp, d.whatsapp),
+    isca = COALESCE(c.isca, d.isca),
+    recomendacoes_ia = COALESCE(c.recomendacoes_ia, d.recomendacoes_ia),
+    historico_chat = COALESCE(c.historico_chat, d.historico_chat),
+    status_lead = CASE WHEN d.algum_quente THEN 'Quente' ELSE c.status_lead END
+FROM (
+    SELECT DISTINCT ON (m.canonical_id) m.canonical_id, l.*,
+           bool_or(l.status_lead = 'Quente') OVER (PARTITION BY m.canonical_id) AS algum_quente
+    FROM lead_merge_map m JOIN elo_leads l ON l.id = m.dup_id
+    ORDER BY m.canonical_id, m.dup_id DESC
+) AS d
+WHERE c.id = d.canonical_id;
+"""
+MERGE_APPLY_SQL = [
+    ("orcamentos", "UPDATE elo_orçar AS o SET lead_id = m.canonical_id FROM lead_merge_map m WHERE o.lead_id = m.dup_id"),
+    ("mensagens", "UPDATE elo_chat_messages AS c SET lead_id = m.canonical_id FROM lead_merge_map m WHERE c.lead_id = m.dup_id"),
+    ("canonicos", "UPDATE elo_leads SET merged_into = NULL "
+                  "WHERE id IN (SELECT canonical_id FROM lead_merge_map) AND merged_into IS NOT NULL"),
+    ("leads_apagados", "DELETE FROM elo_leads AS l USING lead_merge_map m WHERE l.id = m.dup_id"),
+]
+
+
+def find_duplicate_leads(chunk_size=MERGE_LEADS_SCAN_CHUNK):
+    """Lê as chaves de contato em lotes por id e devolve {id duplicado: id canônico}."""
+    groups = _LeadUnion()
+    first_by_key = {}
+    last_id = 0
+    while True:
+        with db_cursor() as cur:
+            cur.execute(MERGE_SCAN_SQL, (last_id, chunk_size))
+            rows = cur.fetchall()
+        if not rows:
+            break
+        for lead_id, email_key, whatsapp_key, merged_into in rows:
+            if merged_into:
+                groups.union(lead_id, merged_into)
+            for key in (('e', email_key), ('w', whatsapp_key)):
+                if key[1]:
+                    groups.union(lead_id, first_by_key.setdefault(key, lead_id))
+        last_id = rows[-1][0]
+    return {lead_id: groups.find(lead_id) for lead_id in list(groups.parent) if groups.find(lead_id) != lead_id}
+
+
+def merge_duplicate_leads(dry_run=False, chunk_size=MERGE_LEADS_SCAN_CHUNK):
+    """
+    Junta os leads duplicados (mesmo email/WhatsApp normalizado, ou já
+    marcados com merged_into) no mais antigo do grupo: completa os campos
+    vazios dele com o duplicado mais recente, re-aponta orçamentos e mensagens
+    e apaga os duplicados. Tudo numa transação, com advisory lock.
+    """
+    started = time.monotonic()
+    mapping = find_duplicate_leads(chunk_size)
+    report = {"duplicados": len(mapping), "grupos": len(set(mapping.values())), "dry_run": dry_run}
+    if mapping and not dry_run:
+        with db_cursor() as cur:
+            cur.execute("SELECT pg_advisory_xact_lock(%s)", (MERGE_LEADS_LOCK_KEY,))
+            cur.execute("CREATE TEMP TABLE lead_merge_map (dup_id INTEGER PRIMARY KEY, canonical_id INTEGER NOT NULL) ON COMMIT DROP")
+            psycopg2.extras.execute_values(cur, "INSERT INTO lead_merge_map (dup_id, canonical_id) VALUES %s",
+                                           list(mapping.items()), page_size=MERGE_LEADS_INSERT_PAGE)
+            cur.execute("ANALYZE lead_merge_map")
+            cur.execute(MERGE_FILL_CANONICAL_SQL)
+            for name, sql in MERGE_APPLY_SQL:
+                cur.execute(sql)
+                report[name] = cur.rowcount
+    report["segundos"] = round(time.monotonic() - started, 3)
+    log.info("[Dedup] Merge de leads duplicados concluído", extra=report)
+    return report
@@ -0,0 +1,289 @@
+"""Idempotency-Key: respostas guardadas (memória + Postgres) para as repetições do cliente."""
+import functools
+import hashlib
+import itertools
+import json
+import os
+import random
+import re
+import threading
+import time
+from collections import OrderedDict
+
+from flask import Response, current_app, jsonify, request
+
+from elo.db import PoolTimeoutError, db_cursor, run_db_steps
+from elo.observability import log
+
+# --- Idempotency-Key (/api/chat, /api/chat-stream e /api/save-quote) ---
+# O app mobile repete a requisição quando a rede falha. Com o header
+# Idempotency-Key, a primeira requisição de cada (endpoint, lead, chave) roda
+# e a resposta fica guardada por IDEMPOTENCY_TTL; as repetições recebem a
+# mesma resposta (header Idempotent-Replayed) sem chamar o Gemini nem gravar
+# de novo. Repetições que chegam enquanto a primeira ainda roda esperam por
+# ela (até IDEMPOTENCY_WAIT_TIMEOUT). Memória do processo na frente e
+# 'elo_idempotency' atrás, para valer entre os workers. Respostas 5xx não
+# ficam guardadas (a repetição tenta de novo). O /api/chat-stream usa as
+# mesmas chaves do /api/chat: guarda o JSON do evento 'done' (igual ao corpo
+# do /api/chat) e, na repetição, o reenvia como SSE.
+IDEMPOTENCY_TTL = int(os.environ.get("IDEMPOTENCY_TTL", 900))  # segundos
+IDEMPOTENCY_LOCK_TTL = int(os.environ.get("IDEMPOTENCY_LOCK_TTL", 120))  # requisição "em andamento" abandonada
+IDEMPOTENCY_WAIT_TIMEOUT = float(os.environ.get("IDEMPOTENCY_WAIT_TIMEOUT", 25))
+IDEMPOTENCY_POLL_INTERVAL = 0.2
+IDEMPOTENCY_MEMORY_MAX = int(os.environ.get("IDEMPOTENCY_MEMORY_MAX", 5000))
+IDEMPOTENCY_KEY_RE = re.compile(r'^[\w.:-]{8,200}$')
+
+CREATE_ELO_IDEMPOTENCY_TABLE_SQL = """
+CREATE TABLE IF NOT EXISTS elo_idempotency (
+    chave VARCHAR(300) PRIMARY KEY,
+    fingerprint CHAR(64) NOT NULL,
+    status VARCHAR(20) NOT NULL DEFAULT 'em_andamento', -- em_andamento | concluida
+    status_code INTEGER,
+    resposta TEXT,
+    content_type VARCHAR(100),
+    travada_ate TIMESTAMP WITH TIME ZONE NOT NULL,
+    expira_em TIMESTAMP WITH TIME ZONE NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_elo_idempotency_expira ON elo_idempotency (expira_em);
+"""
+# Vira "dona" da chave se ela não existe, expirou ou foi abandonada no meio
+IDEMPOTENCY_CLAIM_SQL = """
+INSERT INTO elo_idempotency (chave, fingerprint, travada_ate, expira_em)
+VALUES (%s, %s, NOW() + make_interval(secs => %s), NOW() + make_interval(secs => %s))
+ON CONFLICT (chave) DO UPDATE SET
+    fingerprint = EXCLUDED.fingerprint, status = 'em_andamento', status_code = NULL, resposta = NULL,
+    content_type = NULL, travada_ate = EXCLUDED.travada_ate, expira_em = EXCLUDED.expira_em
+WHERE elo_idempotency.expira_em < NOW()
+   OR (elo_idempotency.status = 'em_andamento' AND elo_idempotency.travada_ate < NOW())
+RETURNING chave;
+"""
+IDEMPOTENCY_SELECT_SQL = "SELECT fingerprint, status, status_code, resposta, content_type FROM elo_idempotency WHERE chave = %s"
+IDEMPOTENCY_COMPLETE_SQL = """
+UPDATE elo_idempotency
+SET status = 'concluida', status_code = %s, resposta = %s, content_type = %s,
+    expira_em = NOW() + make_interval(secs => %s)
+WHERE chave = %s;
+"""
+IDEMPOTENCY_RELEASE_SQL = "DELETE FROM elo_idempotency WHERE chave = %s AND status = 'em_andamento'"
+IDEMPOTENCY_PURGE_SQL = "DELETE FROM elo_idempotency WHERE expira_em < NOW() - INTERVAL '1 hour'"
+
+
+class IdempotencyStore:
+    """
+    begin() devolve (ação, entrada): 'run' (esta requisição executa),
+    'replay' (entrada = (status_code, corpo, content_type)), 'mismatch'
+    (mesma chave, corpo diferente) ou 'busy' (a original ainda não terminou).
+    """
+    new_event = threading.Event
+
+    def __init__(self, ttl, max_entries):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._done = OrderedDict()  # chave -> (fingerprint, (status, corpo, content_type), expira)
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self._stats = {"executadas": 0, "replays": 0, "esperas": 0, "conflitos": 0, "ocupadas": 0}
+
+    def count(self, name):
+        with self._lock:
+            self._stats[name] += 1
+
+    def memory_lookup(self, key, fingerprint):
+        with self._lock:
+            entry = self._done.get(key)
+            if entry is None or entry[2] < time.monotonic():
+                self._done.pop(key, None)
+                return None
+            self._done.move_to_end(key)
+        return self.outcome(entry[0], fingerprint, entry[1])
+
+    def memory_put(self, key, fingerprint, response):
+        with self._lock:
+            self._done[key] = (fingerprint, response, time.monotonic() + self.ttl)
+            self._done.move_to_end(key)
+            while len(self._done) > self.max_entries:
+                self._done.popitem(last=False)
+
+    def outcome(self, stored_fingerprint, fingerprint, response):
+        if stored_fingerprint != fingerprint:
+            self.count("conflitos")
+            return ("mismatch", None)
+        self.count("replays")
+        return ("replay", response)
+
+    def row_outcome(self, key, fingerprint, row):
+        """Resultado a partir da linha do banco (None se ela ainda está em andamento)."""
+        stored_fingerprint, status, status_code, body, content_type = row
+        if stored_fingerprint != fingerprint:
+            self.count("conflitos")
+            return ("mismatch", None)
+        if status != 'concluida':
+            return None
+        response = (status_code, body, content_type)
+        self.memory_put(key, fingerprint, response)
+        return self.outcome(fingerprint, fingerprint, response)
+
+    def claim_steps(self, key, fingerprint):
+        """Passos de banco (ver run_db_steps): True = somos donos; senão a linha existente (ou None se ela sumiu no meio)."""
+        if random.random() < 0.01:
+            yield IDEMPOTENCY_PURGE_SQL, None
+        if (yield IDEMPOTENCY_CLAIM_SQL, (key, fingerprint, IDEMPOTENCY_LOCK_TTL, self.ttl)):
+            return True
+        rows = yield IDEMPOTENCY_SELECT_SQL, (key,)
+        return rows[0] if rows else None
+
+    def _db_claim(self, key, fingerprint):
+        with db_cursor() as cur:
+            return run_db_steps(cur, self.claim_steps(key, fingerprint))
+
+    def join_inflight(self, key):
+        """
+        Single-flight no processo: (True, None) se esta requisição é a
+        primeira da chave, ou (False, evento da original) para esperar por
+        ela sem ir ao banco. O evento vem de new_event (threading.Event aqui,
+        asyncio.Event no AsyncIdempotencyStore).
+        """
+        with self._lock:
+            event = self._inflight.get(key)
+            if event is None:
+                self._inflight[key] = self.new_event()
+                return True, None
+        self.count("esperas")
+        return False, event
+
+    def claim_outcome(self, key, fingerprint, claim, deadline, first):
+        """Resultado de um _db_claim, ou None = a original ainda roda (esperar IDEMPOTENCY_POLL_INTERVAL e repetir)."""
+        if claim is True:
+            self.count("executadas")
+            return ("run", None)
+        found = self.row_outcome(key, fingerprint, claim) if claim else None
+        if found is None and time.monotonic() >= deadline:
+            found = self._busy()
+        if found is None:
+            if first:
+                self.count("esperas")
+            return None
+        self._finish(key)
+        return found
+
+    def db_unavailable(self, error):
+        log.warning(f"[Idempotência] Banco indisponível, seguindo só com a memória: {error}")
+        self.count("executadas")
+        return ("run", None)
+
+    def begin(self, key, fingerprint):
+        found = self.memory_lookup(key, fingerprint)
+        if found:
+            return found
+        leader, event = self.join_inflight(key)
+        if not leader:
+            # (Repetição no MESMO worker: espera a original sem ir ao banco)
+            event.wait(IDEMPOTENCY_WAIT_TIMEOUT)
+            return self.memory_lookup(key, fingerprint) or self._busy()
+
+        deadline = time.monotonic() + IDEMPOTENCY_WAIT_TIMEOUT
+        try:
+            for attempt in itertools.count():
+                found = self.claim_outcome(key, fingerprint, self._db_claim(key, fingerprint), deadline, attempt == 0)
+                if found:
+                    return found
+                time.sleep(IDEMPOTENCY_POLL_INTERVAL)
+        except PoolTimeoutError:
+            self._finish(key)
+            raise
+        except Exception as e_db:
+            return self.db_unavailable(e_db)
+
+    def _busy(self):
+        self.count("ocupadas")
+        return ("busy", None)
+
+    def _finish(self, key):
+        with self._lock:
+            event = self._inflight.pop(key, None)
+        if event is not None:
+            event.set()
+
+    def complete_statement(self, key, fingerprint, response):
+        """Guarda a resposta na memória; devolve o (sql, params) que a guarda no banco."""
+        self.memory_put(key, fingerprint, response)
+        return IDEMPOTENCY_COMPLETE_SQL, (*response, self.ttl, key)
+
+    def _release(self, key, statement, failure):
+        try:
+            with db_cursor() as cur:
+                cur.execute(*statement)
+        except Exception as e_db:
+            log.warning(f"[Idempotência] {failure}: {e_db}")
+        finally:
+            self._finish(key)
+
+    def complete(self, key, fingerprint, response):
+        self._release(key, self.complete_statement(key, fingerprint, response), "Falha ao guardar a resposta no banco")
+
+    def abort(self, key):
+        self._release(key, (IDEMPOTENCY_RELEASE_SQL, (key,)), "Falha ao liberar a chave no banco")
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, memoria=len(self._done), em_andamento=len(self._inflight))
+
+
+idempotency_store = IdempotencyStore(IDEMPOTENCY_TTL, IDEMPOTENCY_MEMORY_MAX)
+
+
+def idempotency_key(scope, lead_field, data, headers, raw_body):
+    """(chave completa, fingerprint do corpo) ou None sem header. Levanta ValueError se o header for inválido."""
+    client_key = headers.get('Idempotency-Key')
+    if client_key is None:
+        return None
+    if not IDEMPOTENCY_KEY_RE.match(client_key):
+        raise ValueError("Idempotency-Key inválida (8 a 200 caracteres: letras, números, '.', ':', '_' ou '-').")
+    lead_id = (data or {}).get(lead_field) or '-'
+    return f"{scope}:{lead_id}:{client_key}", hashlib.sha256(raw_body).hexdigest()
+
+
+def idempotency_reply(action, stored):
+    """(corpo, status, content_type, headers) da resposta para begin() != 'run' (o Flask e o Quart montam a partir daqui)."""
+    if action == 'replay':
+        status_code, body, content_type = stored
+        return body, status_code, content_type, {'Idempotent-Replayed': 'true'}
+    if action == 'mismatch':
+        return json.dumps({"error": "Idempotency-Key já usada com outro conteúdo."}), 422, 'application/json', {}
+    return (json.dumps({"error": "A requisição original ainda está em andamento. Tente novamente em instantes."}),
+            409, 'application/json', {'Retry-After': '1'})
+
+
+def idempotency_response(action, stored):
+    """Resposta HTTP para begin() != 'run'."""
+    body, status, content_type, headers = idempotency_reply(action, stored)
+    return Response(body, status=status, content_type=content_type, headers=headers)
+
+
+def idempotent(scope, lead_field):
+    """Decorator dos endpoints que aceitam Idempotency-Key (sem o header, nada muda)."""
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            try:
+                key = idempotency_key(scope, lead_field, request.get_json(silent=True), request.headers, request.get_data())
+            except ValueError as e_key:
+                return jsonify({"error": str(e_key)}), 400
+            if key is None:
+                return view(*args, **kwargs)
+
+            action, stored = idempotency_store.begin(*key)
+            if action != 'run':
+                return idempotency_response(action, stored)
+            try:
+                response = current_app.make_response(view(*args, **kwargs))
+            except Exception:
+                idempotency_store.abort(key[0])
+                raise
+            if response.status_code >= 500 or response.is_streamed:
+                idempotency_store.abort(key[0])
+            else:
+                idempotency_store.complete(*key, (response.status_code, response.get_data(as_text=True), response.content_type))
+            return response
+        return wrapper
+    return decorator
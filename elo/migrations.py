@@ -0,0 +1,290 @@
+"""Schema do banco: DDL das tabelas e migrações versionadas (rodadas pelo migrate.py)."""
+import os
+import re
+import time
+
+import psycopg2
+
+from elo import db
+from elo.db import DB_MIGRATIONS_LOCK_KEY
+from elo.dedup import ADD_MERGED_INTO_SQL, CREATE_CONTACT_KEY_INDEXES_SQL
+from elo.idempotency import CREATE_ELO_IDEMPOTENCY_TABLE_SQL
+from elo.observability import log
+from elo.outbox import CREATE_ELO_WEBHOOK_OUTBOX_TABLE_SQL
+from elo.write_behind import ADD_CHAT_UPDATED_AT_SQL
+
+# --- SQL para Criar/Atualizar Tabelas ---
+CREATE_ELO_LEADS_TABLE_SQL = """
+CREATE TABLE IF NOT EXISTS elo_leads (
+    id SERIAL PRIMARY KEY,
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
+    nome VARCHAR(255),
+    email VARCHAR(255), -- UNIQUE FOI REMOVIDO PARA TESTES
+    empresa_ramo VARCHAR(255),
+    cargo VARCHAR(255),
+    cnpj_fornecido VARCHAR(50),
+    status_lead VARCHAR(50) DEFAULT 'Frio',
+    recomendacoes_ia JSONB, 
+    historico_chat JSONB,
+    email_enviado BOOLEAN DEFAULT false,
+    ja_e_cliente VARCHAR(50) 
+);
+"""
+CREATE_ELO_ORCAR_TABLE_SQL = """
+CREATE TABLE IF NOT EXISTS elo_orçar (
+    id SERIAL PRIMARY KEY,
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
+    produto_desejado TEXT,
+    quantidade_estimada VARCHAR(100),
+    prazo_entrega VARCHAR(255),
+    tipo_de_gravacao VARCHAR(255),
+    cidade_entrega VARCHAR(255),
+    estado_entrega VARCHAR(100),
+    lead_id INTEGER REFERENCES elo_leads(id)
+);
+"""
+ADD_NEW_COLUMNS_SQL = """
+ALTER TABLE elo_leads 
+ADD COLUMN IF NOT EXISTS whatsapp VARCHAR(50),
+ADD COLUMN IF NOT EXISTS isca TEXT,
+ADD COLUMN IF NOT EXISTS status VARCHAR(100) DEFAULT 'Novo';
+"""
+# Fila de envio do N8N: o /api/n8n/claim-leads "aluga" leads pendentes por
+# N8N_CLAIM_LEASE segundos (n8n_claimed_at); o índice parcial cobre só os
+# pendentes, então a busca não varre a tabela inteira. O índice é criado com
+# CONCURRENTLY na v3 (ver CREATE_HOT_PATH_INDEXES_SQL): a elo_leads já existe
+# com dados em produção, e um CREATE INDEX comum travaria as escritas nela.
+STATUS_AGUARDANDO_N8N = 'Aguardando Envio N8N'
+ADD_N8N_QUEUE_SQL = """
+ALTER TABLE elo_leads ADD COLUMN IF NOT EXISTS n8n_claimed_at TIMESTAMP WITH TIME ZONE;
+"""
+# (SQL para remover a trava de email)
+DROP_UNIQUE_CONSTRAINT_SQL = """
+ALTER TABLE elo_leads 
+DROP CONSTRAINT IF EXISTS elo_leads_email_key;
+"""
+
+# Histórico da conversa append-only (1 linha por mensagem), no lugar de
+# reescrever o JSONB 'historico_chat' inteiro a cada rodada.
+CREATE_ELO_CHAT_MESSAGES_TABLE_SQL = """
+CREATE TABLE IF NOT EXISTS elo_chat_messages (
+    id BIGSERIAL PRIMARY KEY,
+    lead_id INTEGER NOT NULL REFERENCES elo_leads(id),
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
+    role VARCHAR(10) NOT NULL,
+    texto TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_elo_chat_messages_lead_id ON elo_chat_messages (lead_id, id);
+"""
+
+# Camada do cache da isca que sobrevive a restart (ver IscaCache em app.py)
+CREATE_ELO_ISCA_CACHE_TABLE_SQL = """
+CREATE TABLE IF NOT EXISTS elo_isca_cache (
+    ramo_key VARCHAR(255) PRIMARY KEY,
+    ramo_exemplo VARCHAR(255),
+    isca TEXT NOT NULL,
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
+);
+"""
+
+# --- Migrações Versionadas do Banco ---
+# Cada migração roda UMA vez e fica registrada em 'schema_version'. Importar
+# este módulo NÃO migra: as migrações rodam no passo de release do deploy
+# ('python migrate.py') ou, com DB_MIGRATE_ON_START=1, uma vez no master do
+# gunicorn antes do fork (on_starting em gunicorn.conf.py). Com o banco já na
+# última versão é só um SELECT (sem DDL, sem lock); senão um advisory lock
+# garante que só um processo aplica as migrações (ex.: várias instâncias
+# subindo juntas). Os outros NÃO ficam bloqueados esperando o lock (um SELECT
+# pg_advisory_lock parado segura um snapshot, e o CREATE INDEX CONCURRENTLY de
+# quem migra espera todos os snapshots abertos: deadlock); eles tentam o lock
+# com pg_try_advisory_lock e, entre tentativas, só conferem a versão.
+DB_MIGRATIONS_POLL_INTERVAL = float(os.environ.get("DB_MIGRATIONS_POLL_INTERVAL", 1))  # segundos
+DB_MIGRATIONS_WAIT_TIMEOUT = float(os.environ.get("DB_MIGRATIONS_WAIT_TIMEOUT", 600))  # segundos
+
+CREATE_SCHEMA_VERSION_TABLE_SQL = """
+CREATE TABLE IF NOT EXISTS schema_version (
+    version INTEGER PRIMARY KEY,
+    descricao TEXT NOT NULL,
+    aplicada_em TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
+    duracao_ms INTEGER
+);
+"""
+
+# Índices das consultas quentes. CONCURRENTLY não trava escrita na tabela,
+# mas não roda dentro de transação (ver 'transacional' abaixo). (Bancos que
+# rodaram a v1 antiga já têm o índice da fila do N8N: o IF NOT EXISTS pula.)
+CREATE_HOT_PATH_INDEXES_SQL = [
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_elo_orcar_lead_id ON elo_orçar (lead_id)",
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_elo_leads_status_id ON elo_leads (status, id)",
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_elo_leads_aguardando_n8n ON elo_leads (id) "
+    f"WHERE status = '{STATUS_AGUARDANDO_N8N}'",
+]
+
+
+def schema_migrations():
+    """
+    Lista ordenada de (versão, descrição, transacional, [comandos SQL]).
+    Nunca edite uma migração já publicada: acrescente uma nova no fim.
+    """
+    return [
+        (1, "Tabelas base (leads, orçar, chat, isca, outbox, fila do N8N)", True, [
+            CREATE_ELO_LEADS_TABLE_SQL,
+            CREATE_ELO_ORCAR_TABLE_SQL,
+            ADD_NEW_COLUMNS_SQL,
+            DROP_UNIQUE_CONSTRAINT_SQL,
+            ADD_N8N_QUEUE_SQL,
+            CREATE_ELO_CHAT_MESSAGES_TABLE_SQL,
+            CREATE_ELO_ISCA_CACHE_TABLE_SQL,
+            CREATE_ELO_WEBHOOK_OUTBOX_TABLE_SQL,
+        ]),
+        (2, "Coluna merged_into em elo_leads (lead duplicado -> lead canônico)", True, [ADD_MERGED_INTO_SQL]),
+        (3, "Índices de lead_id em elo_orçar, de status, da fila do N8N e das chaves de email/whatsapp em elo_leads",
+         False,
+         CREATE_HOT_PATH_INDEXES_SQL + CREATE_CONTACT_KEY_INDEXES_SQL),
+        (4, "Tabela elo_idempotency (respostas guardadas por Idempotency-Key)", True,
+         [CREATE_ELO_IDEMPOTENCY_TABLE_SQL]),
+        (5, "Coluna chat_atualizado_em em elo_leads (ordem das escritas do chat)", True,
+         [ADD_CHAT_UPDATED_AT_SQL]),
+    ]
+
+
+def current_schema_version(cur):
+    cur.execute("SELECT to_regclass('schema_version') IS NOT NULL")
+    if not cur.fetchone()[0]:
+        return 0
+    cur.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version")
+    return cur.fetchone()[0]
+
+
+CONCURRENT_INDEX_NAME_RE = re.compile(r'CREATE INDEX CONCURRENTLY IF NOT EXISTS (\w+)')
+INDEX_VALIDITY_SQL = """
+SELECT c.relname, i.indisvalid FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid
+WHERE c.relname = ANY(%s) AND pg_catalog.pg_table_is_visible(c.oid)
+"""
+
+
+def index_validity(cur, names):
+    """nome -> indisvalid dos índices que existem (no search_path)."""
+    cur.execute(INDEX_VALIDITY_SQL, (list(names),))
+    return dict(cur.fetchall())
+
+
+def drop_invalid_indexes(cur, names):
+    """
+    Um CREATE INDEX CONCURRENTLY que falha deixa o índice INVALID, e o IF NOT
+    EXISTS da próxima tentativa pularia ele: apaga para ser recriado.
+    """
+    for name, valid in index_validity(cur, names).items():
+        if not valid:
+            log.warning(f"[DB-Migrações] Índice {name} inválido (CONCURRENTLY interrompido): recriando.")
+            cur.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name}")
+
+
+def check_indexes_valid(cur, names):
+    validity = index_validity(cur, names)
+    broken = sorted(name for name in names if not validity.get(name))
+    if broken:
+        raise RuntimeError(f"Índices ausentes ou inválidos após a migração: {', '.join(broken)}")
+
+
+def wait_migration_lock(cur, target):
+    """
+    Tenta o lock de migração sem bloquear. True = lock obtido; False = outro
+    processo levou o banco até 'target' enquanto esperávamos.
+    """
+    deadline = time.monotonic() + DB_MIGRATIONS_WAIT_TIMEOUT
+    waiting_logged = False
+    while True:
+        cur.execute("SELECT pg_try_advisory_lock(%s)", (DB_MIGRATIONS_LOCK_KEY,))
+        if cur.fetchone()[0]:
+            return True
+        if current_schema_version(cur) >= target:
+            return False
+        if time.monotonic() >= deadline:
+            raise RuntimeError(f"Outro processo segura o lock de migração há mais de {DB_MIGRATIONS_WAIT_TIMEOUT:.0f}s.")
+        if not waiting_logged:
+            log.info("[DB-Migrações] Outro processo está migrando; aguardando...")
+            waiting_logged = True
+        time.sleep(DB_MIGRATIONS_POLL_INTERVAL)
+
+
+def run_migrations(conn, upto=None):
+    """
+    Aplica as migrações pendentes (até 'upto', se informado) na conexão dada.
+    Devolve a lista de versões aplicadas; lista vazia = banco já estava em dia
+    (ou outro processo aplicou enquanto esperávamos).
+    """
+    migrations = [m for m in schema_migrations() if upto is None or m[0] <= upto]
+    target = migrations[-1][0]
+    previous_autocommit = conn.autocommit
+    conn.autocommit = True
+    applied = []
+    try:
+        with conn.cursor() as cur:
+            # Caminho rápido: nada a fazer, nada de lock.
+            if current_schema_version(cur) >= target:
+                return applied
+
+            if not wait_migration_lock(cur, target):
+                return applied
+            try:
+                cur.execute(CREATE_SCHEMA_VERSION_TABLE_SQL)
+                version = current_schema_version(cur)  # (outro processo pode ter migrado enquanto esperávamos)
+                for number, descricao, transacional, statements in migrations:
+                    if number <= version:
+                        continue
+                    log.info(f"[DB-Migrações] Aplicando v{number}: {descricao}...")
+                    started = time.monotonic()
+                    index_names = [] if transacional else CONCURRENT_INDEX_NAME_RE.findall(" ".join(statements))
+                    conn.autocommit = not transacional
+                    try:
+                        drop_invalid_indexes(cur, index_names)
+                        for statement in statements:
+                            cur.execute(statement)
+                        check_indexes_valid(cur, index_names)
+                        cur.execute(
+                            "INSERT INTO schema_version (version, descricao, duracao_ms) VALUES (%s, %s, %s)",
+                            (number, descricao, int((time.monotonic() - started) * 1000)),
+                        )
+                        if transacional:
+                            conn.commit()
+                    except Exception:
+                        if transacional:
+                            conn.rollback()
+                        raise
+                    finally:
+                        conn.autocommit = True
+                    applied.append(number)
+            finally:
+                cur.execute("SELECT pg_advisory_unlock(%s)", (DB_MIGRATIONS_LOCK_KEY,))
+    finally:
+        conn.autocommit = previous_autocommit
+    return applied
+
+
+def setup_database():
+    """Conecta ao banco e aplica as migrações que faltarem (no-op se já estiver em dia)."""
+    try:
+        if not db.DATABASE_URL:
+            log.warning("[DB] DATABASE_URL não configurada.")
+            return
+
+        conn = db.db_pool.getconn()
+        discard = False
+        try:
+            applied = run_migrations(conn)
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            discard = True
+            raise
+        finally:
+            db.db_pool.putconn(conn, discard=discard)
+
+        if applied:
+            log.info(f"[DB] Migrações aplicadas: {applied}.")
+        else:
+            log.info("[DB] Schema já está na última versão.")
+        
+    except psycopg2.Error as e:
+        log.error(f"[DB] Erro ao aplicar as migrações: {e}")
+    except Exception as e:
+        log.exception(f"[DB] Erro inesperado em setup_database: {e}")
@@ -0,0 +1,167 @@
+"""Logs estruturados (JSON) e métricas (Prometheus) compartilhados por todos os módulos."""
+import atexit
+import contextvars
+import datetime
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import re
+import sys
+import time
+import uuid
+from contextlib import contextmanager
+
+from prometheus_client import Counter, Gauge, Histogram
+
+# --- Logs Estruturados (JSON) ---
+# Uma linha JSON por evento, com o id de correlação da requisição
+# (X-Request-ID). A thread da requisição só põe o registro numa fila; quem
+# formata e escreve no stdout é a thread do QueueListener. Fila cheia =
+# registro descartado (contado em 'descartados'), nunca espera.
+# Payloads grandes (histórico, dados do lead, resposta do modelo) só entram
+# em LOG_PAYLOAD_SAMPLE_RATE das requisições e são cortados em
+# LOG_PAYLOAD_MAX_CHARS; nas demais vai só o tamanho.
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+LOG_QUEUE_MAX = int(os.environ.get("LOG_QUEUE_MAX", 10000))
+LOG_PAYLOAD_MAX_CHARS = int(os.environ.get("LOG_PAYLOAD_MAX_CHARS", 500))
+LOG_PAYLOAD_SAMPLE_RATE = float(os.environ.get("LOG_PAYLOAD_SAMPLE_RATE", 0.1))
+
+request_id_var = contextvars.ContextVar("request_id", default=None)
+log_payloads_var = contextvars.ContextVar("log_payloads", default=True)
+log_stats = {"descartados": 0}
+
+_LOG_RECORD_ATTRS = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "request_id"}
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "ts": datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "msg": record.getMessage(),
+        }
+        if getattr(record, "request_id", None):
+            entry["request_id"] = record.request_id
+        for key, value in vars(record).items():
+            if key not in _LOG_RECORD_ATTRS:
+                entry[key] = value
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler que carimba o id da requisição e descarta (em vez de travar) se a fila encher."""
+
+    def prepare(self, record):
+        record.request_id = request_id_var.get()
+        if record.exc_info:
+            # (O traceback precisa ser formatado aqui: a exceção não vai para a fila)
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            log_stats["descartados"] += 1
+
+
+def log_payload(value):
+    """Versão "logável" de um payload grande: cortada, ou só o tamanho se a requisição não foi sorteada."""
+    text = value if isinstance(value, str) else json.dumps(value, ensure_ascii=False, default=str)
+    if not log_payloads_var.get():
+        return {"omitido": True, "chars": len(text)}
+    if len(text) > LOG_PAYLOAD_MAX_CHARS:
+        return text[:LOG_PAYLOAD_MAX_CHARS] + f"... (+{len(text) - LOG_PAYLOAD_MAX_CHARS} chars)"
+    return text
+
+
+def begin_request_log(request_id=None):
+    """Abre o contexto de log da requisição (id de correlação + sorteio dos payloads)."""
+    request_id = request_id or uuid.uuid4().hex
+    request_id_var.set(request_id)
+    log_payloads_var.set(random.random() < LOG_PAYLOAD_SAMPLE_RATE)
+    return request_id
+
+
+def setup_logging():
+    log_queue = queue.Queue(LOG_QUEUE_MAX)
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(JsonFormatter())
+    listener = logging.handlers.QueueListener(log_queue, stream_handler)
+    listener.start()
+    atexit.register(listener.stop)  # (esvazia a fila ao sair)
+
+    logger = logging.getLogger("elo")
+    logger.setLevel(LOG_LEVEL)
+    logger.addHandler(NonBlockingQueueHandler(log_queue))
+    logger.propagate = False
+    return logger, log_queue
+
+
+log, _log_queue = setup_logging()
+
+
+def log_queue_size():
+    return _log_queue.qsize()
+
+
+# --- Métricas (Prometheus) ---
+# Expostas em /metrics. Sob o gunicorn cada worker é um processo separado:
+# com PROMETHEUS_MULTIPROC_DIR definido (o gunicorn.conf.py define) cada
+# processo escreve as suas num arquivo mmap desse diretório e o /metrics soma
+# todos. Registrar um valor é só uma escrita em memória, sem I/O na requisição.
+# Estágios: llm_wait (fila do controle de admissão), llm_call, db_connect
+# (checkout do pool), db_query (cada execute), webhook, json_parse,
+# write_behind (cada lote do write-behind do chat).
+METRICS_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 40, 80)
+
+HTTP_REQUEST_SECONDS = Histogram(
+    "elo_http_request_duration_seconds", "Latência das requisições HTTP (até os headers, no caso de stream).",
+    ["endpoint", "method", "status"], buckets=METRICS_LATENCY_BUCKETS)
+STAGE_SECONDS = Histogram(
+    "elo_stage_duration_seconds", "Latência por estágio da requisição.", ["stage"], buckets=METRICS_LATENCY_BUCKETS)
+LLM_TOKENS = Counter("elo_llm_tokens_total", "Tokens do LLM (usage_metadata) por operação.", ["operation", "kind"])
+ERRORS = Counter("elo_errors_total", "Erros por lugar e tipo de exceção.", ["where", "type"])
+CACHE_REQUESTS = Counter("elo_cache_requests_total", "Consultas aos caches por resultado.", ["cache", "result"])
+DB_POOL_IN_USE = Gauge("elo_db_pool_in_use", "Conexões do pool emprestadas agora.", multiprocess_mode="livesum")
+DB_POOL_TIMEOUTS = Counter("elo_db_pool_timeouts_total", "Checkouts do pool que estouraram o timeout.")
+LLM_IN_FLIGHT = Gauge("elo_llm_in_flight", "Chamadas ao LLM em voo.", multiprocess_mode="livesum")
+LLM_WAITING = Gauge("elo_llm_waiting", "Requisições na fila do controle de admissão.", multiprocess_mode="livesum")
+LLM_REJECTIONS = Counter("elo_llm_rejections_total", "Recusas do controle de admissão por motivo.", ["reason"])
+
+
+@contextmanager
+def observe_stage(stage):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_SECONDS.labels(stage).observe(time.perf_counter() - started)
+
+
+def record_error(where, error):
+    ERRORS.labels(where, type(error).__name__).inc()
+
+
+def record_llm_usage(operation, response):
+    """Soma os tokens de entrada/saída de uma resposta do LLM (se ela trouxer usage_metadata)."""
+    usage = getattr(response, 'usage_metadata', None)
+    if usage is None:
+        return
+    LLM_TOKENS.labels(operation, "prompt").inc(getattr(usage, 'prompt_token_count', 0) or 0)
+    LLM_TOKENS.labels(operation, "response").inc(getattr(usage, 'candidates_token_count', 0) or 0)
+
+
+REQUEST_ID_RE = re.compile(r'^[\w.-]{1,64}$')
+
+
+def incoming_request_id(headers):
+    """X-Request-ID do cliente/proxy, se for um id razoável (senão geramos um)."""
+    value = headers.get('X-Request-ID', '')
+    return value if REQUEST_ID_RE.match(value) else None
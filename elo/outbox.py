@@ -0,0 +1,202 @@
+"""Outbox do webhook de vendas: fila no Postgres + dispatcher com retry e dead-letter."""
+import json
+import os
+import random
+import threading
+
+import psycopg2.extras
+import requests
+
+from elo.db import db_cursor
+from elo.observability import log, observe_stage, record_error
+
+SALES_WEBHOOK_URL = os.environ.get("SALES_WEBHOOK_URL")
+
+# --- Outbox do Webhook de Vendas ---
+# O /api/save-quote só grava o evento em 'elo_webhook_outbox' na MESMA
+# transação do orçamento e responde. Quem entrega para o N8N é o
+# OutboxDispatcher (thread em segundo plano ou `python outbox_worker.py`),
+# com retry exponencial e dead-letter, então nenhum evento se perde. O lote é
+# reservado por um "lease" (locked_until) numa transação curta; os POSTs
+# rodam sem transação aberta e os resultados voltam numa segunda transação.
+# Se o processo morrer no meio, o lease vence e outro dispatcher retoma.
+OUTBOX_DISPATCHER_MODE = os.environ.get("OUTBOX_DISPATCHER_MODE", "thread")  # 'thread' ou 'worker' (processo separado)
+OUTBOX_BATCH_SIZE = int(os.environ.get("OUTBOX_BATCH_SIZE", 50))
+OUTBOX_POLL_INTERVAL = float(os.environ.get("OUTBOX_POLL_INTERVAL", 5))  # segundos
+OUTBOX_MAX_ATTEMPTS = int(os.environ.get("OUTBOX_MAX_ATTEMPTS", 8))
+OUTBOX_BACKOFF_BASE = float(os.environ.get("OUTBOX_BACKOFF_BASE", 10))  # segundos; dobra a cada tentativa
+OUTBOX_BACKOFF_MAX = float(os.environ.get("OUTBOX_BACKOFF_MAX", 3600))
+OUTBOX_HTTP_TIMEOUT = float(os.environ.get("OUTBOX_HTTP_TIMEOUT", 10))
+OUTBOX_LEASE_SECONDS = float(os.environ.get("OUTBOX_LEASE_SECONDS", OUTBOX_BATCH_SIZE * OUTBOX_HTTP_TIMEOUT + 60))
+
+CREATE_ELO_WEBHOOK_OUTBOX_TABLE_SQL = """
+CREATE TABLE IF NOT EXISTS elo_webhook_outbox (
+    id BIGSERIAL PRIMARY KEY,
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
+    destino VARCHAR(50) NOT NULL DEFAULT 'vendas',
+    payload JSONB NOT NULL,
+    status VARCHAR(20) NOT NULL DEFAULT 'pendente', -- pendente | entregue | dead
+    tentativas INTEGER NOT NULL DEFAULT 0,
+    proxima_tentativa TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT NOW(),
+    ultimo_erro TEXT,
+    entregue_em TIMESTAMP WITH TIME ZONE,
+    locked_until TIMESTAMP WITH TIME ZONE -- lease do dispatcher que reservou o evento
+);
+CREATE INDEX IF NOT EXISTS idx_elo_webhook_outbox_pendente
+    ON elo_webhook_outbox (proxima_tentativa) WHERE status = 'pendente';
+"""
+
+
+def enqueue_webhook(cur, payload, destino='vendas'):
+    """Grava o evento na outbox usando o cursor (e a transação) de quem chamou."""
+    cur.execute(
+        "INSERT INTO elo_webhook_outbox (destino, payload) VALUES (%s, %s) RETURNING id",
+        (destino, json.dumps(payload))
+    )
+    return cur.fetchone()[0]
+
+
+OUTBOX_CLAIM_SQL = """
+WITH lote AS (
+    SELECT id FROM elo_webhook_outbox
+    WHERE status = 'pendente' AND proxima_tentativa <= NOW()
+      AND (locked_until IS NULL OR locked_until < NOW())
+    ORDER BY proxima_tentativa, id
+    LIMIT %s
+    FOR UPDATE SKIP LOCKED
+)
+UPDATE elo_webhook_outbox AS o SET locked_until = NOW() + make_interval(secs => %s)
+FROM lote
+WHERE o.id = lote.id
+RETURNING o.id, o.payload, o.tentativas;
+"""
+
+
+class OutboxDispatcher:
+    """
+    Entrega os eventos pendentes da outbox em lotes.
+
+    Cada lote é reservado (FOR UPDATE SKIP LOCKED + locked_until) numa
+    transação curta, então várias threads/processos podem rodar ao mesmo
+    tempo sem entregar o mesmo evento duas vezes e nenhuma conexão do pool
+    fica presa durante os POSTs. Os POSTs reaproveitam a conexão HTTP
+    (requests.Session) e os resultados do lote voltam para o banco em um
+    único UPDATE por tipo.
+    """
+
+    def __init__(self, url, batch_size, poll_interval, max_attempts, backoff_base, backoff_max, http_timeout,
+                 lease_seconds):
+        self.url = url
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.http_timeout = http_timeout
+        self.lease_seconds = lease_seconds
+        self._session = requests.Session()
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self._thread_lock = threading.Lock()
+
+    def _backoff(self, attempts):
+        delay = min(self.backoff_base * (2 ** (attempts - 1)), self.backoff_max)
+        return delay * random.uniform(0.8, 1.2)
+
+    def dispatch_batch(self):
+        """Tenta entregar um lote. Devolve quantos eventos foram processados."""
+        if not self.url:
+            return 0
+        with db_cursor() as cur:
+            cur.execute(OUTBOX_CLAIM_SQL, (self.batch_size, self.lease_seconds))
+            rows = cur.fetchall()
+        if not rows:
+            return 0
+
+        delivered, failed = [], []
+        try:
+            for event_id, payload, attempts in rows:
+                try:
+                    with observe_stage("webhook"):
+                        response = self._session.post(self.url, json=payload, timeout=self.http_timeout)
+                    response.raise_for_status()
+                    delivered.append(event_id)
+                except requests.RequestException as e_req:
+                    record_error("webhook", e_req)
+                    attempts += 1
+                    status = 'dead' if attempts >= self.max_attempts else 'pendente'
+                    failed.append((event_id, attempts, status, self._backoff(attempts), str(e_req)[:1000]))
+        finally:
+            # (Eventos não tentados ficam com o lease até ele vencer)
+            self._record_results(delivered, failed)
+
+        dead = sum(1 for f in failed if f[2] == 'dead')
+        log.info(f"[Outbox] Lote: {len(delivered)} entregue(s), {len(failed) - dead} para retry, {dead} dead-letter.")
+        return len(rows)
+
+    def _record_results(self, delivered, failed):
+        if not delivered and not failed:
+            return
+        with db_cursor() as cur:
+            if delivered:
+                cur.execute("""
+                    UPDATE elo_webhook_outbox
+                    SET status = 'entregue', entregue_em = NOW(), tentativas = tentativas + 1,
+                        ultimo_erro = NULL, locked_until = NULL
+                    WHERE id = ANY(%s)
+                """, (delivered,))
+            if failed:
+                psycopg2.extras.execute_values(cur, """
+                    UPDATE elo_webhook_outbox AS o SET
+                        tentativas = v.tentativas,
+                        status = v.status,
+                        proxima_tentativa = NOW() + make_interval(secs => v.atraso),
+                        ultimo_erro = v.erro,
+                        locked_until = NULL
+                    FROM (VALUES %s) AS v (id, tentativas, status, atraso, erro)
+                    WHERE o.id = v.id
+                """, failed, template="(%s::bigint, %s::integer, %s::varchar, %s::double precision, %s::text)")
+
+    def run_forever(self):
+        log.info(f"[Outbox] Dispatcher iniciado (lote={self.batch_size}, intervalo={self.poll_interval}s).")
+        while not self._stop.is_set():
+            try:
+                processed = self.dispatch_batch()
+            except Exception as e:
+                record_error("outbox", e)
+                log.exception(f"[Outbox] Erro ao processar lote: {e}")
+                processed = 0
+            if processed < self.batch_size:
+                self._wakeup.wait(self.poll_interval)
+                self._wakeup.clear()
+
+    def start(self):
+        """
+        Sobe a thread (modo 'thread') se ainda não estiver rodando. Chamado no
+        boot de cada worker (post_worker_init do gunicorn, before_serving do
+        ASGI, `python app.py`) para entregar os eventos que ficaram pendentes
+        de antes do restart, e de novo pelo wake() caso a thread tenha morrido.
+        """
+        if OUTBOX_DISPATCHER_MODE != 'thread' or not self.url:
+            return
+        with self._thread_lock:
+            # (Nunca no import: threads não sobrevivem ao fork do gunicorn)
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self.run_forever, name="outbox-dispatcher", daemon=True)
+                self._thread.start()
+
+    def wake(self):
+        """Chamado após enfileirar: garante a thread e a acorda."""
+        self.start()
+        self._wakeup.set()
+
+    def stop(self):
+        self._stop.set()
+        self._wakeup.set()
+
+
+outbox_dispatcher = OutboxDispatcher(
+    SALES_WEBHOOK_URL, OUTBOX_BATCH_SIZE, OUTBOX_POLL_INTERVAL, OUTBOX_MAX_ATTEMPTS,
+    OUTBOX_BACKOFF_BASE, OUTBOX_BACKOFF_MAX, OUTBOX_HTTP_TIMEOUT, OUTBOX_LEASE_SECONDS
+)
@@ -0,0 +1,162 @@
+"""Widget estático: build (assets com hash + .br/.gz) e entrega com cache/ETag."""
+import gzip
+import hashlib
+import json
+import os
+import re
+import threading
+
+from flask import Response, jsonify, request
+
+from elo.observability import CACHE_REQUESTS, log
+
+try:
+    import brotli
+except ImportError:  # (só o build do widget usa; sem ele saem só as versões .gz)
+    brotli = None
+
+# --- Widget Estático (páginas + CSS/JS + imagens) ---
+# As páginas do widget ficam em widget/src e usam um único widget.css/
+# widget.js. O build (`python build_static.py`, no passo de build do deploy)
+# gera widget/dist:
+# - assets com o hash do conteúdo no nome (widget.3f2a9c1b7e4d.css), servidos
+#   com Cache-Control immutable por um ano: quem volta não baixa nada;
+# - páginas com o mesmo nome, apontando para os assets com hash, servidas
+#   com no-cache + ETag (revalida e recebe 304);
+# - versões .br e .gz pré-comprimidas dos arquivos de texto, escolhidas pelo
+#   Accept-Encoding (imagens já são comprimidas e vão como estão).
+# Cada worker carrega o dist na memória na primeira requisição; sem o
+# manifest (ex.: rodando local sem build), o build roda nessa hora.
+WIDGET_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'widget')
+WIDGET_SRC_DIR = os.path.join(WIDGET_DIR, 'src')
+WIDGET_DIST_DIR = os.environ.get("WIDGET_DIST_DIR", os.path.join(WIDGET_DIR, 'dist'))
+WIDGET_PAGES = ('index.html', 'index2.html', 'index4.html')
+WIDGET_ASSETS = ('widget.css', 'widget.js', 'elologo.png', 'fundo.png')
+WIDGET_ASSET_URL = '/widget/assets/'
+WIDGET_COMPRESSIBLE = {'.html', '.css', '.js', '.svg', '.json'}
+WIDGET_CONTENT_TYPES = {'.html': 'text/html; charset=utf-8', '.css': 'text/css; charset=utf-8',
+                        '.js': 'text/javascript; charset=utf-8', '.png': 'image/png', '.svg': 'image/svg+xml'}
+WIDGET_IMMUTABLE_CACHE = "public, max-age=31536000, immutable"
+WIDGET_ENCODINGS = (('br', '.br'), ('gzip', '.gz'))  # (ordem de preferência)
+
+
+def _content_hash(data):
+    return hashlib.sha256(data).hexdigest()[:12]
+
+
+def _write_atomic(path, data):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def _write_compressed(dist_dir, name, data):
+    """Grava name(.br/.gz) quando comprimir vale a pena (< 90% do original). Devolve as codificações geradas."""
+    variants = {'gzip': gzip.compress(data, compresslevel=9, mtime=0)}
+    if brotli is not None:
+        variants['br'] = brotli.compress(data, quality=11)
+    written = []
+    for encoding, suffix in WIDGET_ENCODINGS:
+        body = variants.get(encoding)
+        if body is not None and len(body) < len(data) * 0.9:
+            _write_atomic(os.path.join(dist_dir, name + suffix), body)
+            written.append(encoding)
+    return written
+
+
+def build_widget(src_dir=WIDGET_SRC_DIR, dist_dir=WIDGET_DIST_DIR):
+    """Gera o dist do widget (assets com hash, páginas reescritas, .br/.gz e manifest.json). Devolve o manifest."""
+    os.makedirs(dist_dir, exist_ok=True)
+    if brotli is None:
+        log.warning("[Widget] Módulo 'brotli' não instalado: gerando só as versões .gz.")
+    files = {}
+    hashed_names = {}
+
+    def emit(name, data, immutable):
+        ext = os.path.splitext(name)[1]
+        _write_atomic(os.path.join(dist_dir, name), data)
+        encodings = _write_compressed(dist_dir, name, data) if ext in WIDGET_COMPRESSIBLE else []
+        files[name] = {"etag": _content_hash(data), "immutable": immutable, "encodings": encodings,
+                       "content_type": WIDGET_CONTENT_TYPES.get(ext, 'application/octet-stream')}
+
+    for asset in WIDGET_ASSETS:
+        with open(os.path.join(src_dir, asset), 'rb') as f:
+            data = f.read()
+        stem, ext = os.path.splitext(asset)
+        hashed_names[asset] = f"{stem}.{_content_hash(data)}{ext}"
+        emit(hashed_names[asset], data, immutable=True)
+
+    asset_ref_re = re.compile(r'\b(src|href)="(' + '|'.join(re.escape(a) for a in WIDGET_ASSETS) + r')"')
+    for page in WIDGET_PAGES:
+        with open(os.path.join(src_dir, page), encoding='utf-8') as f:
+            html = f.read()
+        html = asset_ref_re.sub(lambda m: f'{m.group(1)}="{WIDGET_ASSET_URL}{hashed_names[m.group(2)]}"', html)
+        emit(page, html.encode('utf-8'), immutable=False)
+
+    manifest = {"assets": hashed_names, "files": files}
+    _write_atomic(os.path.join(dist_dir, 'manifest.json'), json.dumps(manifest, indent=2).encode('utf-8'))
+    log.info(f"[Widget] Build gerado em {dist_dir}: {len(files)} arquivo(s).")
+    return manifest
+
+
+class WidgetFiles:
+    """Conteúdo do widget/dist na memória: nome -> (content_type, etag, immutable, {codificação: corpo})."""
+
+    def __init__(self, dist_dir):
+        self.dist_dir = dist_dir
+        self._files = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        manifest_path = os.path.join(self.dist_dir, 'manifest.json')
+        if os.path.exists(manifest_path):
+            with open(manifest_path, encoding='utf-8') as f:
+                manifest = json.load(f)
+        else:
+            log.warning("[Widget] widget/dist sem manifest.json: rodando o build agora (rode build_static.py no deploy).")
+            manifest = build_widget(dist_dir=self.dist_dir)
+
+        files = {}
+        for name, meta in manifest["files"].items():
+            bodies = {}
+            for encoding, suffix in [(None, '')] + [e for e in WIDGET_ENCODINGS if e[0] in meta["encodings"]]:
+                with open(os.path.join(self.dist_dir, name + suffix), 'rb') as f:
+                    bodies[encoding] = f.read()
+            files[name] = (meta["content_type"], meta["etag"], meta["immutable"], bodies)
+        return files
+
+    def get(self, name):
+        if self._files is None:
+            with self._lock:
+                if self._files is None:
+                    self._files = self._load()
+        return self._files.get(name)
+
+
+widget_files = WidgetFiles(WIDGET_DIST_DIR)
+
+
+def serve_widget_file(name, immutable):
+    """Resposta do arquivo do widget com a melhor codificação aceita, ETag e 304."""
+    entry = widget_files.get(name)
+    if entry is None or entry[2] != immutable:
+        return jsonify({"error": "Arquivo não encontrado."}), 404
+    content_type, etag, _, bodies = entry
+
+    encoding = next((enc for enc, _ in WIDGET_ENCODINGS
+                     if enc in bodies and request.accept_encodings.quality(enc) > 0), None)
+    if encoding:
+        etag = f"{etag}-{encoding}"
+    headers = {"Cache-Control": WIDGET_IMMUTABLE_CACHE if immutable else "no-cache", "Vary": "Accept-Encoding"}
+
+    if request.if_none_match.contains_weak(etag):
+        CACHE_REQUESTS.labels("widget", "not_modified").inc()
+        response = Response(status=304, headers=headers)
+    else:
+        CACHE_REQUESTS.labels("widget", "sent").inc()
+        response = Response(bodies[encoding], content_type=content_type, headers=headers)
+        if encoding:
+            response.headers["Content-Encoding"] = encoding
+    response.set_etag(etag)
+    return response
@@ -0,0 +1,180 @@
+"""Write-behind das atualizações do lead no chat (fila coalescida gravada em lotes)."""
+import atexit
+import datetime
+import os
+import threading
+from collections import OrderedDict
+
+import psycopg2.extras
+from prometheus_client import Counter, Gauge
+
+from elo.db import db_cursor
+from elo.dedup import new_contact_params
+from elo.observability import log, observe_stage, record_error
+
+# --- Write-behind das Atualizações do Lead no Chat ---
+# Com CHAT_WRITE_BEHIND=1, a partir da 2ª rodada (o INSERT da 1ª continua
+# síncrono, para termos o id) o UPDATE dos campos do lead não é feito antes
+# da resposta: vai para uma fila do processo, coalescida por lead_id (só o
+# estado mais recente é gravado), que uma thread grava em lotes (um UPDATE
+# ... FROM VALUES) a cada CHAT_WRITE_BEHIND_INTERVAL segundos e ao sair do
+# processo (atexit). Continuam síncronas: a rodada que traz um email/WhatsApp
+# novo (precisa da checagem de duplicado) e, no modo sessão, o INSERT das
+# mensagens (o servidor é a fonte do histórico, lido por qualquer worker).
+# O risco é perder até um intervalo de atualizações se o processo morrer sem
+# atexit (kill -9/OOM); a fila aparece em elo_chat_write_behind_pending.
+# 'chat_atualizado_em' garante que um lote atrasado de outro worker não
+# sobrescreve um estado mais novo.
+CHAT_WRITE_BEHIND = os.environ.get("CHAT_WRITE_BEHIND", "0") == "1"
+CHAT_WRITE_BEHIND_INTERVAL = float(os.environ.get("CHAT_WRITE_BEHIND_INTERVAL", 1.0))  # segundos
+CHAT_WRITE_BEHIND_BATCH = int(os.environ.get("CHAT_WRITE_BEHIND_BATCH", 500))
+CHAT_WRITE_BEHIND_MAX_PENDING = int(os.environ.get("CHAT_WRITE_BEHIND_MAX_PENDING", 5000))  # cheia: volta a ser síncrono
+
+ADD_CHAT_UPDATED_AT_SQL = "ALTER TABLE elo_leads ADD COLUMN IF NOT EXISTS chat_atualizado_em TIMESTAMP WITH TIME ZONE;"
+WRITE_BEHIND_FLUSH_SQL = """
+UPDATE elo_leads AS l SET
+    nome = COALESCE(v.nome, l.nome),
+    email = COALESCE(v.email, l.email),
+    empresa_ramo = COALESCE(v.empresa_ramo, l.empresa_ramo),
+    cargo = COALESCE(v.cargo, l.cargo),
+    ja_e_cliente = COALESCE(v.ja_e_cliente, l.ja_e_cliente),
+    whatsapp = COALESCE(v.whatsapp, l.whatsapp),
+    historico_chat = COALESCE(v.historico_chat::jsonb, l.historico_chat),
+    chat_atualizado_em = v.em
+FROM (VALUES %s) AS v (id, nome, email, empresa_ramo, cargo, ja_e_cliente, whatsapp, historico_chat, em)
+WHERE l.id = v.id AND (l.chat_atualizado_em IS NULL OR l.chat_atualizado_em <= v.em)
+"""
+WRITE_BEHIND_FIELDS = ('nome', 'email', 'empresa_ramo', 'cargo', 'ja_e_cliente', 'whatsapp')  # (ordem do VALUES acima)
+WRITE_BEHIND_FLUSH_TEMPLATE = "(%s::integer, %s, %s, %s, %s, %s, %s, %s::text, %s::timestamptz)"
+
+WRITE_BEHIND_PENDING = Gauge("elo_chat_write_behind_pending", "Leads com atualização do chat ainda não gravada.",
+                             multiprocess_mode="livesum")
+WRITE_BEHIND_ROWS = Counter("elo_chat_write_behind_rows_total", "Atualizações do write-behind por resultado.", ["result"])
+
+
+class LeadWriteBehind:
+    """Fila coalescida lead_id -> últimos parâmetros do UPDATE, gravada em lotes por uma thread."""
+
+    def __init__(self, enabled, interval, batch_size, max_pending):
+        self.enabled = enabled
+        self.interval = interval
+        self.batch_size = batch_size
+        self.max_pending = max_pending
+        self._pending = OrderedDict()
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()  # (um lote por vez; discard() espera o lote em andamento)
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._stats = {"enfileiradas": 0, "coalescidas": 0, "gravadas": 0, "ignoradas_antigas": 0,
+                       "falhas": 0, "fila_cheia": 0}
+
+    def enqueue(self, turn, merged):
+        """Enfileira o UPDATE da rodada. False = a rodada deve gravar de forma síncrona."""
+        if not self.enabled or not turn['lead_id'] or new_contact_params(turn, merged) is not None:
+            return False
+        lead_data = merged['new_lead_data']
+        row = (turn['lead_id'], *[lead_data.get(field) for field in WRITE_BEHIND_FIELDS],
+               merged['history_json'], datetime.datetime.now(datetime.timezone.utc))
+        with self._lock:
+            coalesced = turn['lead_id'] in self._pending
+            if not coalesced and len(self._pending) >= self.max_pending:
+                self._stats["fila_cheia"] += 1
+                return False
+            self._pending[turn['lead_id']] = row
+            self._stats["coalescidas" if coalesced else "enfileiradas"] += 1
+            if not coalesced:
+                WRITE_BEHIND_PENDING.inc()
+        self._ensure_thread()
+        return True
+
+    def discard(self, lead_id):
+        """Descarta o pendente do lead (uma escrita síncrona com o estado completo vai substituí-lo)."""
+        if not self.enabled:
+            return
+        with self._flush_lock, self._lock:
+            if self._pending.pop(lead_id, None) is not None:
+                WRITE_BEHIND_PENDING.dec()
+
+    def _take_batch(self):
+        with self._lock:
+            batch = []
+            while self._pending and len(batch) < self.batch_size:
+                batch.append(self._pending.popitem(last=False)[1])
+            WRITE_BEHIND_PENDING.dec(len(batch))
+            return batch
+
+    def _requeue(self, batch):
+        """Lote que falhou volta para a fila, sem passar por cima de um estado mais novo do mesmo lead."""
+        with self._lock:
+            for row in batch:
+                if row[0] not in self._pending:
+                    self._pending[row[0]] = row
+                    self._pending.move_to_end(row[0], last=False)
+                    WRITE_BEHIND_PENDING.inc()
+
+    def flush(self):
+        """Grava tudo o que está pendente. Devolve quantas linhas foram atualizadas."""
+        written = 0
+        with self._flush_lock:
+            while True:
+                batch = self._take_batch()
+                if not batch:
+                    return written
+                try:
+                    with observe_stage("write_behind"), db_cursor() as cur:
+                        psycopg2.extras.execute_values(cur, WRITE_BEHIND_FLUSH_SQL, batch,
+                                                       template=WRITE_BEHIND_FLUSH_TEMPLATE, page_size=len(batch))
+                        updated = cur.rowcount
+                except Exception as e_db:
+                    self._requeue(batch)
+                    record_error("write_behind", e_db)
+                    WRITE_BEHIND_ROWS.labels("failed").inc(len(batch))
+                    with self._lock:
+                        self._stats["falhas"] += len(batch)
+                    log.error(f"[WriteBehind] Falha ao gravar lote de {len(batch)} lead(s); tenta de novo depois: {e_db}")
+                    return written
+                written += updated
+                WRITE_BEHIND_ROWS.labels("written").inc(updated)
+                WRITE_BEHIND_ROWS.labels("stale").inc(len(batch) - updated)
+                with self._lock:
+                    self._stats["gravadas"] += updated
+                    self._stats["ignoradas_antigas"] += len(batch) - updated
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                log.exception(f"[WriteBehind] Erro inesperado no flush: {e}")
+
+    def _ensure_thread(self):
+        # Criada sob demanda: threads não sobrevivem ao fork do gunicorn
+        if self._thread is not None and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="lead-write-behind", daemon=True)
+                self._thread.start()
+
+    def flush_on_exit(self):
+        pending = self.pending()
+        if pending:
+            log.info(f"[WriteBehind] Gravando {pending} lead(s) pendente(s) antes de sair.")
+            self.flush()
+            if self.pending():
+                log.error(f"[WriteBehind] {self.pending()} lead(s) NÃO foram gravados ao sair.")
+
+    def pending(self):
+        with self._lock:
+            return len(self._pending)
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, ativo=self.enabled, pendentes=len(self._pending))
+
+
+lead_write_behind = LeadWriteBehind(CHAT_WRITE_BEHIND, CHAT_WRITE_BEHIND_INTERVAL,
+                                    CHAT_WRITE_BEHIND_BATCH, CHAT_WRITE_BEHIND_MAX_PENDING)
+atexit.register(lead_write_behind.flush_on_exit)
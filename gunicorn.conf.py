@@ -0,0 +1,40 @@
+"""
+Configuração do gunicorn (carregada automaticamente com `gunicorn app:app`).
+
+Liga o modo multiprocesso do prometheus_client: cada worker grava as
+métricas num diretório compartilhado e o /metrics de qualquer worker soma
+todos. O diretório é limpo ao subir o master e os arquivos de um worker
+morto deixam de contar nos gauges 'livesum'. Também sobe o dispatcher da
+outbox em cada worker assim que ele carrega a aplicação.
+
+Com DB_MIGRATE_ON_START=1, o master roda migrate.py uma vez antes de criar
+os workers (e não sobe se a migração falhar). Num processo à parte: o master
+não importa o app, senão o pool de conexões e as threads dele iriam para os
+workers no fork.
+"""
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", os.path.join(tempfile.gettempdir(), "elo-prometheus"))
+
+
+def on_starting(server):
+    path = os.environ["PROMETHEUS_MULTIPROC_DIR"]
+    shutil.rmtree(path, ignore_errors=True)
+    os.makedirs(path, exist_ok=True)
+    if os.environ.get("DB_MIGRATE_ON_START", "0") == "1":
+        subprocess.run([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "migrate.py")],
+                       check=True)
+
+
+def post_worker_init(worker):
+    from elo.outbox import outbox_dispatcher
+    outbox_dispatcher.start()
+
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
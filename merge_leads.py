@@ -0,0 +1,20 @@
+"""
+Junta os leads duplicados (mesmo email/WhatsApp normalizado, ou já ligados
+por merged_into) no lead mais antigo de cada grupo, re-apontando orçamentos
+e mensagens do chat.
+
+Uso (fora do horário de pico; --dry-run só conta):
+    python merge_leads.py [--chunk-size 20000] [--dry-run]
+"""
+from cli import parser, report, require_database
+
+from elo.dedup import MERGE_LEADS_SCAN_CHUNK, merge_duplicate_leads
+
+
+if __name__ == "__main__":
+    arg_parser = parser(__doc__)
+    arg_parser.add_argument('--chunk-size', type=int, default=MERGE_LEADS_SCAN_CHUNK)
+    arg_parser.add_argument('--dry-run', action='store_true', help="só conta os duplicados, sem gravar")
+    args = arg_parser.parse_args()
+    require_database()
+    report("[Dedup] Resultado do merge.", merge_duplicate_leads(args.dry_run, args.chunk_size))
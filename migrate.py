@@ -0,0 +1,23 @@
+"""
+Aplica as migrações pendentes do banco e sai (código != 0 se falhar).
+
+Uso (no passo de release do deploy, antes de subir os workers; o gunicorn
+também o chama ao subir quando DB_MIGRATE_ON_START=1):
+    python migrate.py
+"""
+import sys
+
+from elo.db import DATABASE_URL, db_pool
+from elo.migrations import run_migrations
+from elo.observability import log
+
+
+if __name__ == "__main__":
+    if not DATABASE_URL:
+        sys.exit("DATABASE_URL não configurada.")
+    conn = db_pool.getconn()
+    try:
+        applied = run_migrations(conn)
+    finally:
+        db_pool.putconn(conn)
+    log.info(f"[DB] Migrações aplicadas: {applied}." if applied else "[DB] Schema já está na última versão.")
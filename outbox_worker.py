@@ -0,0 +1,17 @@
+"""
+Worker separado para entregar a outbox do webhook de VENDAS.
+
+Uso (com a API rodando em OUTBOX_DISPATCHER_MODE=worker):
+    python outbox_worker.py
+"""
+import signal
+
+from elo.outbox import outbox_dispatcher
+
+
+if __name__ == "__main__":
+    signal.signal(signal.SIGTERM, lambda *_: outbox_dispatcher.stop())
+    try:
+        outbox_dispatcher.run_forever()
+    except KeyboardInterrupt:
+        outbox_dispatcher.stop()
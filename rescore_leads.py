@@ -0,0 +1,18 @@
+"""
+Repontua (Quente/Frio) todos os leads com as regras atuais do LeadScorer.
+
+Uso (depois de mudar LEAD_SCORE_HOT_CARGOS / LEAD_SCORE_CNPJ_NEGATIVES):
+    python rescore_leads.py [--chunk-size 5000] [--dry-run]
+"""
+from cli import parser, report, require_database
+
+from app import RESCORE_CHUNK_SIZE, rescore_leads
+
+
+if __name__ == "__main__":
+    arg_parser = parser(__doc__)
+    arg_parser.add_argument('--chunk-size', type=int, default=RESCORE_CHUNK_SIZE)
+    arg_parser.add_argument('--dry-run', action='store_true', help="só conta o que mudaria, sem gravar")
+    args = arg_parser.parse_args()
+    require_database()
+    report("[Rescore] Repontuação concluída.", rescore_leads(args.chunk_size, args.dry_run))
@@ -0,0 +1,82 @@
+"""
+Configuração comum dos testes: o app sobe sem DATABASE_URL, então nenhum
+teste toca um banco por acidente.
+
+Os testes que precisam de um PostgreSQL de verdade usam o fixture `pg_pool`:
+ele aponta o pool do app para TEST_DATABASE_URL (um banco descartável; o
+schema public é recriado a cada teste) e pula o teste quando ela não existe.
+Ex.: TEST_DATABASE_URL=postgresql://postgres@localhost/elo_test python -m pytest -q
+"""
+import json
+import os
+import sys
+from types import SimpleNamespace
+
+os.environ.pop("DATABASE_URL", None)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import psycopg2  # noqa: E402
+import pytest  # noqa: E402
+
+import app as core  # noqa: E402
+from elo import db  # noqa: E402
+
+TEST_DATABASE_URL = os.environ.get("TEST_DATABASE_URL")
+
+
+@pytest.fixture
+def pg_dsn():
+    if not TEST_DATABASE_URL:
+        pytest.skip("TEST_DATABASE_URL não configurada")
+    conn = psycopg2.connect(TEST_DATABASE_URL)
+    conn.autocommit = True
+    with conn.cursor() as cur:
+        cur.execute("DROP SCHEMA public CASCADE; CREATE SCHEMA public;")
+    conn.close()
+    return TEST_DATABASE_URL
+
+
+@pytest.fixture
+def pg_pool(pg_dsn, monkeypatch):
+    """Pool do app num banco de teste vazio."""
+    pool = db.DatabasePool(pg_dsn, 1, 4, 2, 30)
+    monkeypatch.setattr(db, "db_pool", pool)
+    monkeypatch.setattr(db, "DATABASE_URL", pg_dsn)
+    yield pool
+    pool.closeall()
+
+
+@pytest.fixture
+def client():
+    core.app.config["TESTING"] = True
+    return core.app.test_client()
+
+
+class FakeGemini:
+    """Faz o papel do genai.GenerativeModel: responde `reply` e guarda os `contents` recebidos."""
+
+    def __init__(self):
+        self.reply = {"botResponse": "Olá! Qual é o seu nome?", "extractedData": {}}
+        self.calls = []
+
+    def __call__(self, model_name, system_instruction=None, **kwargs):
+        return self
+
+    def generate_content(self, contents, stream=False, **kwargs):
+        self.calls.append(contents)
+        text = json.dumps(self.reply)
+        if stream:  # (pedaços de 7 caracteres, cortando escapes no meio)
+            return [SimpleNamespace(text=text[i:i + 7]) for i in range(0, len(text), 7)]
+        return SimpleNamespace(text=text)
+
+    async def generate_content_async(self, contents, **kwargs):
+        return self.generate_content(contents, **kwargs)
+
+
+@pytest.fixture
+def gemini(monkeypatch):
+    fake = FakeGemini()
+    monkeypatch.setattr(core.genai, "GenerativeModel", fake)
+    monkeypatch.setattr(core, "model", fake)
+    monkeypatch.setattr(core, "_chat_model", None)  # (o modelo do chat é criado uma vez por worker)
+    return fake
@@ -0,0 +1,176 @@
+import asyncio
+import json
+import time
+from types import SimpleNamespace
+
+from psycopg_pool import AsyncConnectionPool
+
+import app as core
+import asgi_app
+
+
+async def asgi_request(method, path, body=None, headers=()):
+    """Chama asgi_app.application como o uvicorn faria; devolve (status, headers, corpo)."""
+    payload = json.dumps(body).encode('utf-8') if body is not None else b''
+    scope = {
+        'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': method,
+        'scheme': 'http', 'path': path, 'raw_path': path.encode('utf-8'), 'query_string': b'',
+        'root_path': '', 'client': ('127.0.0.1', 50000), 'server': ('testserver', 80),
+        'headers': [(b'host', b'testserver'), (b'content-type', b'application/json'),
+                    (b'content-length', str(len(payload)).encode('ascii'))]
+                   + [(k.lower().encode('latin-1'), v.encode('latin-1')) for k, v in headers],
+    }
+    inbox = [{'type': 'http.request', 'body': payload, 'more_body': False}]
+    sent = []
+
+    async def receive():
+        if inbox:
+            return inbox.pop(0)
+        await asyncio.sleep(3600)  # (o cliente não desconecta durante o teste)
+
+    async def send(message):
+        sent.append(message)
+
+    await asgi_app.application(scope, receive, send)
+    start = next(m for m in sent if m['type'] == 'http.response.start')
+    headers = {k.decode('latin-1').lower(): v.decode('latin-1') for k, v in start['headers']}
+    return start['status'], headers, b''.join(m.get('body', b'') for m in sent if m['type'] == 'http.response.body')
+
+
+def request(method, path, body=None, headers=()):
+    return asyncio.run(asgi_request(method, path, body, headers))
+
+
+def test_chat_runs_on_the_async_app(gemini):
+    gemini.reply = {"botResponse": "Prazer, Ana!", "extractedData": {"nome": "Ana"}}
+    status, headers, body = request('POST', '/api/chat', {"message": "Sou a Ana", "leadData": {}})
+    assert status == 200
+    assert headers['access-control-allow-origin'] == '*'
+    assert json.loads(body)["leadData"] == {"nome": "Ana"}
+
+
+def test_other_routes_go_to_flask():
+    status, _, body = request('GET', '/')
+    assert status == 200
+    assert "está rodando" in json.loads(body)["message"]
+    assert request('POST', '/api/save-lead', {})[0] == 400
+
+
+def test_isca_misses_share_one_model_call(gemini, monkeypatch):
+    monkeypatch.setattr(core, "isca_cache", core.IscaCache(10, 60, 30))
+    calls = []
+
+    async def generate(ramo):
+        calls.append(ramo)
+        await asyncio.sleep(0.05)
+        return f"isca de {ramo}"
+
+    monkeypatch.setattr(asgi_app, "generate_isca", generate)
+
+    async def scenario():
+        return await asyncio.gather(*(asgi_app.get_or_generate_isca("Escola") for _ in range(5)))
+
+    assert asyncio.run(scenario()) == ["isca de Escola"] * 5
+    assert calls == ["Escola"]
+    assert core.isca_cache.stats()["coalesced"] == 4
+
+
+def test_session_turn_is_stored_through_the_async_pool(pg_pool, gemini, monkeypatch):
+    core.setup_database()
+    core.conversation_cache._data.clear()
+    gemini.reply = {"botResponse": "Prazer!", "extractedData": {"nome": "Ana"}}
+
+    async def scenario():
+        pool = AsyncConnectionPool(pg_pool.dsn, min_size=1, max_size=2, open=False)
+        await pool.open()
+        monkeypatch.setattr(asgi_app, "db_pool", pool)
+        try:
+            return await asgi_request('POST', '/api/chat', {"message": "Sou a Ana", "leadData": {}})
+        finally:
+            await pool.close()
+
+    status, _, body = asyncio.run(scenario())
+    assert status == 200
+    lead_id = json.loads(body)["leadId"]
+    with core.db_cursor() as cur:
+        cur.execute("SELECT role, texto FROM elo_chat_messages WHERE lead_id = %s ORDER BY id", (lead_id,))
+        assert cur.fetchall() == [('user', 'Sou a Ana'), ('bot', 'Prazer!')]
+
+
+def test_async_chat_links_known_contacts_and_replays(pg_pool, gemini, monkeypatch):
+    core.setup_database()
+    with core.db_cursor() as cur:
+        cur.execute("INSERT INTO elo_leads (nome, email) VALUES ('Ana', 'ana@escola.com') RETURNING id")
+        owner = cur.fetchone()[0]
+        cur.execute("INSERT INTO elo_leads (nome) VALUES ('Ana') RETURNING id")
+        session_lead = cur.fetchone()[0]
+    monkeypatch.setattr(asgi_app, "idempotency_store", asgi_app.AsyncIdempotencyStore(60, 100))
+    gemini.reply = {"botResponse": "Anotado!", "extractedData": {"email": "ANA@escola.com"}}
+    body = {"message": "ANA@escola.com", "leadData": {"nome": "Ana"}, "leadId": session_lead}
+    headers = [('Idempotency-Key', 'teste-asgi-0001')]
+
+    async def scenario():
+        pool = AsyncConnectionPool(pg_pool.dsn, min_size=1, max_size=2, open=False)
+        await pool.open()
+        monkeypatch.setattr(asgi_app, "db_pool", pool)
+        try:
+            return [await asgi_request('POST', '/api/chat', body, headers) for _ in range(2)]
+        finally:
+            await pool.close()
+
+    (status, _, first), (_, replay_headers, second) = asyncio.run(scenario())
+    assert status == 200 and json.loads(first)["leadId"] == session_lead
+    assert replay_headers['idempotent-replayed'] == 'true' and second == first
+    assert len(gemini.calls) == 1
+    with core.db_cursor() as cur:
+        cur.execute("SELECT merged_into FROM elo_leads WHERE id = %s", (session_lead,))
+        assert cur.fetchone()[0] == owner
+
+
+def test_async_llm_stats_needs_the_ops_key(monkeypatch):
+    monkeypatch.setattr(core, "OPS_SECRET_KEY", "segredo-ops")
+    assert request('GET', '/api/llm-stats')[0] == 401
+    status, _, body = request('GET', '/api/llm-stats', headers=[('Authorization', 'Bearer segredo-ops')])
+    assert status == 200
+    assert json.loads(body)["max_concurrent"] == asgi_app.llm_limiter.max_concurrent
+
+
+def test_flask_routes_run_concurrently(gemini, monkeypatch):
+    """Rotas síncronas (aqui o /api/chat-stream) não podem dividir uma única thread."""
+    def slow_stream(contents, stream=False, **kwargs):
+        time.sleep(0.3)
+        return [SimpleNamespace(text=json.dumps({"botResponse": "Oi!", "extractedData": {}}))]
+
+    monkeypatch.setattr(gemini, "generate_content", slow_stream)
+
+    async def scenario():
+        return await asyncio.gather(*(asgi_request('POST', '/api/chat-stream', {"message": f"Oi {i}", "leadData": {}})
+                                      for i in range(3)))
+
+    started = time.perf_counter()
+    results = asyncio.run(scenario())
+    elapsed = time.perf_counter() - started
+    assert [status for status, _, _ in results] == [200] * 3
+    assert all(b'event: done' in body for _, _, body in results)
+    assert elapsed < 0.6
+
+
+def test_worker_boot_starts_the_outbox_dispatcher(monkeypatch):
+    started = []
+    monkeypatch.setattr(core.outbox_dispatcher, "start", lambda: started.append(True))
+
+    async def lifespan():
+        inbox = [{'type': 'lifespan.startup'}, {'type': 'lifespan.shutdown'}]
+        sent = []
+
+        async def receive():
+            return inbox.pop(0)
+
+        async def send(message):
+            sent.append(message['type'])
+
+        await asgi_app.application({'type': 'lifespan', 'asgi': {'version': '3.0'}}, receive, send)
+        return sent
+
+    assert asyncio.run(lifespan()) == ['lifespan.startup.complete', 'lifespan.shutdown.complete']
+    assert started == [True]
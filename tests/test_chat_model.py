@@ -0,0 +1,25 @@
+import app as core
+
+
+def test_chat_model_is_built_once_per_worker(gemini, monkeypatch):
+    built = []
+    monkeypatch.setattr(core.genai, "GenerativeModel", lambda *args, **kwargs: built.append(kwargs) or gemini)
+    assert core.get_chat_model() is core.get_chat_model()
+    assert len(built) == 1
+    assert built[0]["system_instruction"] == core.CHAT_SYSTEM_PROMPT
+
+
+def test_turn_state_goes_ahead_of_the_latest_user_message():
+    window = [{'role': 'user', 'text': 'Oi'}, {'role': 'bot', 'text': 'Olá!'}, {'role': 'user', 'text': 'Sou a Ana'}]
+    contents = core.build_chat_contents(window, {'nome': 'Ana'}, summary='Usuário: começou')
+    assert [c['role'] for c in contents] == ['user', 'model', 'user']
+    state, latest = contents[-1]['parts']
+    assert state['text'].startswith("[ESTADO ATUAL]") and "{'nome': 'Ana'}" in state['text']
+    assert "Usuário: começou" in state['text']
+    assert latest == {'text': 'Sou a Ana'}
+    assert contents[0]['parts'] == [{'text': 'Oi'}]  # (o prefixo não muda entre rodadas)
+
+
+def test_state_gets_its_own_message_after_a_bot_turn():
+    contents = core.build_chat_contents([{'role': 'bot', 'text': 'Olá!'}], {})
+    assert [c['role'] for c in contents] == ['model', 'user']
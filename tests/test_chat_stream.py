@@ -0,0 +1,146 @@
+import json
+
+import pytest
+
+import app as core
+
+
+def feed_all(chunks):
+    parser = core.BotResponseStreamParser()
+    text = ''.join(parser.feed(chunk) for chunk in chunks)
+    return parser, text
+
+
+class TestBotResponseStreamParser:
+    def test_text_arrives_incrementally(self):
+        parser = core.BotResponseStreamParser()
+        assert parser.feed('{"botResp') == ''
+        assert parser.feed('onse": "Olá, ') == 'Olá, '
+        assert parser.feed('tudo bem?", "extractedData": {}}') == 'tudo bem?'
+        assert parser.done
+        assert json.loads(parser.buffer)["botResponse"] == 'Olá, tudo bem?'
+
+    def test_escapes_split_across_chunks(self):
+        payload = json.dumps({"botResponse": 'Linha 1\nDisse "oi" \\ fim\t.', "extractedData": {}})
+        _, text = feed_all(payload)  # (um caractere por pedaço)
+        assert text == 'Linha 1\nDisse "oi" \\ fim\t.'
+
+    def test_unicode_escape_split_across_chunks(self):
+        payload = '{"botResponse": "Cora\\u00e7\\u00e3o"}'
+        cut = payload.index('\\u00e3') + 3
+        _, text = feed_all([payload[:cut], payload[cut:]])
+        assert text == 'Coração'
+
+    @pytest.mark.parametrize("cut", range(1, 12))
+    def test_surrogate_pair_split_anywhere(self, cut):
+        payload = json.dumps({"botResponse": "Oi 😀!"})  # (ensure_ascii: vira \ud83d\ude00)
+        start = payload.index('\\ud83d')
+        _, text = feed_all([payload[:start + cut], payload[start + cut:]])
+        assert text == "Oi 😀!"
+
+    def test_ignores_everything_after_the_closing_quote(self):
+        parser, text = feed_all(['{"botResponse": "fim"', ', "extractedData": {"nome": "x"}}'])
+        assert text == 'fim'
+        assert parser.feed(' ') == ''
+
+    def test_key_after_other_fields(self):
+        _, text = feed_all(['{"extractedData": {}, ', '"botResponse"  :  "ok"}'])
+        assert text == 'ok'
+
+
+def test_sse_event_framing():
+    assert core.sse_event('token', {"text": "Olá\nmundo"}) == 'event: token\ndata: {"text": "Olá\\nmundo"}\n\n'
+
+
+def read_events(response):
+    """[(evento, payload), ...] de um corpo text/event-stream."""
+    events = []
+    for block in response.get_data(as_text=True).split('\n\n'):
+        if block:
+            event, data = block.split('\n')
+            events.append((event[len('event: '):], json.loads(data[len('data: '):])))
+    return events
+
+
+class TestChatStreamEndpoint:
+    def test_tokens_then_done(self, client, gemini):
+        gemini.reply = {"botResponse": 'Prazer, "Ana"! 😀 Qual o seu ramo?', "extractedData": {"nome": "Ana"}}
+        response = client.post('/api/chat-stream', json={"message": "Sou a Ana", "leadData": {}})
+        assert response.status_code == 200
+        assert response.mimetype == 'text/event-stream'
+        assert response.headers['Cache-Control'] == 'no-cache'
+
+        events = read_events(response)
+        names = [name for name, _ in events]
+        assert names[-1] == 'done' and set(names[:-1]) == {'token'} and len(names) > 2
+        assert ''.join(payload['text'] for _, payload in events[:-1]) == gemini.reply['botResponse']
+        done = events[-1][1]
+        assert done['botResponse'] == gemini.reply['botResponse']
+        assert done['leadData'] == {"nome": "Ana"}
+        assert done['isComplete'] is False
+
+    def test_invalid_json_from_the_model_is_an_error_event(self, client, gemini, monkeypatch):
+        monkeypatch.setattr(gemini, "generate_content", lambda *a, **k: [type('C', (), {'text': '{"botResponse": "oi'})()])
+        events = read_events(client.post('/api/chat-stream', json={"message": "Oi", "leadData": {}}))
+        assert events[-1] == ('error', {"error": "Erro ao processar a resposta da IA."})
+
+    def test_bad_payload_is_rejected_before_streaming(self, client, gemini):
+        response = client.post('/api/chat-stream', json={"message": "", "leadData": {}})
+        assert response.status_code == 400
+        assert gemini.calls == []
+
+    def test_done_comes_after_the_turn_is_stored(self, pg_pool, client, gemini):
+        core.setup_database()
+        core.conversation_cache._data.clear()
+        gemini.reply = {"botResponse": "Prazer!", "extractedData": {"nome": "Ana"}}
+        events = read_events(client.post('/api/chat-stream', json={"message": "Sou a Ana", "leadData": {}}))
+        lead_id = events[-1][1]['leadId']
+        with core.db_cursor() as cur:
+            cur.execute("SELECT nome FROM elo_leads WHERE id = %s", (lead_id,))
+            assert cur.fetchone()[0] == 'Ana'
+            cur.execute("SELECT role, texto FROM elo_chat_messages WHERE lead_id = %s ORDER BY id", (lead_id,))
+            assert cur.fetchall() == [('user', 'Sou a Ana'), ('bot', 'Prazer!')]
+
+    def test_model_calls_go_through_the_tail_latency_runner(self, client, gemini, monkeypatch):
+        run = core.TailLatencyRunner(core.AdmissionLimiter(2, 0, 1, 0, 1, 30), 2, 0.1)
+        monkeypatch.setattr(core, "llm_tail", run)
+        read_events(client.post('/api/chat-stream', json={"message": "Oi", "leadData": {}}))
+        assert run.stats()["chat.primary.won"] == 1
+        assert run.limiter.stats()["in_flight"] == 0
+
+
+class TestChatStreamIdempotency:
+    BODY = {"message": "Sou a Ana", "leadData": {}}
+
+    def post(self, client, path, key='teste-stream-001'):
+        return client.post(path, json=self.BODY, headers={'Idempotency-Key': key})
+
+    def test_repeated_stream_is_replayed_as_sse(self, client, gemini):
+        gemini.reply = {"botResponse": "Prazer, Ana!", "extractedData": {"nome": "Ana"}}
+        first = read_events(self.post(client, '/api/chat-stream'))
+        replay = self.post(client, '/api/chat-stream')
+        assert replay.headers['Idempotent-Replayed'] == 'true'
+        assert replay.mimetype == 'text/event-stream'
+        assert read_events(replay) == [('token', {"text": "Prazer, Ana!"}), first[-1]]
+        assert len(gemini.calls) == 1
+
+    def test_keys_are_shared_with_the_chat_endpoint(self, client, gemini):
+        done = read_events(self.post(client, '/api/chat-stream', 'teste-stream-002'))[-1][1]
+        replay = self.post(client, '/api/chat', 'teste-stream-002')
+        assert replay.headers['Idempotent-Replayed'] == 'true'
+        assert replay.get_json() == done
+        assert len(gemini.calls) == 1
+
+    def test_failed_stream_can_be_retried(self, client, gemini, monkeypatch):
+        with monkeypatch.context() as m:
+            m.setattr(gemini, "generate_content", lambda *a, **k: [type('C', (), {'text': '{"botResponse": "oi'})()])
+            assert read_events(self.post(client, '/api/chat-stream', 'teste-stream-003'))[-1][0] == 'error'
+        retry = self.post(client, '/api/chat-stream', 'teste-stream-003')
+        assert 'Idempotent-Replayed' not in retry.headers
+        assert read_events(retry)[-1][0] == 'done'
+
+    def test_other_body_with_the_same_key_is_422(self, client, gemini):
+        read_events(self.post(client, '/api/chat-stream', 'teste-stream-004'))
+        response = client.post('/api/chat-stream', json={"message": "Outra", "leadData": {}},
+                               headers={'Idempotency-Key': 'teste-stream-004'})
+        assert response.status_code == 422
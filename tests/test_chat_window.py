@@ -0,0 +1,55 @@
+import pytest
+
+import app as core
+
+
+def message(role, i, size=80):
+    return {'role': role, 'text': f"{i:02d} " + 'x' * (size - 3)}
+
+
+@pytest.fixture
+def small_budget(monkeypatch):
+    monkeypatch.setattr(core, "CHAT_HISTORY_TOKEN_BUDGET", 100)
+    monkeypatch.setattr(core, "CHAT_HISTORY_KEEP_MESSAGES", 4)
+
+
+class TestWindowHistory:
+    def test_short_history_goes_whole(self):
+        history = [message('user', 0), message('bot', 1)]
+        window, summary = core.window_history({'history': history, 'lead_id': None})
+        assert window == history
+        assert summary == ''
+
+    def test_long_history_is_cut_and_summarized(self, small_budget):
+        history = [message('user' if i % 2 == 0 else 'bot', i) for i in range(10)]
+        turn = {'history': history, 'lead_id': None}
+        window, summary = core.window_history(turn)
+        # 4 literais (80 tokens) + reserva do resumo (25) estouram 100: sobra a partir da 8ª
+        assert window == history[7:]
+        assert summary.splitlines()[0].startswith('Usuário: 00')
+        assert len(summary.splitlines()) == 7
+        assert turn['token_window']['sent_messages'] == 3
+        assert turn['token_window']['estimated_full_tokens'] == 200
+
+    def test_summary_only_grows_for_the_same_lead(self, small_budget):
+        lead_id = 990_001
+        core.summary_cache._data.pop(lead_id, None)
+        history = [message('user' if i % 2 == 0 else 'bot', i) for i in range(10)]
+        core.window_history({'history': history, 'lead_id': lead_id})
+
+        # (Mensagens curtas caberiam inteiras, mas o que já foi resumido não volta)
+        short = [message(m['role'], i, size=8) for i, m in enumerate(history)]
+        window, summary = core.window_history({'history': short + [message('user', 10, size=8)], 'lead_id': lead_id})
+        assert window == short[7:] + [message('user', 10, size=8)]
+        assert len(summary.splitlines()) == 7
+        core.summary_cache._data.pop(lead_id, None)
+
+
+def test_token_log_has_no_lead_ids(client, gemini, monkeypatch):
+    monkeypatch.setattr(core, "OPS_SECRET_KEY", "segredo-ops")
+    history = [message('user' if i % 2 == 0 else 'bot', i) for i in range(3)]
+    client.post('/api/chat', json={"conversationHistory": history, "leadData": {}, "leadId": 990_002})
+    stats = client.get('/api/cache-stats', headers={'Authorization': 'Bearer segredo-ops'}).get_json()
+    entry = stats["chat_tokens"]["recent"][-1]
+    assert entry["history_messages"] == 3
+    assert "lead_id" not in entry
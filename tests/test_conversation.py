@@ -0,0 +1,80 @@
+import time
+
+import pytest
+
+import app as core
+
+
+class TestConversationCache:
+    def test_least_recently_used_session_is_evicted(self):
+        cache = core.ConversationCache(2, 60)
+        cache.put(1, [{'role': 'user', 'text': 'a'}], 10)
+        cache.put(2, [], 20)
+        cache.get(1)
+        cache.put(3, [], 30)
+        assert cache.get(2) == ([], 0)
+        assert cache.get(1) == ([{'role': 'user', 'text': 'a'}], 10)
+
+    def test_expired_session_is_a_miss(self, monkeypatch):
+        cache = core.ConversationCache(10, 60)
+        cache.put(1, [{'role': 'user', 'text': 'a'}], 10)
+        real_monotonic = time.monotonic
+        monkeypatch.setattr(core.time, "monotonic", lambda: real_monotonic() + 61)
+        assert cache.get(1) == ([], 0)
+        assert (cache.hits, cache.misses) == (0, 1)
+
+    def test_get_returns_a_copy(self):
+        cache = core.ConversationCache(10, 60)
+        cache.put(1, [], 0)
+        cache.get(1)[0].append('x')
+        assert cache.get(1) == ([], 0)
+
+
+@pytest.fixture
+def chat_db(pg_pool):
+    core.setup_database()
+    core.conversation_cache._data.clear()
+    return pg_pool
+
+
+def new_lead():
+    with core.db_cursor() as cur:
+        cur.execute("INSERT INTO elo_leads (nome) VALUES ('Ana') RETURNING id")
+        return cur.fetchone()[0]
+
+
+class TestStoredConversation:
+    def test_only_new_rows_are_fetched(self, chat_db):
+        lead_id = new_lead()
+        with core.db_cursor() as cur:
+            core.append_conversation(cur, lead_id, [], [{'role': 'user', 'text': 'oi'}, {'role': 'bot', 'text': 'olá'}])
+            # (outro worker gravou uma rodada que este cache não viu)
+            cur.execute("INSERT INTO elo_chat_messages (lead_id, role, texto) VALUES (%s, 'user', 'tudo bem?')", (lead_id,))
+        with core.db_cursor() as cur:
+            history = core.load_conversation(cur, lead_id)
+            assert [m['text'] for m in history] == ['oi', 'olá', 'tudo bem?']
+            last_id = core.conversation_cache.get(lead_id)[1]
+            cur.execute("SELECT max(id) FROM elo_chat_messages")
+            assert last_id == cur.fetchone()[0]
+
+    def test_session_mode_rebuilds_the_history_on_the_server(self, chat_db, client, gemini):
+        gemini.reply = {"botResponse": "Prazer, Ana!", "extractedData": {"nome": "Ana"}}
+        first = client.post('/api/chat', json={"message": "Sou a Ana", "leadData": {}})
+        assert first.status_code == 200
+        lead_id = first.get_json()["leadId"]
+
+        gemini.reply = {"botResponse": "Qual o ramo?", "extractedData": {}}
+        second = client.post('/api/chat', json={"message": "Oi de novo", "leadData": {"nome": "Ana"}, "leadId": lead_id})
+        assert second.status_code == 200
+        sent = [content['parts'][-1]['text'] for content in gemini.calls[-1]]  # (sem a parte [ESTADO ATUAL])
+        assert sent == ['Sou a Ana', 'Prazer, Ana!', 'Oi de novo']
+
+        with core.db_cursor() as cur:
+            cur.execute("SELECT role, texto FROM elo_chat_messages WHERE lead_id = %s ORDER BY id", (lead_id,))
+            assert [row[0] for row in cur.fetchall()] == ['user', 'bot', 'user', 'bot']
+            cur.execute("SELECT historico_chat FROM elo_leads WHERE id = %s", (lead_id,))
+            assert cur.fetchone()[0] is None
+
+    def test_session_mode_needs_a_message(self, client, gemini):
+        response = client.post('/api/chat', json={"message": "  ", "leadData": {}})
+        assert response.status_code == 400
@@ -0,0 +1,107 @@
+import threading
+
+import psycopg2
+import pytest
+
+import app as core
+from elo import db
+
+
+def saturated_pool():
+    """Pool sem banco com a única vaga já ocupada."""
+    pool = db.DatabasePool(None, 1, 1, 0.05, 30)
+    pool._slots.acquire()
+    return pool
+
+
+class TestWithoutDatabase:
+    def test_saturated_pool_is_503_with_retry_after(self, client, monkeypatch):
+        monkeypatch.setattr(db, "db_pool", saturated_pool())
+        response = client.post('/api/save-lead', json={"lead_id": 1})
+        assert response.status_code == 503
+        assert response.headers["Retry-After"] == "1"
+
+    def test_timeout_is_counted(self):
+        pool = saturated_pool()
+        with pytest.raises(core.PoolTimeoutError):
+            pool.getconn()
+        assert pool.stats()["timeouts"] == 1
+
+    def test_failed_connect_gives_the_slot_back(self):
+        pool = db.DatabasePool(None, 1, 1, 0.05, 30)
+        for _ in range(2):  # (se a vaga vazasse, a 2ª seria PoolTimeoutError)
+            with pytest.raises(psycopg2.OperationalError):
+                pool.getconn()
+        assert pool.stats()["in_use"] == 0
+
+
+class TestPoolStatsAuth:
+    def test_without_ops_key_is_404(self, client, monkeypatch):
+        monkeypatch.setattr(core, "OPS_SECRET_KEY", None)
+        assert client.get('/api/pool-stats').status_code == 404
+
+    def test_wrong_token_is_401(self, client, monkeypatch):
+        monkeypatch.setattr(core, "OPS_SECRET_KEY", "segredo-ops")
+        response = client.get('/api/pool-stats', headers={'Authorization': 'Bearer outro'})
+        assert response.status_code == 401
+
+    def test_right_token_gets_the_stats(self, client, monkeypatch):
+        monkeypatch.setattr(core, "OPS_SECRET_KEY", "segredo-ops")
+        response = client.get('/api/pool-stats', headers={'Authorization': 'Bearer segredo-ops'})
+        assert response.status_code == 200
+        assert response.get_json()["max_size"] == db.db_pool.maxconn
+
+
+def backend_pid():
+    with core.db_cursor() as cur:
+        cur.execute("SELECT pg_backend_pid()")
+        return cur.fetchone()[0]
+
+
+class TestWithDatabase:
+    def test_connection_is_reused(self, pg_pool):
+        pids = {backend_pid() for _ in range(5)}
+        assert len(pids) == 1
+        stats = pg_pool.stats()
+        assert stats["checkouts"] == 5 and stats["in_use"] == 0 and stats["open"] == 1
+
+    def test_checkout_waits_for_a_released_connection(self, pg_dsn, monkeypatch):
+        pool = db.DatabasePool(pg_dsn, 1, 1, 2, 30)
+        monkeypatch.setattr(db, "db_pool", pool)
+        held = pool.getconn()
+        threading.Timer(0.1, pool.putconn, args=(held,)).start()
+        assert backend_pid()
+        assert pool.stats()["wait_seconds_total"] > 0
+        pool.closeall()
+
+    def test_error_rolls_back_and_returns_the_connection(self, pg_pool):
+        with core.db_cursor() as cur:
+            cur.execute("CREATE TABLE t (x integer)")
+        with pytest.raises(ZeroDivisionError):
+            with core.db_cursor() as cur:
+                cur.execute("INSERT INTO t VALUES (1)")
+                1 / 0
+        with core.db_cursor() as cur:
+            cur.execute("SELECT count(*) FROM t")
+            assert cur.fetchone()[0] == 0
+        assert pg_pool.stats()["in_use"] == 0
+
+    def test_broken_connection_is_discarded(self, pg_pool):
+        with pytest.raises(psycopg2.OperationalError):
+            with core.db_cursor() as cur:
+                cur.execute("SELECT pg_terminate_backend(pg_backend_pid())")
+        assert pg_pool.stats()["discarded"] == 1
+        assert backend_pid()
+
+    def test_stale_connection_is_health_checked(self, pg_pool, monkeypatch):
+        monkeypatch.setattr(pg_pool, "healthcheck_idle", 0)
+        pid = backend_pid()
+        admin = psycopg2.connect(pg_pool.dsn)
+        admin.autocommit = True
+        with admin.cursor() as cur:
+            cur.execute("SELECT pg_terminate_backend(%s)", (pid,))
+        admin.close()
+
+        assert backend_pid() != pid  # (a conexão morta foi trocada sem erro)
+        stats = pg_pool.stats()
+        assert stats["healthchecks"] >= 1 and stats["discarded"] == 1
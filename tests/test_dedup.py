@@ -0,0 +1,134 @@
+import pytest
+
+import app as core
+from elo import dedup
+
+LEAD_UP_TO_CARGO = {"nome": "Ana", "empresa_ramo": "Escola", "cargo": "Diretora"}
+
+
+@pytest.fixture
+def dedup_db(pg_pool):
+    core.setup_database()
+    return pg_pool
+
+
+def insert_lead(**fields):
+    with core.db_cursor() as cur:
+        cur.execute(f"INSERT INTO elo_leads ({', '.join(fields)}) VALUES ({', '.join(['%s'] * len(fields))}) RETURNING id",
+                    list(fields.values()))
+        return cur.fetchone()[0]
+
+
+def lead_row(lead_id, *columns):
+    with core.db_cursor() as cur:
+        cur.execute(f"SELECT {', '.join(columns)} FROM elo_leads WHERE id = %s", (lead_id,))
+        return cur.fetchone()
+
+
+@pytest.mark.parametrize("raw, expected", [
+    (" Ana@Escola.COM ", "ana@escola.com"),
+    ("ana@escola.com", "ana@escola.com"),
+])
+def test_email_key(dedup_db, raw, expected):
+    with core.db_cursor() as cur:
+        cur.execute(f"SELECT {dedup.LEAD_EMAIL_KEY_SQL.format('%s')}", (raw,))
+        assert cur.fetchone()[0] == expected
+
+
+@pytest.mark.parametrize("raw, expected", [
+    ("+55 (11) 98765-4321", "11987654321"),
+    ("11 98765-4321", "11987654321"),
+    ("(21) 3456-7890", "2134567890"),
+    ("5555", "5555"),  # (55 só sai quando sobra um número de 10/11 dígitos)
+])
+def test_whatsapp_key(dedup_db, raw, expected):
+    with core.db_cursor() as cur:
+        cur.execute(f"SELECT {dedup.LEAD_WHATSAPP_KEY_SQL.format('%s')}", (raw,))
+        assert cur.fetchone()[0] == expected
+
+
+class TestNewContactParams:
+    def turn(self, lead_data, lead_id=7):
+        return {'lead_id': lead_id, 'lead_data': lead_data}
+
+    def test_only_contacts_captured_this_turn(self):
+        turn = self.turn({"email": "ana@escola.com"})
+        merged = {'new_lead_data': {"email": "ana@escola.com", "whatsapp": "11 98765-4321"}}
+        assert dedup.new_contact_params(turn, merged) == {"email": None, "whatsapp": "11 98765-4321", "lead_id": 7}
+
+    @pytest.mark.parametrize("new_data", [{}, {"email": "sem arroba"}, {"whatsapp": "123"}])
+    def test_nothing_usable_is_none(self, new_data):
+        assert dedup.new_contact_params(self.turn({}, lead_id=None), {'new_lead_data': new_data}) is None
+
+
+def test_link_steps_stop_when_nobody_has_the_contact():
+    turn = {'lead_id': 7, 'lead_data': {}}
+    steps = core.link_known_contact_steps(7, turn, {'new_lead_data': {"email": "ana@escola.com"}})
+    sql, params = next(steps)
+    assert sql == dedup.FIND_LEAD_BY_CONTACT_SQL and params["lead_id"] == 7
+    with pytest.raises(StopIteration) as done:
+        steps.send([])
+    assert done.value.value is None
+
+
+def test_union_root_is_the_oldest_lead():
+    groups = dedup._LeadUnion()
+    groups.union(9, 5)
+    groups.union(7, 9)
+    groups.union(3, 7)
+    assert {groups.find(x) for x in (3, 5, 7, 9)} == {3}
+
+
+class TestChatLinksKnownContact:
+    def test_session_lead_is_linked_and_keeps_its_own_id(self, dedup_db, client, gemini):
+        owner = insert_lead(nome="Ana", email=" ANA@escola.com", historico_chat='[{"role": "user", "text": "segredo"}]')
+        session_lead = insert_lead(**LEAD_UP_TO_CARGO)
+
+        response = client.post('/api/chat', json={"message": "ana@escola.com", "leadData": LEAD_UP_TO_CARGO,
+                                                  "leadId": session_lead})
+        assert response.status_code == 200
+        assert response.get_json()["leadId"] == session_lead
+        assert lead_row(session_lead, 'merged_into', 'email') == (owner, "ana@escola.com")
+        assert lead_row(owner, 'merged_into', 'historico_chat') == (None, [{"role": "user", "text": "segredo"}])
+
+    def test_unknown_contact_is_not_linked(self, dedup_db, client, gemini):
+        session_lead = insert_lead(**LEAD_UP_TO_CARGO)
+        client.post('/api/chat', json={"message": "ana@escola.com", "leadData": LEAD_UP_TO_CARGO, "leadId": session_lead})
+        assert lead_row(session_lead, 'merged_into') == (None,)
+
+
+class TestMergeDuplicateLeads:
+    @pytest.fixture
+    def duplicates(self, dedup_db):
+        canonical = insert_lead(nome="Ana", email="ana@escola.com")
+        by_email = insert_lead(email=" Ana@Escola.com", whatsapp="11 98765-4321", status_lead="Quente")
+        by_whatsapp = insert_lead(nome="Ana S.", whatsapp="+55 (11) 98765-4321")
+        linked = insert_lead(nome="Ana", cargo="Diretora", merged_into=canonical)
+        other = insert_lead(nome="Bruno", email="bruno@escola.com")
+        with core.db_cursor() as cur:
+            cur.execute("INSERT INTO elo_orçar (lead_id, produto_desejado) VALUES (%s, 'Caneta')", (by_whatsapp,))
+            cur.execute("INSERT INTO elo_chat_messages (lead_id, role, texto) VALUES (%s, 'user', 'oi')", (linked,))
+        return canonical, by_email, by_whatsapp, linked, other
+
+    def test_groups_are_folded_into_the_oldest_lead(self, duplicates):
+        canonical, by_email, by_whatsapp, linked, other = duplicates
+        report = dedup.merge_duplicate_leads(chunk_size=2)
+        assert (report["duplicados"], report["grupos"], report["leads_apagados"]) == (3, 1, 3)
+
+        with core.db_cursor() as cur:
+            cur.execute("SELECT id FROM elo_leads ORDER BY id")
+            assert [row[0] for row in cur.fetchall()] == [canonical, other]
+            cur.execute("SELECT lead_id FROM elo_orçar")
+            assert cur.fetchone()[0] == canonical
+            cur.execute("SELECT lead_id FROM elo_chat_messages")
+            assert cur.fetchone()[0] == canonical
+        # (campos vazios do canônico vêm do duplicado mais recente; Quente se algum era)
+        assert lead_row(canonical, 'nome', 'cargo', 'whatsapp', 'status_lead', 'merged_into') == (
+            "Ana", "Diretora", None, "Quente", None)
+
+    def test_dry_run_only_counts(self, duplicates):
+        report = dedup.merge_duplicate_leads(dry_run=True)
+        assert (report["duplicados"], report["grupos"]) == (3, 1)
+        with core.db_cursor() as cur:
+            cur.execute("SELECT count(*) FROM elo_leads")
+            assert cur.fetchone()[0] == 5
@@ -0,0 +1,94 @@
+import csv
+import io
+import json
+
+import pytest
+
+import app as core
+
+AUTH = {'Authorization': 'Bearer segredo-export'}
+
+
+@pytest.fixture
+def export_key(monkeypatch):
+    monkeypatch.setattr(core, "EXPORT_SECRET_KEY", "segredo-export")
+
+
+@pytest.fixture
+def export_db(pg_pool, export_key, monkeypatch):
+    monkeypatch.setattr(core, "EXPORT_FETCH_SIZE", 2)  # (força vários lotes)
+    core.setup_database()
+    with core.db_cursor() as cur:
+        cur.execute("""
+            INSERT INTO elo_leads (nome, email, status, historico_chat) VALUES
+                ('Ana', 'ana@exemplo.com', 'Quente', '[{"role": "user", "text": "oi"}]'),
+                ('Bruno', 'bruno@exemplo.com', 'Frio', NULL),
+                ('Carla', 'carla@exemplo.com', 'Quente', NULL)
+            RETURNING id
+        """)
+        ids = sorted(row[0] for row in cur.fetchall())
+        cur.execute("INSERT INTO elo_orçar (lead_id, produto_desejado) VALUES (%s, 'Caneta'), (%s, 'Caderno')",
+                    (ids[0], ids[0]))
+    return ids
+
+
+def export(client, **args):
+    response = client.get('/api/export/leads', query_string=args, headers=AUTH)
+    assert response.status_code == 200
+    return response
+
+
+class TestAuth:
+    def test_disabled_without_its_own_key(self, client, monkeypatch):
+        monkeypatch.setattr(core, "EXPORT_SECRET_KEY", None)
+        response = client.get('/api/export/leads', headers={'Authorization': f'Bearer {core.N8N_SECRET_KEY}'})
+        assert response.status_code == 404
+
+    def test_needs_the_export_key(self, client, export_key):
+        assert client.get('/api/export/leads').status_code == 401
+        response = client.get('/api/export/leads', headers={'Authorization': f'Bearer {core.N8N_SECRET_KEY}'})
+        assert response.status_code == 401
+
+    @pytest.mark.parametrize("args", [{"format": "xlsx"}, {"since": "ontem"}, {"after": "x:y"}])
+    def test_rejects_bad_filters(self, client, export_key, args):
+        assert client.get('/api/export/leads', query_string=args, headers=AUTH).status_code == 400
+
+    def test_concurrent_exports_are_capped(self, client, export_key, monkeypatch):
+        slots = core.threading.BoundedSemaphore(1)
+        slots.acquire()
+        monkeypatch.setattr(core, "_export_slots", slots)
+        response = client.get('/api/export/leads', headers=AUTH)
+        assert response.status_code == 429
+        assert response.headers['Retry-After'] == '30'
+
+
+class TestStreamingFormat:
+    def test_csv_has_one_row_per_lead_and_quote(self, client, export_db):
+        response = export(client)
+        assert response.mimetype == 'text/csv'
+        assert response.headers['Content-Disposition'].startswith('attachment; filename="leads_')
+        rows = list(csv.DictReader(io.StringIO(response.get_data(as_text=True))))
+        assert [(int(r['lead_id']), r['produto_desejado']) for r in rows] == [
+            (export_db[0], 'Caneta'), (export_db[0], 'Caderno'), (export_db[1], ''), (export_db[2], '')]
+        assert json.loads(rows[0]['historico_chat']) == [{"role": "user", "text": "oi"}]
+
+    def test_ndjson_without_chat_and_filtered_by_status(self, client, export_db):
+        response = export(client, format='ndjson', include_chat='0', status='Quente')
+        assert response.mimetype == 'application/x-ndjson'
+        lines = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+        assert [line['lead_id'] for line in lines] == [export_db[0], export_db[0], export_db[2]]
+        assert 'historico_chat' not in lines[0]
+        assert lines[0]['lead_created_at'].startswith('20')
+
+    def test_resumes_after_the_last_row(self, client, export_db):
+        first_quote = json.loads(export(client, format='ndjson').get_data(as_text=True).splitlines()[0])
+        response = export(client, format='ndjson', after=f"{first_quote['lead_id']}:{first_quote['orcamento_id']}")
+        lines = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+        assert [(line['lead_id'], line['produto_desejado']) for line in lines] == [
+            (export_db[0], 'Caderno'), (export_db[1], None), (export_db[2], None)]
+
+    def test_connection_and_slot_are_released(self, client, export_db, pg_pool):
+        export(client)
+        assert pg_pool.stats()["in_use"] == 0
+        assert core._export_slots.acquire(blocking=False)
+        core._export_slots.release()
@@ -0,0 +1,88 @@
+import pytest
+
+import app as core
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("11 98765-4321", "(11) 98765-4321"),
+    ("+55 (11) 98765-4321", "(11) 98765-4321"),
+    ("meu whats é 11987654321", "(11) 98765-4321"),
+    ("(21) 3456-7890", "(21) 3456-7890"),
+    ("11 88765-4321", None),    # 11 dígitos sem o 9
+    ("01 98765-4321", None),    # DDD inválido
+    ("98765-4321", None),       # sem DDD
+    ("11222333000181", None),   # CNPJ válido, não telefone
+    ("amanhã às 10", None),
+])
+def test_parse_br_phone(text, expected):
+    assert core.parse_br_phone(text) == expected
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("fulano@exemplo.com", "fulano@exemplo.com"),
+    ("Meu email é Fulano.Silva@Exemplo.com.br", "fulano.silva@exemplo.com.br"),
+    ("e-mail: x+y@dominio.io.", "x+y@dominio.io"),
+    ("fulano@", None),
+    ("falar com fulano@exemplo.com amanhã", None),
+])
+def test_parse_email(text, expected):
+    assert core.parse_email(text) == expected
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("Sim", "Sim"), ("sim!", "Sim"), ("já sou", "Sim"), ("Ja sou sim.", "Sim"), ("sou sim", "Sim"),
+    ("não", "Não"), ("NAO", "Não"), ("ainda não", "Não"), ("não sou ainda", "Não"),
+    ("talvez", None), ("sim, mas só às vezes", None),
+    # (curtas demais ou ambíguas: ficam com o modelo)
+    ("s", None), ("n", None), ("sou", None), ("isso", None), ("Claro!", None), ("nunca", None),
+    ("sou da diretoria", None), ("não sei", None),
+])
+def test_parse_yes_no(text, expected):
+    assert core.parse_yes_no(text) == expected
+
+
+@pytest.mark.parametrize("value, expected", [
+    ("11.222.333/0001-81", True),
+    ("11222333000181", True),
+    ("11.222.333/0001-82", False),
+    ("00.000.000/0000-00", False),
+    ("11111111111111", False),
+    ("123", False),
+    (None, False),
+])
+def test_is_valid_cnpj(value, expected):
+    assert core.is_valid_cnpj(value) is expected
+
+
+LEAD_UP_TO_CARGO = {"nome": "Ana", "empresa_ramo": "Escola", "cargo": "Diretora"}
+
+
+class TestChatEndpoint:
+    def test_unambiguous_email_skips_the_model(self, client, gemini):
+        response = client.post('/api/chat', json={"message": "ana@escola.com.br", "leadData": LEAD_UP_TO_CARGO})
+        assert response.status_code == 200
+        body = response.get_json()
+        assert body["leadData"]["email"] == "ana@escola.com.br"
+        assert body["botResponse"] == core.FAST_PATH_REPLIES['email']
+        assert gemini.calls == []
+
+    def test_whatsapp_reply_uses_the_name(self, client, gemini):
+        lead = dict(LEAD_UP_TO_CARGO, email="ana@escola.com.br", ja_e_cliente="Sim")
+        response = client.post('/api/chat', json={"message": "11 98765-4321", "leadData": lead})
+        body = response.get_json()
+        assert body["leadData"]["whatsapp"] == "(11) 98765-4321"
+        assert body["botResponse"].startswith("Perfeito, Ana!")
+        assert body["isComplete"] is True
+        assert gemini.calls == []
+
+    @pytest.mark.parametrize("message", ["s", "n", "sou", "isso"])
+    def test_ambiguous_yes_no_goes_to_the_model(self, client, gemini, message):
+        lead = dict(LEAD_UP_TO_CARGO, email="ana@escola.com.br")
+        response = client.post('/api/chat', json={"message": message, "leadData": lead})
+        assert response.status_code == 200
+        assert len(gemini.calls) == 1
+
+    def test_anything_else_goes_to_the_model(self, client, gemini):
+        client.post('/api/chat', json={"message": "pode mandar no ana@escola.com.br amanhã", "leadData": LEAD_UP_TO_CARGO})
+        client.post('/api/chat', json={"message": "11 98765-4321", "leadData": {"nome": "Ana"}})  # (próximo é o ramo)
+        assert len(gemini.calls) == 2
@@ -0,0 +1,132 @@
+import threading
+
+import pytest
+
+import app as core
+from elo import idempotency
+
+CHAT_BODY = {"message": "Oi", "leadData": {}}
+
+
+def post_chat(client, key, body=CHAT_BODY):
+    return client.post('/api/chat', json=body, headers={'Idempotency-Key': key})
+
+
+class TestChatEndpoint:
+    def test_repeated_request_is_replayed(self, client, gemini):
+        first = post_chat(client, 'teste-replay-0001')
+        second = post_chat(client, 'teste-replay-0001')
+        assert first.status_code == second.status_code == 200
+        assert 'Idempotent-Replayed' not in first.headers
+        assert second.headers['Idempotent-Replayed'] == 'true'
+        assert second.get_json() == first.get_json()
+        assert len(gemini.calls) == 1
+
+    def test_same_key_with_another_body_is_422(self, client, gemini):
+        assert post_chat(client, 'teste-mismatch-01').status_code == 200
+        response = post_chat(client, 'teste-mismatch-01', {"message": "Outra coisa", "leadData": {}})
+        assert response.status_code == 422
+
+    def test_keys_are_scoped_by_lead(self, client, gemini):
+        assert post_chat(client, 'teste-escopo-001', dict(CHAT_BODY, leadId=None)).status_code == 200
+        other_lead = post_chat(client, 'teste-escopo-001', dict(CHAT_BODY, leadId=41))
+        assert 'Idempotent-Replayed' not in other_lead.headers
+
+    def test_invalid_key_is_400(self, client, gemini):
+        assert post_chat(client, 'curta').status_code == 400
+
+    def test_without_header_nothing_changes(self, client, gemini):
+        response = client.post('/api/chat', json=CHAT_BODY)
+        assert response.status_code == 200
+        assert 'Idempotent-Replayed' not in response.headers
+
+    def test_server_errors_are_not_stored(self, client, gemini):
+        gemini.reply = object()  # (a resposta da IA não vira JSON: 500)
+        assert post_chat(client, 'teste-erro-0001').status_code == 500
+        gemini.reply = {"botResponse": "Oi!", "extractedData": {}}
+        response = post_chat(client, 'teste-erro-0001')
+        assert response.status_code == 200
+        assert 'Idempotent-Replayed' not in response.headers
+
+
+class TestIdempotencyStore:
+    @pytest.fixture
+    def store(self):
+        return idempotency.IdempotencyStore(60, 100)
+
+    def test_outcomes(self, store):
+        assert store.begin('chat:-:k1', 'fp') == ('run', None)
+        store.complete('chat:-:k1', 'fp', (200, '{"ok": true}', 'application/json'))
+        assert store.begin('chat:-:k1', 'fp') == ('replay', (200, '{"ok": true}', 'application/json'))
+        assert store.begin('chat:-:k1', 'outro') == ('mismatch', None)
+
+    def test_request_in_flight_is_busy(self, store, monkeypatch):
+        monkeypatch.setattr(idempotency, "IDEMPOTENCY_WAIT_TIMEOUT", 0.05)
+        assert store.begin('chat:-:k2', 'fp') == ('run', None)
+        outcome = []
+        waiter = threading.Thread(target=lambda: outcome.append(store.begin('chat:-:k2', 'fp')))
+        waiter.start()
+        waiter.join()
+        assert outcome == [('busy', None)]
+        assert store.stats()["ocupadas"] == 1
+
+    def test_waiter_gets_the_replay_when_the_original_finishes(self, store, monkeypatch):
+        monkeypatch.setattr(idempotency, "IDEMPOTENCY_WAIT_TIMEOUT", 2)
+        assert store.begin('chat:-:k3', 'fp') == ('run', None)
+        outcome = []
+        waiter = threading.Thread(target=lambda: outcome.append(store.begin('chat:-:k3', 'fp')))
+        waiter.start()
+        store.complete('chat:-:k3', 'fp', (201, '{}', 'application/json'))
+        waiter.join()
+        assert outcome == [('replay', (201, '{}', 'application/json'))]
+
+    def test_aborted_key_can_run_again(self, store):
+        assert store.begin('chat:-:k4', 'fp') == ('run', None)
+        store.abort('chat:-:k4')
+        assert store.begin('chat:-:k4', 'fp') == ('run', None)
+
+    def test_busy_response_is_409_with_retry_after(self):
+        with core.app.test_request_context():
+            response = core.idempotency_response('busy', None)
+        assert response.status_code == 409
+        assert response.headers["Retry-After"] == "1"
+
+
+class TestSharedBetweenWorkers:
+    FP = 'f' * 64  # (fingerprint é um sha256 em hex; a coluna é CHAR(64))
+
+    @pytest.fixture
+    def idem_db(self, pg_pool):
+        core.setup_database()
+        return pg_pool
+
+    def test_other_worker_replays_from_postgres(self, idem_db):
+        idempotency.IdempotencyStore(60, 100).begin('chat:-:k5', self.FP)
+        idempotency.IdempotencyStore(60, 100).complete('chat:-:k5', self.FP, (200, '{}', 'application/json'))
+        assert idempotency.IdempotencyStore(60, 100).begin('chat:-:k5', self.FP) == ('replay', (200, '{}', 'application/json'))
+
+    def test_other_worker_waits_for_the_owner(self, idem_db, monkeypatch):
+        monkeypatch.setattr(idempotency, "IDEMPOTENCY_WAIT_TIMEOUT", 0.3)
+        monkeypatch.setattr(idempotency, "IDEMPOTENCY_POLL_INTERVAL", 0.05)
+        assert idempotency.IdempotencyStore(60, 100).begin('chat:-:k6', self.FP) == ('run', None)
+        assert idempotency.IdempotencyStore(60, 100).begin('chat:-:k6', self.FP) == ('busy', None)
+
+    def test_abandoned_claim_can_be_taken_over(self, idem_db):
+        idempotency.IdempotencyStore(60, 100).begin('chat:-:k7', self.FP)
+        with core.db_cursor() as cur:
+            cur.execute("UPDATE elo_idempotency SET travada_ate = NOW() - INTERVAL '1 second'")
+        assert idempotency.IdempotencyStore(60, 100).begin('chat:-:k7', self.FP) == ('run', None)
+
+    def test_save_quote_retry_does_not_insert_twice(self, idem_db, client):
+        with core.db_cursor() as cur:
+            cur.execute("INSERT INTO elo_leads (nome) VALUES ('Ana') RETURNING id")
+            lead_id = cur.fetchone()[0]
+        body = {"lead_id": lead_id, "quote_data": {"produto_desejado": "Caneta", "quantidade_estimada": "500"}}
+        headers = {'Idempotency-Key': 'teste-orcamento-01'}
+        first = client.post('/api/save-quote', json=body, headers=headers)
+        second = client.post('/api/save-quote', json=body, headers=headers)
+        assert first.status_code == second.status_code == 201
+        assert second.get_json() == first.get_json()
+        with core.db_cursor() as cur:
+            cur.execute("SELECT count(*) FROM elo_orçar")
+            assert cur.fetchone()[0] == 1
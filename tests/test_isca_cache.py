@@ -0,0 +1,110 @@
+import threading
+import time
+
+import pytest
+
+import app as core
+
+
+@pytest.mark.parametrize("ramo, expected", [
+    (" Farmácia", "farmacia"),
+    ("FARMÁCIA", "farmacia"),
+    ("Agência de  MKT!", "agencia de mkt"),
+    ("país", "pais"),         # (não vira 'pal')
+    ("Mais Vendas", "mais vendas"),
+    ("Restaurantes", "restaurantes"),
+    (None, ""),
+])
+def test_normalize_ramo(ramo, expected):
+    assert core.normalize_ramo(ramo) == expected
+
+
+def counting_generator(delay=0.0):
+    calls = []
+
+    def generate(ramo):
+        calls.append(ramo)
+        time.sleep(delay)
+        return f"isca de {ramo}"
+
+    generate.calls = calls
+    return generate
+
+
+class TestMemoryLayer:
+    def test_same_key_is_generated_once(self):
+        cache = core.IscaCache(10, 60, 30)
+        generate = counting_generator()
+        assert cache.get_or_generate("Farmácia", generate) == "isca de Farmácia"
+        assert cache.get_or_generate(" FARMACIA ", generate) == "isca de Farmácia"
+        assert generate.calls == ["Farmácia"]
+        stats = cache.stats()
+        assert (stats["memory_hits"], stats["misses"], stats["model_calls"]) == (1, 1, 1)
+
+    def test_concurrent_misses_share_one_call(self):
+        cache = core.IscaCache(10, 60, 30)
+        generate = counting_generator(delay=0.2)
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(cache.get_or_generate("Escola", generate)))
+                   for _ in range(5)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert results == ["isca de Escola"] * 5
+        assert generate.calls == ["Escola"]
+        assert cache.stats()["coalesced"] == 4
+
+    def test_errors_reach_the_waiters_and_are_not_cached(self):
+        cache = core.IscaCache(10, 60, 30)
+
+        def failing(ramo):
+            time.sleep(0.1)
+            raise RuntimeError("modelo fora do ar")
+
+        errors = []
+
+        def ask():
+            try:
+                cache.get_or_generate("Escola", failing)
+            except RuntimeError as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=ask) for _ in range(3)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert len(errors) == 3
+        assert cache.get_or_generate("Escola", counting_generator()) == "isca de Escola"
+
+
+class TestDatabaseLayer:
+    @pytest.fixture
+    def isca_db(self, pg_pool):
+        core.setup_database()
+        return pg_pool
+
+    def test_other_worker_reads_it_from_postgres(self, isca_db):
+        core.IscaCache(10, 60, 30).get_or_generate("Academia", counting_generator())
+        other_worker = core.IscaCache(10, 60, 30)
+        generate = counting_generator()
+        assert other_worker.get_or_generate("academia", generate) == "isca de Academia"
+        assert generate.calls == []
+        assert other_worker.stats()["db_hits"] == 1
+
+    def test_expired_rows_are_regenerated(self, isca_db):
+        core.IscaCache(10, 60, 30).get_or_generate("Academia", counting_generator())
+        with core.db_cursor() as cur:
+            cur.execute("UPDATE elo_isca_cache SET created_at = NOW() - INTERVAL '31 days'")
+        generate = counting_generator()
+        core.IscaCache(10, 60, 30).get_or_generate("Academia", generate)
+        assert generate.calls == ["Academia"]
+
+
+def test_cache_stats_needs_the_ops_key(client, monkeypatch):
+    monkeypatch.setattr(core, "OPS_SECRET_KEY", "segredo-ops")
+    assert client.get('/api/cache-stats').status_code == 401
+    response = client.get('/api/cache-stats', headers={'Authorization': 'Bearer segredo-ops'})
+    assert response.status_code == 200
+    assert "isca" in response.get_json()
@@ -0,0 +1,68 @@
+import pytest
+
+import app as core
+import cli
+
+
+class TestLeadScorer:
+    @pytest.fixture
+    def scorer(self):
+        return core.LeadScorer("marketing,diretor,agência", "nao,não,n")
+
+    @pytest.mark.parametrize("cargo, cnpj, expected", [
+        ("Diretora de Marketing", "11.222.333/0001-81", "Quente"),
+        ("AGENCIA digital", "tenho", "Quente"),
+        ("Analista", "11.222.333/0001-81", "Frio"),
+        ("Diretor", "Não", "Frio"),
+        ("Diretor", " n ", "Frio"),
+        ("Diretor", "", "Frio"),
+        ("Diretor", None, "Frio"),
+        (None, "11.222.333/0001-81", "Frio"),
+    ])
+    def test_score(self, scorer, cargo, cnpj, expected):
+        assert scorer.score(cargo, cnpj) == expected
+
+    def test_no_keywords_is_always_cold(self):
+        assert core.LeadScorer(" , ", "n").score("Diretor", "sim") == "Frio"
+
+
+class TestRescoreLeads:
+    @pytest.fixture
+    def leads(self, pg_pool):
+        core.setup_database()
+        with core.db_cursor() as cur:
+            cur.execute("""
+                INSERT INTO elo_leads (nome, cargo, cnpj_fornecido, status_lead) VALUES
+                    ('Ana', 'Gerente de Compras', '11.222.333/0001-81', 'Frio'),
+                    ('Bruno', 'Analista', '11.222.333/0001-81', 'Frio'),
+                    ('Carla', 'Diretora', 'não', 'Quente'),
+                    ('Davi', 'CEO', '11.222.333/0001-81', 'Quente')
+                RETURNING id
+            """)
+            return sorted(row[0] for row in cur.fetchall())
+
+    def statuses(self):
+        with core.db_cursor() as cur:
+            cur.execute("SELECT status_lead FROM elo_leads ORDER BY id")
+            return [row[0] for row in cur.fetchall()]
+
+    def test_only_changed_leads_are_written(self, leads):
+        report = core.rescore_leads(chunk_size=3)
+        assert (report["lidos"], report["alterados"], report["quentes"], report["lotes"]) == (4, 2, 2, 2)
+        assert self.statuses() == ['Quente', 'Frio', 'Frio', 'Quente']
+        assert core.rescore_leads(chunk_size=3)["alterados"] == 0
+
+    def test_dry_run_only_counts(self, leads):
+        report = core.rescore_leads(dry_run=True)
+        assert (report["alterados"], report["dry_run"]) == (2, True)
+        assert self.statuses() == ['Frio', 'Frio', 'Quente', 'Quente']
+
+    def test_uses_the_given_rules(self, leads):
+        core.rescore_leads(scorer=core.LeadScorer("analista", "não"))
+        assert self.statuses() == ['Frio', 'Quente', 'Frio', 'Frio']
+
+
+def test_cli_needs_a_database(monkeypatch):
+    monkeypatch.setattr(cli, "DATABASE_URL", None)
+    with pytest.raises(SystemExit, match="DATABASE_URL"):
+        cli.require_database()
@@ -0,0 +1,310 @@
+import asyncio
+import threading
+import time
+
+import pytest
+from google.api_core import exceptions as google_exceptions
+
+import app as core
+
+
+def limiter(max_concurrent=1, max_waiting=0, wait_timeout=0.05, rate=0, burst=1, cooldown=30):
+    return core.AdmissionLimiter(max_concurrent, max_waiting, wait_timeout, rate, burst, cooldown)
+
+
+class TestAdmissionLimiter:
+    def test_full_queue_is_503(self):
+        lim = limiter(max_waiting=0)
+        lim.acquire()
+        with pytest.raises(core.LLMOverloadedError) as exc:
+            lim.acquire()
+        assert exc.value.status == 503 and exc.value.retry_after >= 1
+        lim.release()
+        lim.acquire()  # (a vaga voltou)
+
+    def test_waiting_too_long_is_503(self):
+        lim = limiter(max_waiting=1, wait_timeout=0.05)
+        lim.acquire()
+        with pytest.raises(core.LLMOverloadedError) as exc:
+            lim.acquire()
+        assert exc.value.status == 503
+        assert lim.stats()["rejected_timeout"] == 1
+
+    def test_waiter_gets_the_released_slot(self):
+        lim = limiter(max_waiting=1, wait_timeout=2)
+        lim.acquire()
+        threading.Timer(0.05, lim.release).start()
+        lim.acquire()
+        assert lim.stats()["admitted"] == 2
+
+    def test_rate_limit_is_429_with_retry_after(self):
+        lim = limiter(max_concurrent=5, rate=0.1, burst=1)
+        lim.acquire()
+        with pytest.raises(core.LLMOverloadedError) as exc:
+            lim.acquire()
+        assert exc.value.status == 429 and exc.value.retry_after >= 9
+
+    def test_provider_429_opens_cooldown(self):
+        lim = limiter(max_concurrent=5, cooldown=30)
+        overloaded = lim.record_error(google_exceptions.ResourceExhausted("quota"))
+        assert overloaded.status == 429 and overloaded.retry_after == 30
+        assert lim.record_error(ValueError("outro erro")) is None
+        with pytest.raises(core.LLMOverloadedError) as exc:
+            lim.acquire()
+        assert exc.value.status == 429
+        assert not lim.try_acquire()
+
+    def test_try_acquire_never_waits_nor_jumps_the_queue(self):
+        lim = limiter(max_concurrent=2, max_waiting=1, wait_timeout=2)
+        assert lim.try_acquire()
+        assert lim.try_acquire()
+        assert not lim.try_acquire()
+        lim.release()
+        lim._waiting = 1  # (alguém na fila: a vaga é dele)
+        assert not lim.try_acquire()
+
+
+class TestOverloadedResponses:
+    def test_saturated_chat_is_503_with_retry_after(self, client, gemini, monkeypatch):
+        lim = limiter(max_waiting=0, wait_timeout=7)
+        lim.acquire()
+        monkeypatch.setattr(core.llm_tail, "limiter", lim)
+        response = client.post('/api/chat', json={"message": "Oi", "leadData": {}})
+        assert response.status_code == 503
+        assert response.headers["Retry-After"] == "7"
+        assert gemini.calls == []
+
+    def test_provider_cooldown_is_429_with_retry_after(self, client, gemini, monkeypatch):
+        lim = limiter(max_concurrent=5, cooldown=12)
+        lim.record_error(google_exceptions.TooManyRequests("slow down"))
+        monkeypatch.setattr(core.llm_tail, "limiter", lim)
+        response = client.post('/api/chat', json={"message": "Oi", "leadData": {}})
+        assert response.status_code == 429
+        assert response.headers["Retry-After"] == "12"
+
+    def test_saturated_stream_is_refused_before_the_sse_starts(self, client, gemini, monkeypatch):
+        lim = limiter(max_waiting=0, wait_timeout=3)
+        lim.acquire()
+        monkeypatch.setattr(core.llm_tail, "limiter", lim)
+        response = client.post('/api/chat-stream', json={"message": "Oi", "leadData": {}})
+        assert response.status_code == 503
+        assert response.mimetype == 'application/json'
+
+
+def runner(lim=None, hedge_budget=1.0):
+    return core.TailLatencyRunner(lim or limiter(max_concurrent=4), 4, hedge_budget)
+
+
+def sleeper(delays, results=None):
+    """make_call que dorme delays[n] na n-ésima tentativa e devolve (n, variante)."""
+    calls = []
+
+    def make_call(variant, timeout):
+        n = len(calls)
+        calls.append(variant)
+        delay = delays[n]
+        if delay > timeout:
+            time.sleep(timeout)
+            raise TimeoutError("timeout da tentativa")
+        time.sleep(delay)
+        if isinstance(results, dict) and n in results:
+            raise results[n]
+        return n, variant
+
+    make_call.calls = calls
+    return make_call
+
+
+class TestTailLatencyRunner:
+    def test_fast_primary_needs_no_hedge(self):
+        run = runner()
+        call = sleeper([0.0])
+        assert run.call(core.LLMCallPolicy("chat", 1.0, 0.2, None), call) == (0, 'primary')
+        assert call.calls == ['primary']
+
+    def test_hedge_wins_over_a_slow_primary(self):
+        lim = limiter(max_concurrent=4)
+        run = runner(lim)
+        call = sleeper([0.5, 0.0])
+        assert run.call(core.LLMCallPolicy("chat", 2.0, 0.05, None), call) == (1, 'primary')
+        assert run.stats()["chat.hedge.won"] == 1
+        assert run.stats()["chat.primary.lost"] == 1
+        time.sleep(0.6)
+        assert lim.stats()["in_flight"] == 0  # (a perdedora devolveu a vaga ao terminar)
+
+    def test_hedge_is_skipped_when_the_limiter_is_saturated(self):
+        lim = limiter(max_concurrent=1)
+        run = runner(lim)
+        call = sleeper([0.2])
+        assert run.call(core.LLMCallPolicy("chat", 2.0, 0.05, None), call) == (0, 'primary')
+        assert call.calls == ['primary']
+        assert run.stats()["chat.hedge.skipped_saturated"] == 1
+        assert lim.stats()["in_flight"] == 0
+
+    def test_hedge_budget_limits_extra_calls(self):
+        run = runner(hedge_budget=0.0)
+        run._hedge_tokens = 0.0
+        call = sleeper([0.2])
+        run.call(core.LLMCallPolicy("chat", 2.0, 0.05, None), call)
+        assert call.calls == ['primary']
+        assert run.stats()["chat.hedge.skipped_budget"] == 1
+
+    def test_deadline_is_504(self):
+        run = runner()
+        with pytest.raises(core.LLMDeadlineError) as exc:
+            run.call(core.LLMCallPolicy("isca", 0.1, 0, None), sleeper([1.0]))
+        assert exc.value.status == 504
+        assert run.stats()["isca.deadline_exceeded"] == 1
+
+    def test_fallback_after_primary_error(self):
+        run = runner()
+        call = sleeper([0.0, 0.0], results={0: RuntimeError("500 do provedor")})
+        assert run.call(core.LLMCallPolicy("chat", 2.0, 0, 1.0), call) == (1, 'fallback')
+        assert call.calls == ['primary', 'fallback']
+
+    def test_fallback_when_primary_is_slow(self):
+        run = runner()
+        call = sleeper([0.5, 0.0])
+        assert run.call(core.LLMCallPolicy("chat", 2.0, 0, 0.05), call) == (1, 'fallback')
+        assert run.stats()["chat.fallback.won"] == 1
+
+    def test_all_attempts_failing_raises_the_last_error(self):
+        run = runner()
+        call = sleeper([0.0, 0.0], results={0: RuntimeError("a"), 1: RuntimeError("b")})
+        with pytest.raises(RuntimeError, match="b"):
+            run.call(core.LLMCallPolicy("chat", 2.0, 0, 1.0), call)
+
+    def test_provider_rate_limit_is_429(self):
+        lim = limiter(max_concurrent=4, cooldown=15)
+        run = runner(lim)
+        call = sleeper([0.0], results={0: google_exceptions.ResourceExhausted("quota")})
+        with pytest.raises(core.LLMOverloadedError) as exc:
+            run.call(core.LLMCallPolicy("chat", 2.0, 0, None), call)
+        assert exc.value.status == 429 and exc.value.retry_after == 15
+        assert lim.stats()["in_flight"] == 0
+
+
+def streamer(chunks_by_variant, delay=0.0):
+    """make_call de stream: a variante devolve seus pedaços (ou levanta a exceção dada)."""
+    calls = []
+
+    def make_call(variant, timeout):
+        calls.append(variant)
+        outcome = chunks_by_variant[variant]
+        if isinstance(outcome, Exception):
+            raise outcome
+
+        def chunks():
+            for chunk in outcome:
+                time.sleep(delay)
+                if isinstance(chunk, Exception):
+                    raise chunk
+                yield chunk
+        return chunks()
+
+    make_call.calls = calls
+    return make_call
+
+
+class TestLLMStream:
+    def test_stream_holds_one_slot_until_it_ends(self):
+        lim = limiter(max_concurrent=1)
+        run = runner(lim)
+        stream = run.stream(core.LLMCallPolicy("chat", 2.0, 0.05, None), streamer({'primary': ['a', 'b']}))
+        assert lim.stats()["in_flight"] == 1
+        assert list(stream) == ['a', 'b']
+        assert lim.stats()["in_flight"] == 0
+        assert run.stats()["chat.primary.won"] == 1
+        assert "chat.hedge.skipped_saturated" not in run.stats()  # (stream não tem hedge)
+
+    def test_close_before_iterating_frees_the_slot(self):
+        lim = limiter(max_concurrent=1)
+        stream = runner(lim).stream(core.LLMCallPolicy("chat", 2.0, 0, None), streamer({'primary': ['a']}))
+        stream.close()
+        stream.close()
+        assert lim.stats()["in_flight"] == 0
+
+    def test_saturated_limiter_refuses_before_the_stream_opens(self):
+        lim = limiter(max_concurrent=1)
+        lim.acquire()
+        with pytest.raises(core.LLMOverloadedError):
+            runner(lim).stream(core.LLMCallPolicy("chat", 2.0, 0, None), streamer({'primary': ['a']}))
+
+    def test_fallback_takes_over_before_the_first_chunk(self):
+        lim = limiter(max_concurrent=2)
+        run = runner(lim)
+        call = streamer({'primary': RuntimeError("500"), 'fallback': ['x']})
+        assert list(run.stream(core.LLMCallPolicy("chat", 2.0, 0, 0.5), call)) == ['x']
+        assert call.calls == ['primary', 'fallback']
+        assert (run.stats()["chat.primary.error"], run.stats()["chat.fallback.won"]) == (1, 1)
+        assert lim.stats()["in_flight"] == 0
+
+    def test_error_after_the_first_chunk_is_not_retried(self):
+        lim = limiter(max_concurrent=2)
+        call = streamer({'primary': ['a', RuntimeError("caiu")], 'fallback': ['x']})
+        chunks = []
+        with pytest.raises(RuntimeError, match="caiu"):
+            for chunk in runner(lim).stream(core.LLMCallPolicy("chat", 2.0, 0, 0.5), call):
+                chunks.append(chunk)
+        assert chunks == ['a'] and call.calls == ['primary']
+        assert lim.stats()["in_flight"] == 0
+
+    def test_slow_stream_hits_the_deadline(self):
+        run = runner()
+        with pytest.raises(core.LLMDeadlineError):
+            list(run.stream(core.LLMCallPolicy("chat", 0.1, 0, None), streamer({'primary': ['a'] * 5}, delay=0.05)))
+        assert run.stats()["chat.deadline_exceeded"] == 1
+
+    def test_provider_rate_limit_is_429(self):
+        lim = limiter(max_concurrent=2, cooldown=15)
+        call = streamer({'primary': google_exceptions.ResourceExhausted("quota"), 'fallback': ['x']})
+        with pytest.raises(core.LLMOverloadedError) as exc:
+            list(runner(lim).stream(core.LLMCallPolicy("chat", 2.0, 0, 0.5), call))
+        assert exc.value.status == 429 and call.calls == ['primary']
+
+
+def test_async_runner_cancels_losers_and_frees_their_slots():
+    import asgi_app
+
+    async def scenario():
+        lim = asgi_app.AsyncAdmissionLimiter(2, 2, 1, 0, 1, 30)
+        run = asgi_app.AsyncTailLatencyRunner(lim, 1, 1.0)
+        calls = []
+
+        async def make_call(variant, timeout):
+            calls.append(variant)
+            await asyncio.sleep(0.5 if len(calls) == 1 else 0.0)
+            return len(calls)
+
+        result = await run.call_async(core.LLMCallPolicy("chat", 2.0, 0.05, None), make_call)
+        await asyncio.sleep(0.01)
+        return result, lim.stats()["in_flight"], run.stats()
+
+    result, in_flight, stats = asyncio.run(scenario())
+    assert result == 2
+    assert in_flight == 0
+    assert stats["chat.hedge.won"] == 1
+
+
+def test_stub_backend_completes_the_funnel_in_six_turns():
+    stub = core.StubBackend(0)
+    lead_data, history = {}, []
+    answers = ["Ana", "Escola", "Diretora", "ana@escola.com.br", "Sim", "11 98765-4321"]
+    for answer in answers:
+        history.append({'role': 'user', 'text': answer})
+        reply = core.json.loads(stub.generate_chat(core.build_chat_contents(history, lead_data)).text)
+        lead_data.update(reply["extractedData"])
+        history.append({'role': 'bot', 'text': reply["botResponse"]})
+    assert lead_data == dict(zip(core.LEAD_FIELDS, answers))
+    assert reply["botResponse"] == "Perfeito! Já tenho todos os seus dados."
+
+
+def test_llm_stats_needs_the_ops_key(client, monkeypatch):
+    monkeypatch.setattr(core, "OPS_SECRET_KEY", None)
+    assert client.get('/api/llm-stats').status_code == 404
+    monkeypatch.setattr(core, "OPS_SECRET_KEY", "segredo-ops")
+    assert client.get('/api/llm-stats', headers={'Authorization': 'Bearer x'}).status_code == 401
+    response = client.get('/api/llm-stats', headers={'Authorization': 'Bearer segredo-ops'})
+    body = response.get_json()
+    assert body["max_concurrent"] == core.llm_limiter.max_concurrent
+    assert "tentativas" in body
@@ -0,0 +1,77 @@
+import json
+import logging
+import queue
+import sys
+
+import pytest
+
+import app as core
+from elo import observability
+
+
+def make_record(msg, level=logging.INFO, **extra):
+    return logging.getLogger("elo.teste").makeRecord("elo.teste", level, __file__, 1, msg, (), None, extra=extra)
+
+
+class TestJsonFormatter:
+    def test_one_json_object_with_extras_and_request_id(self):
+        record = make_record("Requisição atendida", status=200, ms=12.5)
+        record.request_id = "abc-123"
+        entry = json.loads(observability.JsonFormatter().format(record))
+        assert entry["msg"] == "Requisição atendida"
+        assert entry["level"] == "INFO"
+        assert (entry["request_id"], entry["status"], entry["ms"]) == ("abc-123", 200, 12.5)
+        assert "funcName" not in entry
+
+    def test_traceback_is_formatted_before_queueing(self):
+        handler = observability.NonBlockingQueueHandler(queue.Queue())
+        try:
+            raise ValueError("quebrou")
+        except ValueError:
+            record = logging.getLogger("elo.teste").makeRecord(
+                "elo.teste", logging.ERROR, __file__, 1, "falhou", (), sys.exc_info())
+        prepared = handler.prepare(record)
+        assert prepared.exc_info is None
+        assert "ValueError: quebrou" in json.loads(observability.JsonFormatter().format(prepared))["exc"]
+
+
+def test_full_queue_drops_instead_of_blocking(monkeypatch):
+    monkeypatch.setitem(core.log_stats, "descartados", 0)
+    handler = observability.NonBlockingQueueHandler(queue.Queue(1))
+    handler.handle(make_record("primeiro"))
+    handler.handle(make_record("segundo"))
+    assert handler.queue.qsize() == 1
+    assert core.log_stats["descartados"] == 1
+
+
+class TestLogPayload:
+    def test_sampled_requests_get_a_truncated_payload(self, monkeypatch):
+        monkeypatch.setattr(observability, "LOG_PAYLOAD_MAX_CHARS", 10)
+        observability.log_payloads_var.set(True)
+        assert core.log_payload("x" * 25) == "x" * 10 + "... (+15 chars)"
+        assert core.log_payload({"a": 1}) == '{"a": 1}'
+
+    def test_other_requests_only_log_the_size(self):
+        observability.log_payloads_var.set(False)
+        try:
+            assert core.log_payload("x" * 25) == {"omitido": True, "chars": 25}
+        finally:
+            observability.log_payloads_var.set(True)
+
+
+@pytest.mark.parametrize("header, echoed", [
+    ("pedido-42", True),
+    ("com espaço", False),
+    ("x" * 65, False),
+])
+def test_request_id_is_echoed_only_when_valid(client, header, echoed):
+    response = client.get('/', headers={'X-Request-ID': header})
+    request_id = response.headers['X-Request-ID']
+    assert (request_id == header) is echoed
+    assert observability.REQUEST_ID_RE.match(request_id)
+
+
+def test_request_id_is_generated_when_missing(client):
+    first = client.get('/').headers['X-Request-ID']
+    second = client.get('/').headers['X-Request-ID']
+    assert first != second
@@ -0,0 +1,58 @@
+from prometheus_client import REGISTRY
+
+import app as core
+
+OPS = {'Authorization': 'Bearer segredo-ops'}
+
+
+def sample(name, **labels):
+    return REGISTRY.get_sample_value(name, labels) or 0
+
+
+def test_request_latency_is_recorded_per_route(client):
+    labels = dict(endpoint='/api/chat', method='POST', status='400')
+    before = sample('elo_http_request_duration_seconds_count', **labels)
+    client.post('/api/chat', json={"message": "  ", "leadData": {}})
+    assert sample('elo_http_request_duration_seconds_count', **labels) == before + 1
+
+
+def test_stages_errors_and_tokens():
+    before_stage = sample('elo_stage_duration_seconds_count', stage='webhook')
+    with core.observe_stage("webhook"):
+        pass
+    assert sample('elo_stage_duration_seconds_count', stage='webhook') == before_stage + 1
+
+    before_error = sample('elo_errors_total', where='teste', type='ValueError')
+    core.record_error("teste", ValueError("x"))
+    assert sample('elo_errors_total', where='teste', type='ValueError') == before_error + 1
+
+    class Usage:
+        prompt_token_count = 120
+        candidates_token_count = 30
+
+    class Response:
+        usage_metadata = Usage()
+
+    before_prompt = sample('elo_llm_tokens_total', operation='teste', kind='prompt')
+    core.record_llm_usage("teste", Response())
+    core.record_llm_usage("teste", object())  # (sem usage_metadata: ignorado)
+    assert sample('elo_llm_tokens_total', operation='teste', kind='prompt') == before_prompt + 120
+    assert sample('elo_llm_tokens_total', operation='teste', kind='response') >= 30
+
+
+def test_fast_path_counts_skipped_llm_calls(client, gemini):
+    before = sample('elo_cache_requests_total', cache='chat_fast_path', result='llm_calls_skipped')
+    lead = {"nome": "Ana", "empresa_ramo": "Escola", "cargo": "Diretora"}
+    client.post('/api/chat', json={"message": "ana@escola.com.br", "leadData": lead})
+    assert sample('elo_cache_requests_total', cache='chat_fast_path', result='llm_calls_skipped') == before + 1
+    assert gemini.calls == []
+
+
+def test_metrics_endpoint_needs_the_ops_key(client, monkeypatch):
+    assert client.get('/metrics').status_code == 404
+    monkeypatch.setattr(core, "OPS_SECRET_KEY", "segredo-ops")
+    assert client.get('/metrics').status_code == 401
+    response = client.get('/metrics', headers=OPS)
+    assert response.status_code == 200
+    assert response.mimetype == 'text/plain'
+    assert b'elo_stage_duration_seconds_bucket' in response.data
@@ -0,0 +1,142 @@
+import os
+import runpy
+import subprocess
+import sys
+
+import psycopg2
+import pytest
+
+from elo import db, migrations
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+
+@pytest.fixture
+def conn(pg_pool, pg_dsn):
+    connection = psycopg2.connect(pg_dsn)
+    connection.autocommit = True
+    yield connection
+    connection.close()
+
+
+def latest_version():
+    return migrations.schema_migrations()[-1][0]
+
+
+def recorded_versions(conn):
+    with conn.cursor() as cur:
+        cur.execute("SELECT version FROM schema_version ORDER BY version")
+        return [row[0] for row in cur.fetchall()]
+
+
+class TestRunMigrations:
+    def test_applies_every_migration_once(self, conn):
+        versions = [m[0] for m in migrations.schema_migrations()]
+        assert migrations.run_migrations(conn) == versions
+        assert recorded_versions(conn) == versions
+        assert migrations.run_migrations(conn) == []  # (banco em dia: só o SELECT)
+
+    def test_stops_at_the_requested_version(self, conn):
+        assert migrations.run_migrations(conn, upto=1) == [1]
+        with conn.cursor() as cur:
+            cur.execute("SELECT to_regclass('idx_elo_orcar_lead_id')")
+            assert cur.fetchone()[0] is None
+        assert migrations.run_migrations(conn)[0] == 2
+
+    def test_n8n_queue_index_is_built_concurrently(self, conn):
+        migrations.run_migrations(conn, upto=1)
+        with conn.cursor() as cur:
+            cur.execute("SELECT to_regclass('idx_elo_leads_aguardando_n8n')")
+            assert cur.fetchone()[0] is None  # (a v1, transacional, não trava a elo_leads com o índice)
+        migrations.run_migrations(conn)
+        with conn.cursor() as cur:
+            assert migrations.index_validity(cur, ['idx_elo_leads_aguardando_n8n']) == {'idx_elo_leads_aguardando_n8n': True}
+            cur.execute("SELECT pg_get_indexdef('idx_elo_leads_aguardando_n8n'::regclass)")
+            assert "WHERE ((status)::text = 'Aguardando Envio N8N'::text)" in cur.fetchone()[0]
+
+    def test_invalid_concurrent_index_is_rebuilt(self, conn):
+        migrations.run_migrations(conn)
+        with conn.cursor() as cur:
+            # (como um CREATE INDEX CONCURRENTLY interrompido deixaria o índice)
+            cur.execute("UPDATE pg_index SET indisvalid = false WHERE indexrelid = 'idx_elo_orcar_lead_id'::regclass")
+            cur.execute("DELETE FROM schema_version WHERE version >= 2")
+        assert migrations.run_migrations(conn)[0] == 2
+        with conn.cursor() as cur:
+            assert migrations.index_validity(cur, ['idx_elo_orcar_lead_id']) == {'idx_elo_orcar_lead_id': True}
+
+    def test_missing_index_fails_the_migration(self, conn):
+        migrations.run_migrations(conn, upto=1)
+        with conn.cursor() as cur:
+            with pytest.raises(RuntimeError, match="idx_inexistente"):
+                migrations.check_indexes_valid(cur, ['idx_elo_orcar_lead_id', 'idx_inexistente'])
+
+
+class TestMigrationLock:
+    def test_waiter_returns_once_another_process_migrated(self, conn, pg_dsn):
+        migrations.run_migrations(conn)
+        holder = psycopg2.connect(pg_dsn)
+        try:
+            with holder.cursor() as cur:
+                cur.execute("SELECT pg_advisory_lock(%s)", (db.DB_MIGRATIONS_LOCK_KEY,))
+            with conn.cursor() as cur:
+                assert migrations.wait_migration_lock(cur, latest_version()) is False
+        finally:
+            holder.close()
+
+    def test_waiter_gives_up_after_the_timeout(self, conn, pg_dsn, monkeypatch):
+        monkeypatch.setattr(migrations, "DB_MIGRATIONS_WAIT_TIMEOUT", 0)
+        holder = psycopg2.connect(pg_dsn)
+        try:
+            with holder.cursor() as cur:
+                cur.execute("SELECT pg_advisory_lock(%s)", (db.DB_MIGRATIONS_LOCK_KEY,))
+            with conn.cursor() as cur:
+                with pytest.raises(RuntimeError, match="lock de migração"):
+                    migrations.wait_migration_lock(cur, latest_version())
+        finally:
+            holder.close()
+
+    def test_waiter_takes_the_free_lock(self, conn):
+        with conn.cursor() as cur:
+            assert migrations.wait_migration_lock(cur, latest_version()) is True
+            cur.execute("SELECT pg_advisory_unlock(%s)", (db.DB_MIGRATIONS_LOCK_KEY,))
+
+
+class TestWhereMigrationsRun:
+    def run_python(self, pg_dsn, *args):
+        env = dict(os.environ, DATABASE_URL=pg_dsn, LOG_LEVEL='WARNING')
+        return subprocess.run([sys.executable, *args], cwd=ROOT, env=env, capture_output=True, text=True, timeout=60)
+
+    def test_importing_the_app_does_not_migrate(self, conn, pg_dsn):
+        assert self.run_python(pg_dsn, '-c', 'import app, asgi_app').returncode == 0
+        with conn.cursor() as cur:
+            cur.execute("SELECT to_regclass('schema_version')")
+            assert cur.fetchone()[0] is None
+
+    def test_migrate_script_applies_everything(self, conn, pg_dsn):
+        result = self.run_python(pg_dsn, 'migrate.py')
+        assert result.returncode == 0, result.stderr
+        assert recorded_versions(conn) == [m[0] for m in migrations.schema_migrations()]
+
+
+class TestGunicornOnStarting:
+    @pytest.fixture
+    def hooks(self, tmp_path, monkeypatch):
+        monkeypatch.setenv("PROMETHEUS_MULTIPROC_DIR", str(tmp_path / "prom"))
+        calls = []
+        config = runpy.run_path(os.path.join(ROOT, 'gunicorn.conf.py'))
+        monkeypatch.setattr(subprocess, "run", lambda args, **kwargs: calls.append((args, kwargs)))
+        return config, calls
+
+    def test_master_runs_migrate_once_when_asked(self, hooks, monkeypatch):
+        config, calls = hooks
+        monkeypatch.setenv("DB_MIGRATE_ON_START", "1")
+        config["on_starting"](None)
+        [(args, kwargs)] = calls
+        assert args[0] == sys.executable and os.path.basename(args[1]) == 'migrate.py'
+        assert kwargs["check"] is True  # (migração falhou: o gunicorn não sobe)
+
+    def test_off_by_default(self, hooks, monkeypatch):
+        config, calls = hooks
+        monkeypatch.delenv("DB_MIGRATE_ON_START", raising=False)
+        config["on_starting"](None)
+        assert calls == []
@@ -0,0 +1,102 @@
+import pytest
+
+import app as core
+
+AUTH = {'Authorization': 'Bearer segredo-n8n'}
+
+
+@pytest.fixture
+def n8n_db(pg_pool, monkeypatch):
+    monkeypatch.setattr(core, "N8N_SECRET_KEY", "segredo-n8n")
+    core.setup_database()
+    return pg_pool
+
+
+def new_leads(count, status=core.STATUS_AGUARDANDO_N8N):
+    with core.db_cursor() as cur:
+        cur.execute("INSERT INTO elo_leads (nome, status) SELECT 'Lead ' || n, %s FROM generate_series(1, %s) AS n"
+                    " RETURNING id", (status, count))
+        return sorted(row[0] for row in cur.fetchall())
+
+
+def claim(client, **body):
+    response = client.post('/api/n8n/claim-leads', json=body, headers=AUTH)
+    assert response.status_code == 200
+    return response.get_json()
+
+
+class TestClaimLeads:
+    def test_pages_through_pending_leads(self, n8n_db, client):
+        ids = new_leads(3)
+        new_leads(1, status='Novo')
+        first = claim(client, limit=2)
+        assert [lead['id'] for lead in first['leads']] == ids[:2]
+        assert (first['next_cursor'], first['has_more']) == (ids[1], True)
+
+        second = claim(client, limit=2, after_id=first['next_cursor'])
+        assert [lead['id'] for lead in second['leads']] == ids[2:]
+        assert second['has_more'] is False
+
+    def test_claimed_leads_are_not_handed_out_twice(self, n8n_db, client):
+        ids = new_leads(2)
+        assert [lead['id'] for lead in claim(client)['leads']] == ids
+        assert claim(client)['leads'] == []
+
+    def test_expired_claims_return_to_the_queue(self, n8n_db, client, monkeypatch):
+        ids = new_leads(1)
+        claim(client)
+        with core.db_cursor() as cur:
+            cur.execute("UPDATE elo_leads SET n8n_claimed_at = NOW() - INTERVAL '1 hour'")
+        monkeypatch.setattr(core, "N8N_CLAIM_LEASE", 60)
+        assert [lead['id'] for lead in claim(client)['leads']] == ids
+
+    def test_needs_the_n8n_key(self, n8n_db, client):
+        assert client.post('/api/n8n/claim-leads', json={}).status_code == 401
+        response = client.post('/api/n8n/claim-leads', json={}, headers={'Authorization': 'Bearer outra'})
+        assert response.status_code == 401
+
+    @pytest.mark.parametrize("body", [{"limit": 0}, {"limit": "muitos"}, {"after_id": "x"}])
+    def test_rejects_bad_paging(self, n8n_db, client, body):
+        assert client.post('/api/n8n/claim-leads', json=body, headers=AUTH).status_code == 400
+
+
+class TestBatchStatusUpdate:
+    def test_updates_the_batch_in_one_statement(self, n8n_db, client):
+        ids = new_leads(2)
+        claim(client)
+        response = client.post('/api/update-status-n8n', headers=AUTH, json={"updates": [
+            {"lead_id": ids[0], "new_status": "Isca Enviada"},
+            {"lead_id": ids[1], "new_status": "Isca Enviada"},
+            {"lead_id": 999999, "new_status": "Isca Enviada"},
+        ]})
+        assert response.status_code == 200
+        assert response.get_json() == {"success": True, "updated": 2, "not_found": [999999]}
+        with core.db_cursor() as cur:
+            cur.execute("SELECT status, email_enviado, n8n_claimed_at FROM elo_leads ORDER BY id")
+            assert cur.fetchall() == [("Isca Enviada", True, None)] * 2
+
+    def test_single_lead_update_still_works(self, n8n_db, client):
+        [lead_id] = new_leads(1)
+        response = client.post('/api/update-status-n8n', headers=AUTH,
+                               json={"lead_id": lead_id, "new_status": "Isca Enviada"})
+        assert response.status_code == 200
+        with core.db_cursor() as cur:
+            cur.execute("SELECT status FROM elo_leads WHERE id = %s", (lead_id,))
+            assert cur.fetchone()[0] == "Isca Enviada"
+
+    @pytest.mark.parametrize("updates", [
+        [],
+        "nada",
+        [{"lead_id": 1}],
+        [{"lead_id": "um", "new_status": "Isca Enviada"}],
+    ])
+    def test_rejects_bad_batches(self, client, monkeypatch, updates):
+        monkeypatch.setattr(core, "N8N_SECRET_KEY", "segredo-n8n")
+        response = client.post('/api/update-status-n8n', headers=AUTH, json={"updates": updates})
+        assert response.status_code == 400
+
+    def test_rejects_oversized_batches(self, client, monkeypatch):
+        monkeypatch.setattr(core, "N8N_SECRET_KEY", "segredo-n8n")
+        monkeypatch.setattr(core, "N8N_BATCH_MAX", 2)
+        updates = [{"lead_id": n, "new_status": "Isca Enviada"} for n in range(1, 4)]
+        assert client.post('/api/update-status-n8n', headers=AUTH, json={"updates": updates}).status_code == 400
@@ -0,0 +1,125 @@
+import pytest
+import requests
+
+import app as core
+from elo import outbox
+
+
+class FakeSession:
+    """Faz o papel do requests.Session do dispatcher; `on_post` roda durante cada POST."""
+
+    def __init__(self, status=200, on_post=None):
+        self.status = status
+        self.on_post = on_post
+        self.sent = []
+
+    def post(self, url, json=None, timeout=None):
+        self.sent.append(json)
+        if self.on_post:
+            self.on_post()
+        response = requests.Response()
+        response.status_code = self.status
+        response.url = url
+        return response
+
+
+def dispatcher(session, max_attempts=3, lease_seconds=60):
+    d = outbox.OutboxDispatcher('http://n8n.local/webhook', 10, 1, max_attempts, 10, 3600, 5, lease_seconds)
+    d._session = session
+    return d
+
+
+@pytest.fixture
+def outbox_db(pg_pool):
+    core.setup_database()
+    return pg_pool
+
+
+def enqueue(*payloads):
+    with core.db_cursor() as cur:
+        return [core.enqueue_webhook(cur, payload) for payload in payloads]
+
+
+def outbox_rows():
+    with core.db_cursor() as cur:
+        cur.execute("SELECT id, status, tentativas, locked_until IS NOT NULL, ultimo_erro IS NOT NULL,"
+                    " proxima_tentativa > NOW() FROM elo_webhook_outbox ORDER BY id")
+        return cur.fetchall()
+
+
+class TestDispatch:
+    def test_delivered_events_are_marked_and_released(self, outbox_db):
+        ids = enqueue({"n": 1}, {"n": 2})
+        session = FakeSession()
+        assert dispatcher(session).dispatch_batch() == 2
+        assert session.sent == [{"n": 1}, {"n": 2}]
+        assert outbox_rows() == [(ids[0], 'entregue', 1, False, False, False),
+                                 (ids[1], 'entregue', 1, False, False, False)]
+
+    def test_failures_back_off_and_end_in_dead_letter(self, outbox_db):
+        [event_id] = enqueue({"n": 1})
+        d = dispatcher(FakeSession(status=500), max_attempts=2)
+        assert d.dispatch_batch() == 1
+        assert outbox_rows() == [(event_id, 'pendente', 1, False, True, True)]
+        assert d.dispatch_batch() == 0  # (ainda no backoff)
+
+        with core.db_cursor() as cur:
+            cur.execute("UPDATE elo_webhook_outbox SET proxima_tentativa = NOW()")
+        assert d.dispatch_batch() == 1
+        assert outbox_rows()[0][1:3] == ('dead', 2)
+
+    def test_batch_is_leased_and_posted_without_holding_a_connection(self, outbox_db):
+        enqueue({"n": 1})
+        other = dispatcher(FakeSession())
+        seen = {}
+
+        def during_post():
+            seen["in_use"] = outbox_db.stats()["in_use"]
+            seen["other_claimed"] = other.dispatch_batch()
+
+        assert dispatcher(FakeSession(on_post=during_post)).dispatch_batch() == 1
+        assert seen == {"in_use": 0, "other_claimed": 0}
+        assert outbox_rows()[0][1] == 'entregue'
+
+    def test_expired_lease_is_claimed_again(self, outbox_db):
+        enqueue({"n": 1})
+        with core.db_cursor() as cur:
+            cur.execute(outbox.OUTBOX_CLAIM_SQL, (10, 60))  # (um dispatcher que morreu no meio do lote)
+        assert dispatcher(FakeSession()).dispatch_batch() == 0
+
+        with core.db_cursor() as cur:
+            cur.execute("UPDATE elo_webhook_outbox SET locked_until = NOW() - INTERVAL '1 second'")
+        assert dispatcher(FakeSession()).dispatch_batch() == 1
+
+
+def test_save_quote_enqueues_in_the_same_transaction(outbox_db, client, monkeypatch):
+    woken = []
+    monkeypatch.setattr(core, "SALES_WEBHOOK_URL", 'http://n8n.local/webhook')
+    monkeypatch.setattr(core.outbox_dispatcher, "wake", lambda: woken.append(True))
+    with core.db_cursor() as cur:
+        cur.execute("INSERT INTO elo_leads (nome, email) VALUES ('Ana', 'ana@exemplo.com') RETURNING id")
+        lead_id = cur.fetchone()[0]
+
+    response = client.post('/api/save-quote', json={
+        "lead_id": lead_id, "quote_data": {"produto_desejado": "Caneta", "quantidade_estimada": "500"}})
+    assert response.status_code == 201
+    assert response.get_json()["webhook_status"] == 'enfileirado'
+    assert woken == [True]
+    with core.db_cursor() as cur:
+        cur.execute("SELECT payload FROM elo_webhook_outbox")
+        payload = cur.fetchone()[0]
+    assert payload["orcamento_id"] == response.get_json()["orcamento_id"]
+    assert payload["email"] == 'ana@exemplo.com'
+
+
+def test_start_only_runs_in_thread_mode(monkeypatch):
+    d = dispatcher(FakeSession())
+    monkeypatch.setattr(outbox, "OUTBOX_DISPATCHER_MODE", "worker")
+    d.start()
+    assert d._thread is None
+
+    monkeypatch.setattr(outbox, "OUTBOX_DISPATCHER_MODE", "thread")
+    monkeypatch.setattr(d, "run_forever", lambda: None)
+    d.start()
+    assert d._thread is not None
+    d._thread.join()
@@ -0,0 +1,88 @@
+import gzip
+import json
+import os
+
+import brotli
+import pytest
+
+from elo import widget
+
+
+@pytest.fixture
+def dist(tmp_path, monkeypatch):
+    """Build do widget num diretório temporário, servido pelo app."""
+    manifest = widget.build_widget(dist_dir=str(tmp_path))
+    monkeypatch.setattr(widget, "widget_files", widget.WidgetFiles(str(tmp_path)))
+    return tmp_path, manifest
+
+
+def source(name):
+    with open(os.path.join(widget.WIDGET_SRC_DIR, name), 'rb') as f:
+        return f.read()
+
+
+class TestBuild:
+    def test_assets_are_named_by_content_hash(self, dist):
+        _, manifest = dist
+        js = manifest["assets"]["widget.js"]
+        assert js == f"widget.{widget._content_hash(source('widget.js'))}.js"
+        assert set(manifest["assets"]) == set(widget.WIDGET_ASSETS)
+
+    def test_pages_point_at_the_hashed_assets(self, dist):
+        path, manifest = dist
+        html = (path / 'index2.html').read_text(encoding='utf-8')
+        for asset in ('widget.css', 'widget.js'):
+            assert f'"{widget.WIDGET_ASSET_URL}{manifest["assets"][asset]}"' in html
+        assert 'src="widget.js"' not in html
+
+    def test_text_files_get_br_and_gz_but_images_do_not(self, dist):
+        path, manifest = dist
+        js = manifest["assets"]["widget.js"]
+        assert manifest["files"][js]["encodings"] == ['br', 'gzip']
+        assert brotli.decompress((path / f'{js}.br').read_bytes()) == source('widget.js')
+        assert gzip.decompress((path / f'{js}.gz').read_bytes()) == source('widget.js')
+        assert manifest["files"][manifest["assets"]["fundo.png"]]["encodings"] == []
+
+    def test_same_source_gives_the_same_build(self, dist, tmp_path_factory):
+        _, manifest = dist
+        assert widget.build_widget(dist_dir=str(tmp_path_factory.mktemp("dist2"))) == manifest
+
+    def test_missing_dist_is_built_on_first_use(self, tmp_path):
+        files = widget.WidgetFiles(str(tmp_path / 'dist'))
+        assert files.get('index.html')[0] == 'text/html; charset=utf-8'
+        assert json.loads((tmp_path / 'dist' / 'manifest.json').read_text())["files"]
+
+
+class TestServing:
+    def test_brotli_is_preferred_when_accepted(self, client, dist):
+        response = client.get('/widget/', headers={'Accept-Encoding': 'gzip, deflate, br'})
+        assert response.status_code == 200
+        assert response.headers['Content-Encoding'] == 'br'
+        assert response.headers['Vary'] == 'Accept-Encoding'
+        assert brotli.decompress(response.get_data()).startswith(b'<!DOCTYPE html>')
+
+    def test_gzip_and_identity_fallbacks(self, client, dist):
+        gz = client.get('/widget/index4.html', headers={'Accept-Encoding': 'gzip'})
+        assert gz.headers['Content-Encoding'] == 'gzip'
+        plain = client.get('/widget/index4.html', headers={'Accept-Encoding': 'identity'})
+        assert 'Content-Encoding' not in plain.headers
+        assert gzip.decompress(gz.get_data()) == plain.get_data()
+        assert gz.headers['ETag'] != plain.headers['ETag']  # (ETag por codificação)
+
+    def test_pages_revalidate_and_get_304(self, client, dist):
+        first = client.get('/widget/index.html', headers={'Accept-Encoding': 'br'})
+        assert first.headers['Cache-Control'] == 'no-cache'
+        again = client.get('/widget/index.html', headers={'Accept-Encoding': 'br', 'If-None-Match': first.headers['ETag']})
+        assert again.status_code == 304
+        assert again.get_data() == b''
+
+    def test_hashed_assets_are_immutable(self, client, dist):
+        _, manifest = dist
+        response = client.get(f'/widget/assets/{manifest["assets"]["widget.css"]}')
+        assert response.status_code == 200
+        assert response.headers['Cache-Control'] == widget.WIDGET_IMMUTABLE_CACHE
+        assert response.mimetype == 'text/css'
+
+    @pytest.mark.parametrize("url", ['/widget/assets/widget.js', '/widget/assets/index.html', '/widget/manifest.json'])
+    def test_unhashed_or_misplaced_names_are_404(self, client, dist, url):
+        assert client.get(url).status_code == 404
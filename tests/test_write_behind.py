@@ -0,0 +1,106 @@
+import datetime
+
+import pytest
+
+import app as core
+from elo import write_behind
+
+
+def chat_turn(lead_id, nome, historico='[]'):
+    lead_data = {'nome': nome, 'email': 'a@b.com'}
+    return ({'lead_id': lead_id, 'lead_data': dict(lead_data)},
+            {'new_lead_data': dict(lead_data), 'history_json': historico})
+
+
+@pytest.fixture
+def queue(monkeypatch):
+    queue = write_behind.LeadWriteBehind(True, 3600, 2, 3)
+    monkeypatch.setattr(queue, "_ensure_thread", lambda: None)  # (o teste chama flush() na mão)
+    return queue
+
+
+@pytest.fixture
+def leads(pg_pool):
+    core.setup_database()
+    with core.db_cursor() as cur:
+        cur.execute("INSERT INTO elo_leads (nome, email) VALUES ('A', 'a@b.com'), ('B', 'a@b.com'), ('C', 'a@b.com') "
+                    "RETURNING id")
+        return sorted(row[0] for row in cur.fetchall())
+
+
+def names():
+    with core.db_cursor() as cur:
+        cur.execute("SELECT nome FROM elo_leads ORDER BY id")
+        return [row[0] for row in cur.fetchall()]
+
+
+class TestQueue:
+    def test_synchronous_cases_are_not_queued(self, queue):
+        assert not write_behind.LeadWriteBehind(False, 1, 2, 3).enqueue(*chat_turn(7, 'Ana'))  # (desligado)
+        assert not queue.enqueue(*chat_turn(None, 'Novo'))  # (1ª rodada: INSERT síncrono)
+        turn, merged = chat_turn(9, 'Ana')
+        merged['new_lead_data']['whatsapp'] = '11 98765-4321'  # (contato novo: checa duplicado)
+        assert not queue.enqueue(turn, merged)
+        for lead_id in (1, 2, 3):
+            queue.enqueue(*chat_turn(lead_id, 'X'))
+        assert not queue.enqueue(*chat_turn(4, 'X'))  # (fila cheia)
+        assert queue.enqueue(*chat_turn(3, 'Y'))      # (mas coalescer ainda pode)
+        assert queue.stats()["fila_cheia"] == 1
+
+    def test_discard_drops_the_pending_update(self, queue):
+        queue.enqueue(*chat_turn(7, 'Ana'))
+        queue.discard(7)
+        assert queue.pending() == 0
+
+    def test_failed_batch_is_requeued_without_overwriting_newer_state(self, queue):
+        queue.enqueue(*chat_turn(7, 'Ana'))
+        assert queue.flush() == 0  # (sem banco)
+        assert queue.pending() == 1 and queue.stats()["falhas"] == 1
+
+        queue.enqueue(*chat_turn(7, 'Ana Maria'))
+        queue._requeue([(7, 'Ana') + (None,) * 7])
+        assert queue._pending[7][1] == 'Ana Maria'
+
+
+class TestFlush:
+    def test_updates_of_the_same_lead_are_coalesced_in_batches(self, queue, leads):
+        assert queue.enqueue(*chat_turn(leads[0], 'Ana'))
+        assert queue.enqueue(*chat_turn(leads[0], 'Ana Maria', '[{"role": "user", "text": "oi"}]'))
+        assert queue.enqueue(*chat_turn(leads[1], 'Bia'))
+        assert queue.enqueue(*chat_turn(leads[2], 'Caio'))
+        assert queue.pending() == 3
+
+        assert queue.flush() == 3
+        assert names() == ['Ana Maria', 'Bia', 'Caio']
+        with core.db_cursor() as cur:
+            cur.execute("SELECT historico_chat, chat_atualizado_em IS NOT NULL FROM elo_leads WHERE id = %s", (leads[0],))
+            assert cur.fetchone() == ([{"role": "user", "text": "oi"}], True)
+        stats = queue.stats()
+        assert (stats["enfileiradas"], stats["coalescidas"], stats["gravadas"], stats["pendentes"]) == (3, 1, 3, 0)
+
+    def test_older_state_does_not_overwrite_a_newer_write(self, queue, leads):
+        queue.enqueue(*chat_turn(leads[0], 'Antigo'))
+        with core.db_cursor() as cur:  # (outro worker gravou depois de enfileirarmos)
+            cur.execute("UPDATE elo_leads SET nome = 'Novo', chat_atualizado_em = %s WHERE id = %s",
+                        (datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=5), leads[0]))
+        assert queue.flush() == 0
+        assert names()[0] == 'Novo'
+        assert queue.stats()["ignoradas_antigas"] == 1
+
+
+def test_chat_turn_is_deferred_and_flushed(pg_pool, client, gemini, monkeypatch, queue):
+    core.setup_database()
+    monkeypatch.setattr(core, "lead_write_behind", queue)
+    with core.db_cursor() as cur:
+        cur.execute("INSERT INTO elo_leads (nome, email) VALUES ('Ana', 'a@b.com') RETURNING id")
+        lead_id = cur.fetchone()[0]
+    gemini.reply = {"botResponse": "Qual o ramo?", "extractedData": {"nome": "Ana Maria"}}
+
+    response = client.post('/api/chat', json={"message": "Ana Maria", "leadData": {"nome": "Ana", "email": "a@b.com"},
+                                              "leadId": lead_id})
+    assert response.status_code == 200
+    assert response.get_json()["leadId"] == lead_id
+    assert names() == ['Ana'] and queue.pending() == 1
+
+    queue.flush()
+    assert names() == ['Ana Maria']
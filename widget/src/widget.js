@@ -0,0 +1,569 @@
+document.addEventListener('DOMContentLoaded', function() {
+    // LÓGICA PRÉ-EXISTENTE DO SITE
+    // (Omitida para breveidade - Copie a lógica do Carrossel, Accordion, etc. do seu arquivo original)
+
+    (function setupSiteLogic() {
+        const slides = document.querySelectorAll('#hero-carousel .carousel-slide');
+        const prevButton = document.getElementById('prev-slide');
+        const nextButton = document.getElementById('next-slide');
+        const prevButtonMobile = document.getElementById('prev-slide-mobile');
+        const nextButtonMobile = document.getElementById('next-slide-mobile');
+        const logoHome = document.getElementById('logo-home');
+        let currentSlide = 0;
+        let slideInterval;
+        const intervalTime = 8000;
+        function changeSlide(index, resetInterval = true) {
+            if (resetInterval) clearInterval(slideInterval);
+            if (index >= slides.length) currentSlide = 0;
+            else if (index < 0) currentSlide = slides.length - 1;
+            else currentSlide = index;
+            slides.forEach((slide, i) => {
+                slide.style.opacity = (i === currentSlide) ? '1' : '0';
+                if (i === currentSlide) slide.classList.add('active');
+                else slide.classList.remove('active');
+            });
+            if (resetInterval) startSlideShow();
+        }
+        function nextSlide() { changeSlide(currentSlide + 1, true); }
+        function prevSlide() { changeSlide(currentSlide - 1, true); }
+        function startSlideShow() {
+            clearInterval(slideInterval);
+            slideInterval = setInterval(() => { changeSlide(currentSlide + 1, false); }, intervalTime);
+        }
+        if (prevButton && nextButton) {
+            prevButton.addEventListener('click', prevSlide);
+            nextButton.addEventListener('click', nextSlide);
+        }
+        if (prevButtonMobile && nextButtonMobile) {
+            prevButtonMobile.addEventListener('click', prevSlide);
+            nextButtonMobile.addEventListener('click', nextSlide);
+        }
+        if (logoHome) {
+            logoHome.addEventListener('click', function(e) {
+                e.preventDefault();
+                window.scrollTo({ top: 0, behavior: 'smooth' });
+            });
+        }
+        if (slides.length > 1) startSlideShow();
+        const menuContainer = document.getElementById('icon-menu-container');
+        const scrollLeftBtn = document.getElementById('scroll-menu-left');
+        const scrollRightBtn = document.getElementById('scroll-menu-right');
+        if (menuContainer && scrollLeftBtn && scrollRightBtn) {
+            const scrollAmount = 150;
+            scrollLeftBtn.addEventListener('click', function() { menuContainer.scrollBy({ left: -scrollAmount, behavior: 'smooth' }); });
+            scrollRightBtn.addEventListener('click', function() { menuContainer.scrollBy({ left: scrollAmount, behavior: 'smooth' }); });
+        }
+        const logoContainer = document.getElementById('logo-carousel-container');
+        const logoLeftBtn = document.getElementById('scroll-logo-left');
+        const logoRightBtn = document.getElementById('scroll-logo-right');
+        if (logoContainer && logoLeftBtn && logoRightBtn) {
+            const logoScrollAmount = 200;
+            logoLeftBtn.addEventListener('click', function() { logoContainer.scrollBy({ left: -logoScrollAmount, behavior: 'smooth' }); });
+            logoRightBtn.addEventListener('click', function() { logoContainer.scrollBy({ left: logoScrollAmount, behavior: 'smooth' }); });
+        }
+        const accordionContainer = document.getElementById('accordion-container');
+        if (accordionContainer) {
+            const buttons = accordionContainer.querySelectorAll('.accordion-button');
+            function toggleAccordion(button) {
+                const content = button.nextElementSibling;
+                const icon = button.querySelector('i');
+                buttons.forEach(otherButton => {
+                    if (otherButton !== button) {
+                        const otherContent = otherButton.nextElementSibling;
+                        const otherIcon = otherButton.querySelector('i');
+                        otherContent.classList.remove('open');
+                        otherContent.style.maxHeight = null;
+                        otherIcon.classList.remove('rotate-180');
+                    }
+                });
+                if (content.classList.contains('open')) {
+                    content.classList.remove('open');
+                    content.style.maxHeight = null;
+                    icon.classList.remove('rotate-180');
+                } else {
+                    content.classList.add('open');
+                    content.style.maxHeight = content.scrollHeight + "px";
+                    icon.classList.add('rotate-180');
+                }
+            }
+            buttons.forEach(button => { button.addEventListener('click', () => toggleAccordion(button)); });
+        }
+    })();
+
+    // -----------------------------------------------------------
+    // --- INÍCIO: LÓGICA DO CHATBOT ELOBOT (V3 - FUNIL N8N) ---
+    // -----------------------------------------------------------
+
+    const chatbotButton = document.getElementById('chatbotButton');
+    const chatbotWindow = document.getElementById('chatbotWindow');
+    const chatbotClose = document.getElementById('chatbotClose');
+    const chatbotInput = document.getElementById('chatbotInput');
+    const chatbotSend = document.getElementById('chatbotSend');
+    const chatbotMessages = document.getElementById('chatbotMessages');
+    const previewClose = document.getElementById('previewClose');
+    const minimizedIcon = document.getElementById('minimizedIcon');
+    const heroCtaButton = document.getElementById('cta-black-friday'); 
+    const previewMessageEl = document.getElementById('preview-message-text');
+
+    const RENDER_BACKEND_URL = "https://grafica-chatbot.onrender.com/"; 
+
+    // --- Variáveis de ESTADO PRINCIPAL ---
+    let leadData = {};
+    let currentLeadId = null; 
+    let conversationHistory = []; // (só para o /api/save-lead; o /api/chat usa o histórico do servidor)
+
+    // --- Variáveis de ESTADO DO FLUXO (ATUALIZADAS) ---
+    let quoteData = {}; // Armazena os dados do orçamento
+    let quoteStep = 0;  // Controla a etapa da coleta do orçamento
+
+    // (ATUALIZADO) Perguntas do fluxo de orçamento
+    const quoteQuestions = [
+        "Ótimo! Para começar, qual o **produto** que você tem em mente?",
+        "Entendido. E qual a **quantidade** aproximada?",
+        "Perfeito. E para quando você precisa? (Qual o **prazo de entrega**?)",
+        "Certo. Qual o **tipo de gravação** você prefere (Laser, Silk, Bordado, etc)? (Se não souber, digite 'Sugestão')",
+        "Para calcular o frete, qual a **cidade e estado** de entrega? (ex: São Paulo, SP)"
+    ];
+
+    // Flags de controle de fluxo
+    let isWaitingForQuoteDecision = false; // Esperando "Sim/Não" para orçar
+    let isWaitingForQuoteDetails = false;  // No meio da coleta do orçamento
+    let isWaitingForCnpj = false;           // Na etapa final (CNPJ)
+
+    const previewMessages = [
+        "Olá! 🔥 Posso te ajudar a encontrar o brinde perfeito?",
+        "Clique aqui para um orçamento rápido!",
+        "Temos ofertas de Black Friday!",
+        "Qual o brinde ideal para sua empresa?"
+    ];
+    let messageIndex = 0;
+    let previewInterval;
+
+    // --- Lógica Preview/Minimize (sem mudanças) ---
+    function minimizePreview() {
+        chatbotButton.classList.add('minimized');
+        minimizedIcon.classList.add('minimized');
+        clearInterval(previewInterval);
+    }
+    function maximizePreview() {
+        chatbotButton.classList.remove('minimized');
+        minimizedIcon.classList.remove('minimized');
+        startPreviewAnimation();
+    }
+    function startPreviewAnimation() {
+         if (previewInterval) clearInterval(previewInterval);
+         previewInterval = setInterval(() => {
+            messageIndex = (messageIndex + 1) % previewMessages.length;
+            previewMessageEl.style.opacity = 0;
+            setTimeout(() => {
+                previewMessageEl.textContent = previewMessages[messageIndex];
+                previewMessageEl.style.opacity = 1;
+            }, 300);
+        }, 4000);
+    }
+    if (previewClose) previewClose.addEventListener('click', function(e) { e.stopPropagation(); minimizePreview(); });
+    if (minimizedIcon) minimizedIcon.addEventListener('click', maximizePreview);
+    if (previewMessageEl) startPreviewAnimation();
+
+    // --- Abrir/Fechar chatbot (MODIFICADO COM NOVA CORREÇÃO) ---
+    function toggleChat(e) {
+        if (e) e.preventDefault();
+        const isActive = chatbotWindow.classList.contains('active');
+        if (isActive) {
+            chatbotWindow.classList.remove('active');
+            chatbotButton.classList.remove('active');
+            minimizedIcon.classList.remove('active');
+            maximizePreview();
+
+            // --- INÍCIO DA CORREÇÃO DE ZOOM V2 ---
+            // Força o "desfoque" (blur) do campo de input.
+            // Isso faz o teclado virtual recolher e 
+            // sinaliza ao iOS para resetar o zoom.
+            if (chatbotInput) {
+                chatbotInput.blur();
+            }
+            // --- FIM DA CORREÇÃO ---
+
+        } else {
+            chatbotWindow.classList.add('active');
+            chatbotButton.classList.add('active');
+            minimizedIcon.classList.add('active');
+            setTimeout(() => {
+                if (chatbotMessages.children.length === 0) startChat();
+                chatbotInput.focus();
+            }, 300);
+        }
+    }
+    if (chatbotButton) chatbotButton.addEventListener('click', toggleChat);
+    if (chatbotClose) chatbotClose.addEventListener('click', toggleChat);
+    if (heroCtaButton) heroCtaButton.addEventListener('click', toggleChat);
+
+    // --- Envio com Idempotency-Key ---
+    // Cada envio ganha uma chave; se a rede cair (ou o servidor pedir para
+    // esperar com 409/503), reenviamos UMA vez com a MESMA chave, então o
+    // servidor devolve a resposta já gerada em vez de processar a mensagem de novo.
+    function newIdempotencyKey() {
+        if (window.crypto && typeof window.crypto.randomUUID === 'function') {
+            return window.crypto.randomUUID();
+        }
+        return `${Date.now().toString(36)}-${Math.random().toString(36).slice(2, 12)}`;
+    }
+    async function postIdempotent(path, body) {
+        const options = {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json', 'Idempotency-Key': newIdempotencyKey() },
+            body: JSON.stringify(body)
+        };
+        let response;
+        try {
+            response = await fetch(`${RENDER_BACKEND_URL}${path}`, options);
+            if (response.status !== 409 && response.status !== 503) return response;
+        } catch (err) {
+            console.warn(`Falha de rede em ${path}, tentando de novo:`, err);
+        }
+        const retryAfter = response ? parseInt(response.headers.get('Retry-After'), 10) : NaN;
+        await new Promise(resolve => setTimeout(resolve, (retryAfter > 0 ? Math.min(retryAfter, 5) : 1) * 1000));
+        return fetch(`${RENDER_BACKEND_URL}${path}`, options);
+    }
+
+    // --- Funções de Suporte ao Chat (ATUALIZADAS) ---
+    function getCurrentTime() {
+        const now = new Date();
+        return now.toLocaleTimeString('pt-BR', { hour: '2-digit', minute: '2-digit' });
+    }
+    function addMessage(text, isUser = false) {
+        const messageDiv = document.createElement('div');
+        messageDiv.className = `message ${isUser ? 'user' : 'bot'}`;
+        let formattedText = text.replace(/\n/g, '<br>');
+        formattedText = formattedText.replace(/\*\*(.*?)\*\*/g, '<strong>$1</strong>');
+
+        // ATUALIZADO: Só salva no histórico de IA se for o chat de coleta
+        // Não salva as perguntas/respostas do fluxo de orçamento ou cnpj
+        if (isUser || (!isWaitingForQuoteDecision && !isWaitingForQuoteDetails && !isWaitingForCnpj)) {
+            conversationHistory.push({ 
+                role: isUser ? 'user' : 'bot', 
+                text: text, // Salva o texto original
+                time: getCurrentTime()
+            });
+        }
+
+        messageDiv.innerHTML = `
+            <div class="message-avatar">
+                <i class="fas fa-${isUser ? 'user' : 'robot'}"></i>
+            </div>
+            <div class="message-content">
+                <div class="message-bubble">${formattedText}</div>
+                <div class="message-time">${getCurrentTime()}</div>
+            </div>
+        `;
+        if (chatbotMessages) {
+            chatbotMessages.appendChild(messageDiv);
+            chatbotMessages.scrollTop = chatbotMessages.scrollHeight;
+        }
+    }
+    function showTypingIndicator() {
+        const typingDiv = document.createElement('div');
+        typingDiv.className = 'message bot typing-message';
+        typingDiv.id = 'typing-indicator';
+        typingDiv.innerHTML = `
+            <div class="message-avatar"><i class="fas fa-robot"></i></div>
+            <div class="message-content">
+                <div class="message-bubble">
+                    <div class="typing-indicator"><span></span><span></span><span></span></div>
+                </div>
+            </div>
+        `;
+        if (chatbotMessages) {
+            chatbotMessages.appendChild(typingDiv);
+            chatbotMessages.scrollTop = chatbotMessages.scrollHeight;
+        }
+    }
+    function removeTypingIndicator() {
+        const typingDiv = document.getElementById('typing-indicator');
+        if (typingDiv && typingDiv.parentNode) {
+            typingDiv.parentNode.removeChild(typingDiv);
+        }
+    }
+
+    // --- [LÓGICA DE CONVERSA ATUALIZADA V3] ---
+
+    // (FUNÇÃO ATUALIZADA) Reseta todo o estado
+    function startChat() {
+        // Reseta estado principal
+        leadData = {};
+        conversationHistory = [];
+        currentLeadId = null;
+
+        // Reseta estado do fluxo
+        quoteData = {};
+        quoteStep = 0;
+        isWaitingForQuoteDecision = false;
+        isWaitingForQuoteDetails = false;
+        isWaitingForCnpj = false;
+
+        chatbotSend.disabled = false;
+        chatbotInput.placeholder = "Digite seu nome para começar...";
+        chatbotInput.disabled = false;
+
+        // Limpa mensagens antigas
+        while (chatbotMessages.children.length > 0) {
+            chatbotMessages.removeChild(chatbotMessages.lastChild);
+        }
+
+        const firstMessage = "Olá! Sou o assistente de IA da [SUA GRÁFICA] . Estou pronto para te ajudar. Para começar, qual seu nome?";
+        showTypingIndicator();
+        setTimeout(() => {
+            removeTypingIndicator();
+            addMessage(firstMessage, false);
+        }, 1000);
+    }
+
+    // (FUNÇÃO ATUALIZADA) Salva o CNPJ final
+    async function saveFinalLead(cnpj) {
+        chatbotInput.placeholder = "Salvando...";
+        chatbotSend.disabled = true; 
+        chatbotInput.disabled = true;
+
+        leadData['cnpj_fornecido'] = cnpj;
+
+        // Adiciona a resposta do CNPJ ao histórico final
+        conversationHistory.push({ role: 'user', text: cnpj, time: getCurrentTime() });
+
+        const payload = { 
+            ...leadData, 
+            lead_id: currentLeadId, 
+            historico_chat: conversationHistory // Envia o histórico completo
+        };
+
+        try {
+            const saveResponse = await fetch(`${RENDER_BACKEND_URL}/api/save-lead`, {
+                method: 'POST',
+                headers: { 'Content-Type': 'application/json' },
+                body: JSON.stringify(payload)
+            });
+
+            if (!saveResponse.ok) {
+                const errData = await saveResponse.json();
+                throw new Error(errData.error || "Não foi possível salvar a atualização final.");
+            }
+
+            console.log("Lead final salvo com CNPJ.");
+            addMessage("Entendido. Seus dados foram salvos! Nossa equipe já recebeu todas as informações e entrará em contato em breve. Obrigado!", false);
+            chatbotInput.placeholder = "Conversa finalizada.";
+
+        } catch (err) {
+            console.error("Erro ao salvar lead final:", err);
+            addMessage("Ocorreu um erro ao salvar sua última informação, mas não se preocupe, o principal foi salvo.", false);
+        }
+    }
+
+    // (FUNÇÃO ATUALIZADA) Roda a IA, salva a isca (NÃO MOSTRA) e pergunta sobre orçamento
+    async function generateAndSaveIsca() {
+        showTypingIndicator();
+        addMessage("Perfeito! Estou analisando seu perfil para gerar sua lista de brindes...", false);
+
+        try {
+            const recomResponse = await fetch(`${RENDER_BACKEND_URL}/api/generate-recommendations`, {
+                method: 'POST',
+                headers: { 'Content-Type': 'application/json' },
+                body: JSON.stringify({
+                    lead_id: currentLeadId,
+                    ramo: leadData.empresa_ramo
+                })
+            });
+
+            const recomResult = await recomResponse.json();
+            if (!recomResponse.ok) { 
+                throw new Error(recomResult.error || "Não foi possível gerar as recomendações.");
+            }
+
+            removeTypingIndicator();
+            // --- MUDANÇA CRÍTICA ---
+            // NÃO MOSTRA A ISCA. Avisa que será enviada por e-mail.
+            const nome = leadData.nome ? leadData.nome.split(' ')[0] : 'você'; // Pega o primeiro nome
+            addMessage(`Pronto, ${nome}! Nossos especialistas já estão com seu perfil. Você receberá um e-mail com 5 ideias de brindes personalizadas em breve.`, false);
+
+            // Agora, inicia o fluxo de orçamento
+            setTimeout(() => {
+                addMessage("Enquanto isso... **gostaria de adiantar um orçamento** sem compromisso? (Responda Sim ou Não)", false);
+                isWaitingForQuoteDecision = true; // Seta a flag
+                chatbotSend.disabled = false;
+                chatbotInput.focus();
+            }, 1000);
+
+        } catch (err) {
+            removeTypingIndicator();
+            console.error("Erro ao gerar isca:", err);
+            addMessage(`Ocorreu um erro ao gerar suas recomendações. (Detalhe: ${err.message})`, false);
+
+            // Mesmo com erro, pergunta sobre orçamento
+            setTimeout(() => {
+                addMessage("Gostaria de solicitar um orçamento mesmo assim? (Responda Sim ou Não)", false);
+                isWaitingForQuoteDecision = true;
+                chatbotSend.disabled = false;
+                chatbotInput.focus();
+            }, 1000);
+        }
+    }
+
+    // (FUNÇÃO ATUALIZADA) Lógica principal do chat (roteador)
+    async function sendMessage() {
+        const messageText = chatbotInput.value.trim();
+        if (messageText === '' || chatbotSend.disabled) return;
+
+        addMessage(messageText, true); 
+        chatbotInput.value = '';
+        chatbotSend.disabled = true; // Desabilita enquanto processa
+
+        try {
+            // --- ROTA 1: Coleta de Orçamento ---
+            if (isWaitingForQuoteDetails) {
+                await handleQuoteLogic(messageText);
+
+            // --- ROTA 2: Decisão de Orçamento ---
+            } else if (isWaitingForQuoteDecision) {
+                isWaitingForQuoteDecision = false;
+                if (messageText.toLowerCase().startsWith('s')) {
+                    // Usuário quer orçar
+                    isWaitingForQuoteDetails = true;
+                    quoteStep = 0;
+                    quoteData = {};
+                    addMessage(quoteQuestions[quoteStep], false);
+                    chatbotSend.disabled = false;
+                } else {
+                    // Usuário não quer orçar. Pula para o CNPJ.
+                    addMessage("Sem problemas. Para fechar: a [SUA GRÁFICA] vende apenas para CNPJ. Você já tem um CNPJ para agilizar o atendimento? (Responda Sim ou Não)", false);
+                    isWaitingForCnpj = true;
+                    chatbotSend.disabled = false;
+                }
+
+            // --- ROTA 3: Coleta de CNPJ ---
+            } else if (isWaitingForCnpj) {
+                isWaitingForCnpj = false;
+                await saveFinalLead(messageText); // Salva o CNPJ e finaliza
+
+            // --- ROTA 4: Coleta de Dados da IA ---
+            } else {
+                await handleChatLogic(messageText);
+            }
+
+        } catch (err) {
+            removeTypingIndicator();
+            console.error("Erro no fluxo principal de chat:", err);
+            addMessage(`Ocorreu um erro. 😥 Por favor, tente novamente. (Detalhe: ${err.message})`, false);
+            chatbotSend.disabled = false; // Reabilita em caso de erro
+            chatbotInput.focus();
+        }
+    }
+
+    // (NOVA FUNÇÃO) Roteador da IA
+    async function handleChatLogic(messageText) {
+        showTypingIndicator();
+
+        // Modo sessão: só a mensagem nova; o servidor guarda e remonta o histórico
+        const response = await postIdempotent('/api/chat', {
+            message: messageText,
+            leadData: leadData, 
+            leadId: currentLeadId 
+        });
+
+        const result = await response.json();
+        if (!response.ok) throw new Error(result.error || "Erro na API do chat.");
+
+        removeTypingIndicator();
+        addMessage(result.botResponse, false);
+
+        // Atualiza o estado local
+        leadData = result.leadData;
+        currentLeadId = result.leadId;
+
+        console.log("Lead data atualizado:", leadData);
+        console.log("Lead ID atual:", currentLeadId);
+
+        // A IA disse que coletou tudo (6/6)?
+        if (result.isComplete) {
+            // Sim! Hora de gerar a ISCA (que não será mostrada)
+            await generateAndSaveIsca();
+            // O botão de envio será reabilitado pela função acima
+        } else {
+            // Não, a conversa continua
+            chatbotSend.disabled = false;
+            chatbotInput.focus();
+        }
+    }
+
+    // (NOVA FUNÇÃO) Roteador do Orçamento
+    async function handleQuoteLogic(messageText) {
+        // Salva a resposta atual
+        const currentQuestionKey = [
+            'produto_desejado', 'quantidade_estimada', 'prazo_entrega', 
+            'tipo_de_gravacao', 'cidade_entrega'
+        ][quoteStep];
+
+        // Lógica para tratar "cidade, estado"
+        if (currentQuestionKey === 'cidade_entrega') {
+            const parts = messageText.split(',');
+            quoteData['cidade_entrega'] = parts[0] ? parts[0].trim() : 'Não informado';
+            quoteData['estado_entrega'] = parts[1] ? parts[1].trim() : 'Não informado';
+        } else {
+            quoteData[currentQuestionKey] = messageText;
+        }
+
+        quoteStep++; // Avança para a próxima pergunta
+
+        if (quoteStep < quoteQuestions.length) {
+            // Ainda tem perguntas
+            addMessage(quoteQuestions[quoteStep], false);
+            chatbotSend.disabled = false;
+        } else {
+            // Acabou! Salva o orçamento
+            isWaitingForQuoteDetails = false;
+            showTypingIndicator();
+
+            try {
+                const quoteResponse = await postIdempotent('/api/save-quote', {
+                    lead_id: currentLeadId, 
+                    quote_data: quoteData 
+                });
+                const quoteResult = await quoteResponse.json();
+                if (!quoteResponse.ok) throw new Error(quoteResult.error || "Não foi possível salvar orçamento.");
+
+                removeTypingIndicator();
+                addMessage("✅ Orçamento anotado! Nossa equipe de vendas já foi acionada.", false);
+
+                // Agora, VAI para o CNPJ
+                setTimeout(() => {
+                    addMessage("Para fechar: a [SUA GRÁFICA] vende apenas para CNPJ. Você já tem um CNPJ para agilizar o atendimento? (Responda Sim ou Não)", false);
+                    isWaitingForCnpj = true;
+                    chatbotSend.disabled = false;
+                }, 1000);
+
+            } catch (err) {
+                removeTypingIndicator();
+                console.error("Erro ao salvar orçamento:", err);
+                addMessage("Ocorreu um erro ao salvar seu orçamento. Vamos pular para a próxima etapa.", false);
+
+                // Pula para o CNPJ mesmo com erro
+                setTimeout(() => {
+                    addMessage("Para fechar: a [SUA GRÁFICA] vende apenas para CNPJ. Você já tem um CNPJ para agilizar o atendimento? (Responda Sim ou Não)", false);
+                    isWaitingForCnpj = true;
+                    chatbotSend.disabled = false;
+                }, 1000);
+            }
+        }
+    }
+
+    // --- FIM DA LÓGICA DE CONVERSA ---
+
+    if (chatbotSend) chatbotSend.addEventListener('click', sendMessage);
+    if (chatbotInput) chatbotInput.addEventListener('keypress', (e) => {
+        if (e.key === 'Enter') {
+            e.preventDefault();
+            sendMessage();
+        }
+    });
+
+    // --- FIM: LÓGICA DO CHATBOT ELOBOT V3 ---
+    // -----------------------------------------------------------
+
+});